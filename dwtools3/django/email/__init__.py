@@ -1,4 +1,14 @@
 """
 Package providing additional email services such as multipart
 text/html emails, and rendering emails from templates.
+
+Installation
+------------
+    - To use the ``send_queued_email`` command with ``QueuedEmailBackend``,
+      add to your ``INSTALLED_APPS``::
+
+        INSTALLED_APPS = INSTALLED_APPS + (
+            'dwtools3.django.email',
+        )
+
 """
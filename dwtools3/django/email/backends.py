@@ -1,5 +1,12 @@
+import os
+import smtplib
+import threading
+import time
+
+from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.backends.smtp import EmailBackend
 
+from .queue import enqueue_message
 from .settings import EmailSettings
 
 
@@ -16,3 +23,178 @@ class DebugSMTPEmailBackend(EmailBackend):
 
         email_message.recipients = lambda: [EmailSettings.EMAIL_DEBUG_BACKEND_OVERRIDE_ADDRESS]
         return super()._send(email_message)
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """
+    Email backend which adds emails to the outbound queue in
+    ``EMAIL_QUEUE_DIRECTORY`` rather than sending them, so the request isn't
+    delayed by the SMTP server. Run the ``send_queued_email`` management
+    command (eg. from cron, or with ``--loop``) to deliver queued emails.
+    """
+
+    def send_messages(self, email_messages):
+        count = 0
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            try:
+                enqueue_message(message)
+            except Exception:
+                if not self.fail_silently:
+                    raise
+            else:
+                count += 1
+        return count
+
+
+class _PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.sent = 0
+
+    def is_expired(self):
+        return (
+            self.sent >= EmailSettings.EMAIL_POOL_MAX_MESSAGES
+            or time.monotonic() - self.created_at >= EmailSettings.EMAIL_POOL_MAX_AGE
+        )
+
+    def is_healthy(self):
+        try:
+            return self.connection.noop()[0] == 250
+        except (OSError, smtplib.SMTPException):
+            return False
+
+    def close(self):
+        try:
+            self.connection.quit()
+        except (OSError, smtplib.SMTPException):
+            self.connection.close()
+
+
+class _SMTPConnectionPool:
+    """
+    Thread-safe per-process pool of idle SMTP connections, for each
+    server and login.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def acquire(self, key):
+        """
+        Returns a healthy idle connection, or None if there isn't one.
+        """
+        while True:
+            with self.lock:
+                if self.pid != os.getpid():
+                    # Don't share the parent's sockets after a fork
+                    self.pid = os.getpid()
+                    self.idle = {}
+                try:
+                    pooled = self.idle.get(key, []).pop()
+                except IndexError:
+                    return None
+
+            if not pooled.is_expired() and pooled.is_healthy():
+                return pooled
+            pooled.close()
+
+    def release(self, key, pooled):
+        """
+        Returns a connection to the pool, or closes it if expired or the pool is full.
+        """
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if (
+                self.pid == os.getpid()
+                and not pooled.is_expired()
+                and len(idle) < EmailSettings.EMAIL_POOL_SIZE
+            ):
+                idle.append(pooled)
+                return
+        pooled.close()
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for pooled in connections:
+                pooled.close()
+
+
+_smtp_connection_pool = _SMTPConnectionPool()
+
+
+class PooledSMTPEmailBackend(EmailBackend):
+    """
+    SMTP email backend which keeps a pool of authenticated connections open
+    per process, rather than connecting to the SMTP server for every
+    ``send_mail()`` call.
+
+    Idle connections are health checked with ``NOOP`` before reuse, and
+    recycled after ``EMAIL_POOL_MAX_MESSAGES`` emails or ``EMAIL_POOL_MAX_AGE``
+    seconds. At most ``EMAIL_POOL_SIZE`` idle connections are kept.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pooled = None
+
+    @property
+    def _pool_key(self):
+        return (self.host, self.port, self.username, self.use_tls, self.use_ssl)
+
+    def open(self):
+        if self.connection:
+            return False
+
+        pooled = _smtp_connection_pool.acquire(self._pool_key)
+        if pooled is not None:
+            self.connection = pooled.connection
+            self._pooled = pooled
+            return True
+
+        new_conn_created = super().open()
+        if self.connection:
+            self._pooled = _PooledConnection(self.connection)
+        return new_conn_created
+
+    def close(self):
+        if self.connection is None:
+            return
+
+        pooled, self._pooled = self._pooled, None
+        if pooled is None:
+            super().close()
+        else:
+            self.connection = None
+            _smtp_connection_pool.release(self._pool_key, pooled)
+
+    def _send(self, email_message):
+        try:
+            sent = super()._send(email_message)
+        except Exception:
+            self._discard_connection()
+            raise
+
+        if not sent and email_message.recipients():
+            # An SMTP error was swallowed with fail_silently
+            self._discard_connection()
+        elif sent and self._pooled is not None:
+            self._pooled.sent += 1
+        return sent
+
+    def _discard_connection(self):
+        """
+        Marks the current connection to be closed by ``close()`` rather than
+        returned to the pool, as it's in an unknown state after an error.
+        It's still used for the remaining messages of ``send_messages()``.
+        """
+        self._pooled = None
@@ -0,0 +1,65 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...queue import drain_queue, logger, recover_stale_messages
+
+
+class Command(BaseCommand):
+    help = "Deliver emails queued by QueuedEmailBackend"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            action="store",
+            type=int,
+            dest="workers",
+            default=4,
+            help="Number of concurrent worker threads delivering emails.",
+        )
+        parser.add_argument(
+            "--rate-limit",
+            action="store",
+            type=float,
+            dest="rate_limit",
+            default=None,
+            help="Maximum emails sent per second. Defaults to EMAIL_QUEUE_RATE_LIMIT.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            dest="loop",
+            default=False,
+            help="Keep polling the queue for new emails rather than exiting when it's empty.",
+        )
+        parser.add_argument(
+            "--interval",
+            action="store",
+            type=float,
+            dest="interval",
+            default=5.0,
+            help="Seconds between polls of the queue with --loop.",
+        )
+
+    def handle(self, *args, **options):
+        if int(options.get("verbosity")) < 1:
+            logger.setLevel(logging.WARN)
+
+        recovered = recover_stale_messages()
+        if recovered:
+            logger.warning("Recovered %d stale emails.", recovered)
+
+        while True:
+            result = drain_queue(workers=options["workers"], rate_limit=options["rate_limit"])
+            if any(result):
+                logger.info(
+                    "Sent %d emails, %d scheduled for retry, %d failed.",
+                    result.sent,
+                    result.retried,
+                    result.failed,
+                )
+
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
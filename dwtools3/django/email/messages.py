@@ -1,7 +1,11 @@
 """
 Provides enhanced email messaging such as mutlipart html/text emails.
 """
+from collections import OrderedDict
+import hashlib
+from html.parser import HTMLParser
 import re
+import threading
 
 from django.conf import settings
 from django.core import mail as django_mail
@@ -24,9 +28,39 @@ INVISIBLE_HTML_TAGS_RE = [
     for tag in INVISIBLE_HTML_TAGS
 ]
 INVISIBLE_HTML_TAGS_RE.append(re.compile(r"<!--.*?-->", re.IGNORECASE | re.DOTALL))
-INVISIBLE_HTML_TAGS_RE.append(re.compile(r"<!--.*?-->", re.IGNORECASE | re.DOTALL))
 TRIM_NEWLINES_RE = re.compile(r"\n\s*\n\s*(\n\s*)+")
 
+BLOCK_HTML_TAGS = {
+    "p": 2,
+    "h1": 2,
+    "h2": 2,
+    "h3": 2,
+    "h4": 2,
+    "h5": 2,
+    "h6": 2,
+    "blockquote": 2,
+    "pre": 2,
+    "hr": 2,
+    "ul": 2,
+    "ol": 2,
+    "table": 2,
+    "div": 1,
+    "tr": 1,
+    "li": 1,
+}
+"""
+HTML tags converted to line breaks by ``html_to_text()``, and the number
+of newlines to end up with before and after each one.
+"""
+
+HTML_TO_TEXT_CACHE_SIZE = 32
+"""
+The maximum number of converted HTML bodies memoized by ``html_to_text()``.
+"""
+
+_html_to_text_cache = OrderedDict()
+_html_to_text_cache_lock = threading.Lock()
+
 
 def strip_html_tags(message):
     for regexp in INVISIBLE_HTML_TAGS_RE:
@@ -55,6 +89,120 @@ def html_decode(s):
     return s
 
 
+class _HTMLToTextParser(HTMLParser):
+    """
+    Converts HTML to text in a single pass, collecting text content
+    outside of invisible tags, and adding line breaks for block tags.
+
+    Whitespace between text is buffered, so that line breaks from tags
+    and line breaks in the HTML source aren't doubled up.
+    """
+
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.invisible_depth = 0
+        self.started = False
+        self.pending_whitespace = ""
+        self.pending_newlines = 0
+        self.pending_breaks = 0
+        self.pending_prefix = ""
+
+    def handle_starttag(self, tag, attrs):
+        if tag in INVISIBLE_HTML_TAGS and tag != "embed":
+            self.invisible_depth += 1
+        elif tag == "body":
+            # Recover from an unclosed <head>
+            self.invisible_depth = 0
+        elif self.invisible_depth:
+            pass
+        elif tag == "br":
+            self.pending_breaks += 1
+        elif tag in BLOCK_HTML_TAGS:
+            self.pending_newlines = max(self.pending_newlines, BLOCK_HTML_TAGS[tag])
+            if tag == "li":
+                self.pending_prefix = "- "
+
+    def handle_startendtag(self, tag, attrs):
+        if tag not in INVISIBLE_HTML_TAGS:
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in INVISIBLE_HTML_TAGS and tag != "embed":
+            self.invisible_depth = max(0, self.invisible_depth - 1)
+        elif not self.invisible_depth and tag in BLOCK_HTML_TAGS:
+            self.pending_newlines = max(self.pending_newlines, BLOCK_HTML_TAGS[tag])
+
+    def handle_data(self, data):
+        if self.invisible_depth:
+            return
+
+        text = data.strip(self.WHITESPACE)
+        if not text:
+            self.pending_whitespace += data
+            return
+
+        start = data.index(text[0])
+        self.pending_whitespace += data[:start]
+
+        if self.started:
+            newlines = max(
+                self.pending_newlines,
+                self.pending_breaks,
+                self.pending_whitespace.count("\n"),
+            )
+            self.parts.append("\n" * newlines if newlines else self.pending_whitespace)
+        self.parts.append(self.pending_prefix)
+        self.parts.append(text.replace("\xa0", " "))
+
+        self.started = True
+        self.pending_whitespace = data[start + len(text) :]
+        self.pending_newlines = 0
+        self.pending_breaks = 0
+        self.pending_prefix = ""
+
+
+def html_to_text(html):
+    """
+    Converts a HTML message to plain text, for the text version of an email.
+
+    Removes invisible content (eg. ``<head>``, ``<style>``, ``<script>`` and
+    comments) and all tags, decodes entities, and adds line breaks for block
+    level tags (eg. ``<p>``, ``<div>``, ``<br>``) and bullets for list items.
+    Line breaks & indentation in the source HTML are otherwise preserved,
+    with leading and trailing whitespace removed from each line, and no more
+    than one consecutive blank line.
+
+    Parses the HTML in a single pass. The ``HTML_TO_TEXT_CACHE_SIZE`` most recently
+    converted messages are memoized by a hash of the HTML, as the same body
+    is often sent to many recipients, eg. for newsletters.
+    """
+    key = hashlib.sha256(html.encode("utf-8", "surrogatepass")).digest()
+    with _html_to_text_cache_lock:
+        text = _html_to_text_cache.get(key)
+        if text is not None:
+            _html_to_text_cache.move_to_end(key)
+            return text
+
+    text = _convert_html_to_text(html)
+    with _html_to_text_cache_lock:
+        _html_to_text_cache[key] = text
+        if len(_html_to_text_cache) > HTML_TO_TEXT_CACHE_SIZE:
+            _html_to_text_cache.popitem(last=False)
+    return text
+
+
+def _convert_html_to_text(html):
+    parser = _HTMLToTextParser()
+    parser.feed(html)
+    parser.close()
+
+    text = "\n".join(line.strip() for line in "".join(parser.parts).split("\n"))
+    return TRIM_NEWLINES_RE.sub("\n\n", text).strip()
+
+
 class HTMLEmail(EmailMultiAlternatives):
     """
     Extends Django's EmailMultiAlternatives class to automatically
@@ -119,7 +267,7 @@ class HTMLEmail(EmailMultiAlternatives):
         """
         if self.as_html and self.body:
             html = self.body
-            self.body = html_decode(strip_html_tags(self.body))
+            self.body = html_to_text(self.body)
             self.attach_alternative(html, "text/html")
 
         if self.from_email:
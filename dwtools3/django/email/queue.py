@@ -0,0 +1,293 @@
+"""
+A file-backed outbound email queue, so emails can be sent from a request
+without waiting on the SMTP server.
+
+Emails sent with ``QueuedEmailBackend`` are serialized to files in
+``EMAIL_QUEUE_DIRECTORY``, and delivered by the ``send_queued_email``
+management command using ``EMAIL_QUEUE_BACKEND``.
+
+The queue directory contains the following subdirectories:
+
+    - ``tmp``: Emails being written to the queue.
+    - ``queue``: Emails waiting to be delivered.
+    - ``sending``: Emails claimed by a worker for delivery.
+    - ``failed``: Emails which failed delivery after ``EMAIL_QUEUE_MAX_RETRIES`` retries.
+
+Queued emails are claimed by atomically renaming them to the ``sending``
+directory, so multiple worker threads or processes can safely drain
+the same queue.
+"""
+from collections import namedtuple
+from email import message_from_bytes
+from email.message import Message
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from django.core import mail as django_mail
+from django.core.mail.message import EmailMessage, MIMEMixin
+
+from .settings import EmailSettings
+
+logger = logging.getLogger("dwtools3.django.email")
+
+QUEUE_SUBDIRECTORIES = ("tmp", "queue", "sending", "failed")
+QUEUED_EMAIL_EXTENSION = ".eml"
+
+
+def get_queue_directory(subdirectory):
+    """
+    Returns the path of a subdirectory of ``EMAIL_QUEUE_DIRECTORY``.
+    """
+    if not EmailSettings.EMAIL_QUEUE_DIRECTORY:
+        raise RuntimeError(
+            "Please configure the EMAIL_QUEUE_DIRECTORY setting to use the email queue."
+        )
+    return os.path.join(EmailSettings.EMAIL_QUEUE_DIRECTORY, subdirectory)
+
+
+def _make_filename(not_before, attempts):
+    return "{:017.6f}-{}-{}{}".format(
+        not_before, attempts, uuid.uuid4().hex, QUEUED_EMAIL_EXTENSION
+    )
+
+
+def _parse_filename(filename):
+    """
+    Returns the ``(not_before, attempts)`` of a queued email filename.
+    """
+    not_before, attempts, _ = filename.split("-", 2)
+    return float(not_before), int(attempts)
+
+
+class _QueuedMIMEMessage(MIMEMixin, Message):
+    """
+    A parsed MIME message supporting the ``as_bytes(linesep=...)`` used by Django's backends.
+    """
+
+
+class QueuedEmailMessage(EmailMessage):
+    """
+    An email read back from the queue, which sends the original serialized
+    MIME message to the original envelope recipients.
+    """
+
+    def __init__(self, raw_message, from_email, recipients, connection=None):
+        super().__init__(from_email=from_email, to=recipients, connection=connection)
+        self.raw_message = raw_message
+
+    def message(self):
+        return message_from_bytes(self.raw_message, _class=_QueuedMIMEMessage)
+
+    def recipients(self):
+        return self.to
+
+
+def enqueue_message(email_message):
+    """
+    Serializes an ``EmailMessage`` to the queue. Returns the queued filename.
+    """
+    envelope = {"from": email_message.from_email, "recipients": email_message.recipients()}
+    data = json.dumps(envelope).encode("utf-8") + b"\n" + email_message.message().as_bytes()
+
+    for subdirectory in QUEUE_SUBDIRECTORIES:
+        os.makedirs(get_queue_directory(subdirectory), exist_ok=True)
+
+    filename = _make_filename(time.time(), 0)
+    tmp_path = os.path.join(get_queue_directory("tmp"), filename)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(get_queue_directory("queue"), filename))
+    return filename
+
+
+def read_queued_message(path):
+    """
+    Returns the ``QueuedEmailMessage`` stored in a queued email file.
+    """
+    with open(path, "rb") as f:
+        envelope, raw_message = f.read().split(b"\n", 1)
+    envelope = json.loads(envelope)
+    return QueuedEmailMessage(raw_message, envelope["from"], envelope["recipients"])
+
+
+def list_queued_messages(due_only=True):
+    """
+    Returns the filenames of queued emails, oldest first. If ``due_only``,
+    excludes emails waiting to be retried later.
+    """
+    try:
+        filenames = os.listdir(get_queue_directory("queue"))
+    except FileNotFoundError:
+        return []
+
+    now = time.time()
+    return sorted(
+        f
+        for f in filenames
+        if f.endswith(QUEUED_EMAIL_EXTENSION) and (not due_only or _parse_filename(f)[0] <= now)
+    )
+
+
+def recover_stale_messages(timeout=3600):
+    """
+    Returns emails claimed more than ``timeout`` seconds ago (eg. by a worker
+    that crashed) back to the queue. Returns the number of emails recovered.
+    """
+    recovered = 0
+    try:
+        filenames = os.listdir(get_queue_directory("sending"))
+    except FileNotFoundError:
+        return 0
+
+    for filename in filenames:
+        path = os.path.join(get_queue_directory("sending"), filename)
+        try:
+            if os.path.getmtime(path) < time.time() - timeout:
+                os.rename(path, os.path.join(get_queue_directory("queue"), filename))
+                recovered += 1
+        except FileNotFoundError:
+            pass
+    return recovered
+
+
+class _RateLimiter:
+    """
+    Limits the rate of an operation across threads to ``rate`` per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_time, now)
+            self.next_time = wait_until + self.interval
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+
+DrainResult = namedtuple("DrainResult", ["sent", "retried", "failed"])
+"""
+The result of ``drain_queue()``: the number of emails sent, scheduled
+for retry, and moved to the ``failed`` directory.
+"""
+
+
+class _QueueWorker(threading.Thread):
+    """
+    Worker thread delivering claimed emails over a single backend connection.
+    """
+
+    def __init__(self, filenames, counts, lock, rate_limiter, backend, max_retries, retry_delay):
+        super().__init__(name="EmailQueueWorker", daemon=True)
+        self.filenames = filenames
+        self.counts = counts
+        self.lock = lock
+        self.rate_limiter = rate_limiter
+        self.backend = backend
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.connection = None
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    filename = self.filenames.get_nowait()
+                except queue.Empty:
+                    break
+                self.process(filename)
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+
+    def process(self, filename):
+        path = os.path.join(get_queue_directory("queue"), filename)
+        claimed_path = os.path.join(get_queue_directory("sending"), filename)
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            # Claimed by another worker
+            return
+        os.utime(claimed_path)
+
+        if self.rate_limiter:
+            self.rate_limiter.wait()
+
+        try:
+            if self.connection is None:
+                self.connection = django_mail.get_connection(self.backend)
+                self.connection.open()
+            self.connection.send_messages([read_queued_message(claimed_path)])
+        except Exception:  # pylint: disable=broad-except
+            # The connection may be broken, so reconnect for the next email
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            self.retry(filename, claimed_path)
+        else:
+            os.unlink(claimed_path)
+            self.increment("sent")
+
+    def retry(self, filename, claimed_path):
+        _, attempts = _parse_filename(filename)
+        if attempts >= self.max_retries:
+            logger.exception("Failed to send queued email %s, giving up.", filename)
+            os.rename(claimed_path, os.path.join(get_queue_directory("failed"), filename))
+            self.increment("failed")
+        else:
+            logger.warning("Failed to send queued email %s, will retry.", filename, exc_info=True)
+            not_before = time.time() + self.retry_delay * 2**attempts
+            os.rename(
+                claimed_path,
+                os.path.join(
+                    get_queue_directory("queue"), _make_filename(not_before, attempts + 1)
+                ),
+            )
+            self.increment("retried")
+
+    def increment(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+
+def drain_queue(workers=1, backend=None, max_retries=None, retry_delay=None, rate_limit=None):
+    """
+    Delivers all due emails in the queue using ``workers`` concurrent threads,
+    each with its own connection to the email backend. Returns a ``DrainResult``.
+
+    Emails which fail delivery are retried with exponential backoff on a later
+    run, once their retry delay has elapsed.
+
+    Parameters default to the ``EMAIL_QUEUE_*`` settings.
+    """
+    backend = backend or EmailSettings.EMAIL_QUEUE_BACKEND
+    max_retries = EmailSettings.EMAIL_QUEUE_MAX_RETRIES if max_retries is None else max_retries
+    retry_delay = EmailSettings.EMAIL_QUEUE_RETRY_DELAY if retry_delay is None else retry_delay
+    rate_limit = rate_limit or EmailSettings.EMAIL_QUEUE_RATE_LIMIT
+
+    filenames = queue.Queue()
+    for filename in list_queued_messages():
+        filenames.put(filename)
+
+    counts = {"sent": 0, "retried": 0, "failed": 0}
+    lock = threading.Lock()
+    rate_limiter = _RateLimiter(rate_limit) if rate_limit else None
+    threads = [
+        _QueueWorker(filenames, counts, lock, rate_limiter, backend, max_retries, retry_delay)
+        for _ in range(max(1, min(workers, filenames.qsize())))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return DrainResult(counts["sent"], counts["retried"], counts["failed"])
@@ -20,3 +20,48 @@ class EmailSettings(SettingsProxy):
     Set this to an email address which should receive all emails sent
     by the system, when using the DebugSMTPEmailBackend backend.
     """
+
+    EMAIL_QUEUE_DIRECTORY = None
+    """
+    The directory used by ``QueuedEmailBackend`` to store queued emails.
+    Must be set to use the backend, and shared by all web & worker processes.
+    """
+
+    EMAIL_QUEUE_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    """
+    The email backend used by the ``send_queued_email`` command to deliver queued emails.
+    """
+
+    EMAIL_QUEUE_MAX_RETRIES = 5
+    """
+    The number of times delivery of a queued email is retried before it's
+    moved to the ``failed`` directory of the queue.
+    """
+
+    EMAIL_QUEUE_RETRY_DELAY = 60
+    """
+    Seconds to wait before the first retry of a queued email. The delay
+    doubles with each subsequent retry.
+    """
+
+    EMAIL_QUEUE_RATE_LIMIT = None
+    """
+    If set, the maximum number of queued emails delivered per second,
+    across all worker threads of the ``send_queued_email`` command.
+    """
+
+    EMAIL_POOL_SIZE = 4
+    """
+    The maximum number of idle SMTP connections kept open per process by
+    ``PooledSMTPEmailBackend``.
+    """
+
+    EMAIL_POOL_MAX_MESSAGES = 100
+    """
+    Pooled SMTP connections are closed after sending this many emails.
+    """
+
+    EMAIL_POOL_MAX_AGE = 300
+    """
+    Pooled SMTP connections are closed after being open for this many seconds.
+    """
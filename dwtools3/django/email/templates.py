@@ -1,11 +1,17 @@
+from collections import namedtuple
+import itertools
+import logging
 import re
+import time
 
 from django.conf import settings
+from django.core import mail as django_mail
 
 from . import messages
-from ..helpers.view_helpers import render_template_to_string
+from ..helpers.view_helpers import get_compiled_template, render_template_to_string
 from .settings import EmailSettings
 
+logger = logging.getLogger("dwtools3.django.email")
 
 CONDENSE_WHITESPACE_RE = re.compile(r"\s+")
 REMOVE_INDENTS_RE = re.compile(r"\n +")
@@ -51,12 +57,7 @@ def send_email(
     ``as_html`` indicates whether to send a HTML or plain text email.
     """
     vars = vars or {}
-
-    if EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT:
-        if callable(EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT):
-            vars.update(EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT())
-        else:
-            vars.update(EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT)
+    vars.update(_get_extra_template_context())
 
     if hasattr(user_or_to, "get_full_name"):
         to = [(user_or_to.get_full_name(), user_or_to.email)]
@@ -99,6 +100,164 @@ def send_email(
     )
 
 
+def _get_extra_template_context():
+    if callable(EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT):
+        return EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT()
+    return EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT or {}
+
+
+BulkEmailError = namedtuple("BulkEmailError", ["batch", "recipients", "exception"])
+"""
+A batch of emails that ``send_bulk_email()`` failed to send, or a single
+recipient's email that failed to render.
+"""
+
+BulkEmailResult = namedtuple("BulkEmailResult", ["sent", "failed", "errors"])
+"""
+The result of ``send_bulk_email()``: the number of emails sent and failed,
+and a list of ``BulkEmailError`` for each failed batch.
+"""
+
+
+def send_bulk_email(
+    users_or_recipients,
+    template_prefix=None,
+    vars_fn=None,
+    subject=None,
+    body=None,
+    batch_size=100,
+    frm=None,
+    headers=None,
+    as_html=True,
+    max_retries=2,
+    retry_delay=1.0,
+):
+    """
+    Sends a separately rendered email to each of many recipients, eg. for
+    a newsletter. Equivalent to calling ``send_email()`` for each recipient,
+    but the templates are compiled once, and emails are sent in batches
+    over a single connection to the email backend.
+
+    ``users_or_recipients`` is an iterable of User objects, or single
+    recipients as accepted by HTMLEmail (eg. ``"a@b.com"`` or
+    ``("Name", "a@b.com")``).
+
+    ``template_prefix``, ``subject`` and ``body`` are as for ``send_email()``.
+
+    ``vars_fn`` is an optional function called with each user or recipient,
+    returning a dict of template variables for that recipient's email. As for
+    ``vars`` in ``send_email()``, ``EMAIL_EXTRA_TEMPLATE_CONTEXT`` takes precedence.
+
+    ``batch_size`` is the number of emails sent with each
+    ``connection.send_messages()`` call.
+
+    If sending a batch fails, the connection is reopened and the batch is
+    retried up to ``max_retries`` times, with exponential backoff starting at
+    ``retry_delay`` seconds. As the whole batch is retried, recipients sent to
+    before the error may receive a duplicate email. Batches that still fail
+    are logged and reported in the result, and sending continues with the
+    next batch. Likewise if rendering a recipient's email (including calling
+    ``vars_fn``) fails, the error is logged and reported in the result, and
+    the rest of the batch is sent.
+
+    Returns a ``BulkEmailResult``.
+    """
+    subject_template = get_compiled_template(
+        template_prefix + ".subject.txt" if template_prefix else None,
+        None if template_prefix else subject,
+    )
+    body_template = get_compiled_template(
+        template_prefix + ".body.html" if template_prefix else None,
+        None if template_prefix else body,
+    )
+    extra_context = _get_extra_template_context()
+
+    def get_to(recipient):
+        if hasattr(recipient, "get_full_name"):
+            return [(recipient.get_full_name(), recipient.email)]
+        return [recipient]
+
+    def render(recipient):
+        # Same precedence as send_email()
+        vars = dict(vars_fn(recipient)) if vars_fn else {}
+        vars.update(extra_context)
+        if hasattr(recipient, "get_full_name"):
+            vars["USER"] = recipient
+
+        rendered_subject = subject_template.render(vars)
+        rendered_subject = CONDENSE_WHITESPACE_RE.sub(" ", rendered_subject).strip()
+        vars["SUBJECT"] = rendered_subject
+
+        return messages.HTMLEmail(
+            rendered_subject,
+            body_template.render(vars),
+            from_email=(frm or settings.DEFAULT_FROM_EMAIL),
+            to=get_to(recipient),
+            headers=headers,
+            connection=connection,
+            as_html=as_html,
+        )
+
+    def render_batch(batch_index, batch_recipients):
+        nonlocal failed
+        batch = []
+        for recipient in batch_recipients:
+            try:
+                batch.append(render(recipient))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("Failed to render bulk email in batch %d.", batch_index)
+                failed += 1
+                errors.append(BulkEmailError(batch_index, get_to(recipient), e))
+        return batch
+
+    def send_batch(batch):
+        for attempt in range(max_retries + 1):
+            try:
+                return connection.send_messages(batch) or 0
+            except Exception as e:  # pylint: disable=broad-except
+                if attempt == max_retries:
+                    raise
+                logger.warning(
+                    "Error sending bulk email batch, retrying (%d/%d): %s",
+                    attempt + 1,
+                    max_retries,
+                    e,
+                )
+                connection.close()
+                time.sleep(retry_delay * 2**attempt)
+                connection.open()
+        return 0
+
+    sent = 0
+    failed = 0
+    errors = []
+    recipients = iter(users_or_recipients)
+    connection = django_mail.get_connection()
+    connection.open()
+    try:
+        batch_index = 0
+        while True:
+            batch_recipients = list(itertools.islice(recipients, batch_size))
+            if not batch_recipients:
+                break
+
+            batch = render_batch(batch_index, batch_recipients)
+            try:
+                if batch:
+                    sent += send_batch(batch)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("Failed to send bulk email batch %d.", batch_index)
+                failed += len(batch)
+                errors.append(
+                    BulkEmailError(batch_index, [r for m in batch for r in m.recipients()], e)
+                )
+            batch_index += 1
+    finally:
+        connection.close()
+
+    return BulkEmailResult(sent, failed, errors)
+
+
 def send_email_to_admins(
     subject=None,
     body=None,
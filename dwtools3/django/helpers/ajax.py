@@ -1,21 +1,41 @@
 """
 Decorators and exceptions for handling Ajax views with JSON input and output.
 """
+import asyncio
 import enum
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import copy
 from functools import wraps
-import json
+import hashlib
+import logging
 import time
 
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.cache import caches
+from django.core.exceptions import BadRequest, PermissionDenied, SuspiciousOperation
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.http import Http404, QueryDict
 from django.http.response import (
     HttpResponseBadRequest,
-    JsonResponse,
+    HttpResponseBase,
     HttpResponseForbidden,
     HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
 )
-from django.utils.http import http_date
+from django.middleware.csrf import get_token
+from django.urls import Resolver404, resolve
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import http_date, parse_etags
 from django.views.decorators.csrf import ensure_csrf_cookie
 
+from .json_backends import get_json_backend
+
+logger = logging.getLogger("dwtools3.django.helpers")
+
 
 class AjaxBadRequest(Exception):
     """
@@ -29,7 +49,58 @@ class AjaxPermissionDenied(Exception):
     """
 
 
-def ajax(methods, login_required=False, expires_in=None, encoder=DjangoJSONEncoder):
+AJAX_CACHE_KEY_PREFIX = "dwtools3:ajax:"
+STREAMING_CHUNK_SIZE = 64 * 1024
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def _get_ajax_cache_key(fn, request, args, kwargs, vary_on):
+    """
+    Returns the cache key for an Ajax view call, based on the view, its arguments,
+    the query string and request body, and any extra ``vary_on`` values.
+    """
+    h = hashlib.sha256()
+    parts = [
+        fn.__module__,
+        fn.__qualname__,
+        request.method,
+        repr(args),
+        repr(sorted(kwargs.items())),
+        request.META.get("QUERY_STRING", ""),
+    ]
+    for v in vary_on:
+        if v == "user":
+            parts.append(str(request.user.pk) if request.user.is_authenticated else "")
+        elif v == "session":
+            parts.append(request.session.session_key or "")
+        else:
+            parts.append(request.META.get(v, ""))
+
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(request.body)
+    return AJAX_CACHE_KEY_PREFIX + h.hexdigest()
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return "*" in etags or etag in etags
+
+
+def ajax(
+    methods,
+    login_required=False,
+    expires_in=None,
+    encoder=DjangoJSONEncoder,
+    cache_ttl=None,
+    vary_on=None,
+    cache_alias="default",
+    json_backend="json",
+):
     """
     Decorator to pre- and post-process an Ajax view with JSON inputs and outputs.
 
@@ -45,6 +116,35 @@ def ajax(methods, login_required=False, expires_in=None, encoder=DjangoJSONEncod
         should be made before the view runs.
     :param int expires_in: If none, no caching headers are sent. If positive/negative,
         the Expires HTTP header is set for the given number of secs forward/backward.
+    :param int cache_ttl: If set, the encoded JSON response is stored in the Django
+        cache for this many seconds, and served from there without invoking the view.
+        Responses also get an ``ETag`` header, and requests with a matching
+        ``If-None-Match`` header get a 304 Not Modified response.
+    :param list vary_on: The cache key always includes the view, its arguments, the query
+        string and the request body. Add ``"user"`` or ``"session"`` to cache per
+        user/session, or ``request.META`` keys (eg. ``"HTTP_ACCEPT_LANGUAGE"``).
+        ``"user"`` is added automatically for ``login_required`` views.
+    :param str cache_alias: The Django cache to use with ``cache_ttl``.
+    :param str json_backend: The JSON backend to decode requests and encode responses:
+        ``"json"`` (standard library), ``"orjson"``, ``"ujson"``, or ``"auto"`` for ``orjson``
+        if installed. See ``dwtools3.django.helpers.json_backends`` for output differences.
+
+    The view may be a coroutine function (``async def``), in which case an async view
+    is returned. For async views, the CSRF cookie is set by ``CsrfViewMiddleware``
+    rather than ``ensure_csrf_cookie`` (which only supports sync views).
+
+    If the view returns an iterator (eg. a generator or ``queryset.iterator()``) or a
+    ``QuerySet``, the items are encoded one at a time and streamed as a JSON array in a
+    ``StreamingHttpResponse``, using bounded memory. If the request's ``Accept`` header
+    includes ``application/x-ndjson``, they are streamed as newline-delimited JSON instead.
+    Streamed responses are not cached, and exceptions raised while iterating can't be
+    converted to error responses.
+
+    Under ASGI, streamed responses are iterated in the event loop, where the ORM can't
+    be used. So a ``QuerySet`` returned by an async view is evaluated with
+    ``sync_to_async()`` before streaming, holding all its rows in memory, and async
+    views must not return other iterators which query the database, eg.
+    ``queryset.iterator()``.
 
     Example::
 
@@ -60,50 +160,181 @@ def ajax(methods, login_required=False, expires_in=None, encoder=DjangoJSONEncod
         methods, (str, tuple, list)
     ), "First argument to @ajax must be a list of supported HTTP methods."
     methods = tuple(methods) if isinstance(methods, str) else methods
+    vary_on = tuple(vary_on or ())
+    if login_required and "user" not in vary_on:
+        # Never serve one user's cached response to another
+        vary_on += ("user",)
+    backend = get_json_backend(json_backend)
 
     def decorator(fn):
-        @wraps(fn)
-        def wrapper(request, *args, **kwargs):
+        def preprocess(request, args, kwargs):
+            """
+            Returns an early response (or None), and the view's kwargs & cache key.
+            """
             if request.method not in methods:
-                return HttpResponseBadRequest("Method {} not supported.".format(request.method))
+                response = HttpResponseBadRequest("Method {} not supported.".format(request.method))
+                return response, kwargs, None
 
             if login_required and not request.user.is_authenticated:
-                return HttpResponseForbidden("Permission denied.")
+                return HttpResponseForbidden("Permission denied."), kwargs, None
+
+            cache_key = None
+            if cache_ttl:
+                cache_key = _get_ajax_cache_key(fn, request, args, kwargs, vary_on)
+                cached = caches[cache_alias].get(cache_key)
+                if cached is not None:
+                    content, etag = cached
+                    if _etag_matches(request, etag):
+                        response = HttpResponseNotModified()
+                    else:
+                        response = HttpResponse(content, content_type="application/json")
+                    response["ETag"] = etag
+                    return _set_expires(response, expires_in), kwargs, cache_key
 
             if request.body:
                 try:
-                    jsondata = json.loads(request.body.decode("utf-8"))
+                    jsondata = backend.loads(request.body)
                 except ValueError:
-                    return HttpResponseBadRequest("Invalid JSON in request body.")
+                    return HttpResponseBadRequest("Invalid JSON in request body."), kwargs, None
 
                 if not isinstance(jsondata, (dict, list)):
-                    return HttpResponseBadRequest("JSON object is required.")
+                    return HttpResponseBadRequest("JSON object is required."), kwargs, None
 
                 kwargs = dict(kwargs, jsondata=jsondata)
 
-            try:
-                ret = fn(request, *args, **kwargs)
-            except AjaxBadRequest as e:
-                return HttpResponseBadRequest(str(e))
-            except AjaxPermissionDenied as e:
-                return HttpResponseForbidden(str(e) or "Permission denied.")
+            return None, kwargs, cache_key
 
-            if isinstance(ret, HttpResponse):
+        def postprocess(request, ret, cache_key):
+            if isinstance(ret, HttpResponseBase):
                 response = ret
+            elif isinstance(ret, (Iterator, QuerySet)):
+                ndjson = NDJSON_CONTENT_TYPE in request.META.get("HTTP_ACCEPT", "")
+                response = StreamingHttpResponse(
+                    _stream_json(ret, backend, encoder, ndjson),
+                    content_type=NDJSON_CONTENT_TYPE if ndjson else "application/json",
+                )
             else:
-                response = JsonResponse(data=ret, safe=False, encoder=encoder)
+                response = HttpResponse(
+                    backend.dumps(ret, encoder), content_type="application/json"
+                )
+
+                if cache_key:
+                    etag = '"{}"'.format(hashlib.sha1(response.content).hexdigest())
+                    caches[cache_alias].set(cache_key, (response.content, etag), cache_ttl)
+                    if _etag_matches(request, etag):
+                        response = HttpResponseNotModified()
+                    response["ETag"] = etag
+
+            return _set_expires(response, expires_in)
+
+        if asyncio.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def async_wrapper(request, *args, **kwargs):
+                if login_required or "user" in vary_on:
+                    # Load the lazy user outside of the event loop
+                    await sync_to_async(lambda: request.user.is_authenticated)()
+
+                if cache_ttl:
+                    # Cache backends aren't async-safe, eg. the database cache
+                    response, kwargs, cache_key = await sync_to_async(preprocess)(
+                        request, args, kwargs
+                    )
+                else:
+                    response, kwargs, cache_key = preprocess(request, args, kwargs)
+                if response is not None:
+                    return response
+
+                # Equivalent of ensure_csrf_cookie, which doesn't support async views
+                get_token(request)
 
-            if expires_in:
-                response["Expires"] = http_date(time.time() + expires_in)
-                response["Cache-Control"] = "private, max-age={}".format(expires_in)
+                try:
+                    ret = await fn(request, *args, **kwargs)
+                except AjaxBadRequest as e:
+                    return HttpResponseBadRequest(str(e))
+                except AjaxPermissionDenied as e:
+                    return HttpResponseForbidden(str(e) or "Permission denied.")
 
-            return response
+                if isinstance(ret, QuerySet):
+                    ret = iter(await sync_to_async(list)(ret))
 
-        return ensure_csrf_cookie(wrapper)
+                if cache_key:
+                    return await sync_to_async(postprocess)(request, ret, cache_key)
+                return postprocess(request, ret, cache_key)
+
+            view = async_wrapper
+        else:
+
+            @wraps(fn)
+            def wrapper(request, *args, **kwargs):
+                response, kwargs, cache_key = preprocess(request, args, kwargs)
+                if response is not None:
+                    return response
+
+                try:
+                    ret = fn(request, *args, **kwargs)
+                except AjaxBadRequest as e:
+                    return HttpResponseBadRequest(str(e))
+                except AjaxPermissionDenied as e:
+                    return HttpResponseForbidden(str(e) or "Permission denied.")
+
+                return postprocess(request, ret, cache_key)
+
+            view = ensure_csrf_cookie(wrapper)
+
+        view.ajax_batchable = True
+        return view
 
     return decorator
 
 
+def _stream_json(items, backend, encoder, ndjson):
+    """
+    Generator encoding items as a JSON array or NDJSON, in chunks of
+    up to ``STREAMING_CHUNK_SIZE`` bytes.
+    """
+    if isinstance(items, QuerySet):
+        items = items.iterator()
+
+    separator = b"\n" if ndjson else b","
+    chunk = []
+    chunk_size = 0
+    first = True
+
+    if not ndjson:
+        yield b"["
+
+    for item in items:
+        content = backend.dumps(item, encoder)
+        if ndjson:
+            chunk.append(content)
+            chunk.append(separator)
+        else:
+            if not first:
+                chunk.append(separator)
+            chunk.append(content)
+        chunk_size += len(content) + 1
+
+        # Send the first item immediately to minimize time to first byte
+        if first or chunk_size >= STREAMING_CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            chunk_size = 0
+        first = False
+
+    if not ndjson:
+        chunk.append(b"]")
+    if chunk:
+        yield b"".join(chunk)
+
+
+def _set_expires(response, expires_in):
+    if expires_in:
+        response["Expires"] = http_date(time.time() + expires_in)
+        response["Cache-Control"] = "private, max-age={}".format(expires_in)
+    return response
+
+
 class DjangoJSONEncoderWithEnum(DjangoJSONEncoder):
     """
     JSONEncoder subclass that knows how to encode date/time and decimal types, and enums.
@@ -116,6 +347,158 @@ class DjangoJSONEncoderWithEnum(DjangoJSONEncoder):
             return super().default(o)
 
 
+def ajax_batch_view(max_requests=50, max_workers=4, json_backend="json"):
+    """
+    Returns a view which executes a batch of Ajax sub-requests in a single
+    HTTP request, to avoid the overhead of running the middleware, session
+    loading, etc. for each of many small Ajax calls.
+
+    Sub-requests are resolved against the URL configuration, and may only target
+    views decorated with ``@ajax``. Each runs with a copy of the batch request,
+    so shares its user & session, and the view's own checks such as ``login_required``
+    still apply. Middleware is *not* run for sub-requests.
+
+    The request body is a JSON list of sub-requests, or an object with a
+    ``requests`` list and a ``parallel`` flag. If ``parallel`` is true and all
+    sub-requests are ``GET`` requests, they're executed concurrently in a thread
+    pool. Otherwise they're executed in order::
+
+        {
+            "parallel": true,
+            "requests": [
+                {"path": "/api/items/?page=2"},
+                {"path": "/api/item/5/", "method": "POST", "body": {"name": "New name"}}
+            ]
+        }
+
+    The response is a list of ``{"status": 200, "body": ...}`` results, in the same
+    order as the sub-requests. JSON response bodies are decoded, others are returned
+    as strings. Exceptions raised by a sub-request's view are converted to a 404, 403,
+    400 or 500 result as Django would, without affecting the other sub-requests.
+
+    Parallel sub-requests share the batch request's user and session between threads,
+    so their views must not modify the session.
+
+    :param int max_requests: The maximum number of sub-requests in a batch.
+    :param int max_workers: The maximum number of threads for parallel batches.
+    :param str json_backend: The JSON backend, see ``ajax()``.
+
+    Example usage::
+
+        path('api/batch/', ajax_batch_view()),
+    """
+    backend = get_json_backend(json_backend)
+
+    @ajax(["POST"], json_backend=json_backend)
+    def batch_view(request, jsondata=None):
+        parallel = False
+        items = jsondata
+        if isinstance(jsondata, dict):
+            items = jsondata.get("requests")
+            parallel = bool(jsondata.get("parallel"))
+
+        if not isinstance(items, list) or not all(
+            isinstance(item, dict) and isinstance(item.get("path"), str) for item in items
+        ):
+            raise AjaxBadRequest("A list of sub-requests with paths is required.")
+        if len(items) > max_requests:
+            raise AjaxBadRequest("A maximum of {} sub-requests is allowed.".format(max_requests))
+
+        if hasattr(request, "user"):
+            # Resolve the lazy user once, rather than per sub-request or thread
+            _ = request.user.is_authenticated
+        if parallel and hasattr(request, "session"):
+            # Likewise load the session data before it's shared between threads
+            _ = request.session.keys()
+
+        sub_requests = [_make_sub_request(request, item, backend) for item in items]
+
+        if parallel and len(items) > 1 and all(r.method == "GET" for r in sub_requests):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(
+                    executor.map(_run_threaded_sub_request, sub_requests, [backend] * len(items))
+                )
+
+        return [_run_sub_request(r, backend) for r in sub_requests]
+
+    batch_view.ajax_batchable = False
+    return batch_view
+
+
+def _make_sub_request(request, item, backend):
+    """
+    Creates a copy of ``request`` for a batch sub-request.
+    """
+    body = item.get("body")
+    body = b"" if body is None else backend.dumps(body, DjangoJSONEncoder)
+    path, _, query_string = item["path"].partition("?")
+
+    sub = copy.copy(request)
+    sub.method = str(item.get("method") or "GET").upper()
+    sub.path = sub.path_info = path
+    sub.META = dict(
+        request.META,
+        REQUEST_METHOD=sub.method,
+        PATH_INFO=path,
+        QUERY_STRING=query_string,
+        CONTENT_TYPE="application/json",
+        CONTENT_LENGTH=str(len(body)),
+    )
+    sub.GET = QueryDict(query_string)
+    sub.POST = QueryDict()
+    sub._files = MultiValueDict()  # pylint: disable=protected-access
+    sub._body = body  # pylint: disable=protected-access
+    return sub
+
+
+def _run_sub_request(sub, backend):
+    """
+    Executes a batch sub-request and returns its ``{"status", "body"}`` result.
+    """
+    try:
+        match = resolve(sub.path_info, urlconf=getattr(sub, "urlconf", None))
+    except Resolver404:
+        return {"status": 404, "body": "Not found."}
+
+    if not getattr(match.func, "ajax_batchable", False):
+        return {"status": 404, "body": "Not an ajax view."}
+
+    sub.resolver_match = match
+    try:
+        if asyncio.iscoroutinefunction(match.func):
+            response = async_to_sync(match.func)(sub, *match.args, **match.kwargs)
+        else:
+            response = match.func(sub, *match.args, **match.kwargs)
+    except Http404:
+        return {"status": 404, "body": "Not found."}
+    except PermissionDenied:
+        return {"status": 403, "body": "Permission denied."}
+    except (BadRequest, SuspiciousOperation):
+        return {"status": 400, "body": "Bad request."}
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Error in batch sub-request %s %s", sub.method, sub.path)
+        return {"status": 500, "body": "Server error."}
+
+    if response.streaming:
+        content = b"".join(response.streaming_content)
+    else:
+        content = response.content
+
+    if response.get("Content-Type", "").startswith("application/json"):
+        body = backend.loads(content) if content else None
+    else:
+        body = content.decode(response.charset)
+
+    return {"status": response.status_code, "body": body}
+
+
+def _run_threaded_sub_request(sub, backend):
+    try:
+        return _run_sub_request(sub, backend)
+    finally:
+        connections.close_all()
+
+
 def cors(origins):
     """
     Decorator to send CORS access control headers for the whitelisted origins specified.
@@ -123,13 +506,23 @@ def cors(origins):
     :param origins list: List of origins in the form: ``['https://othersite.com']``
     """
 
+    def add_headers(request, response):
+        if request.META.get("HTTP_ORIGIN") and request.META.get("HTTP_ORIGIN") in origins:
+            response["Access-Control-Allow-Origin"] = request.META["HTTP_ORIGIN"]
+        return response
+
     def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def async_wrapper(request, *args, **kwargs):
+                return add_headers(request, await fn(request, *args, **kwargs))
+
+            return async_wrapper
+
         @wraps(fn)
         def wrapper(request, *args, **kwargs):
-            response = fn(request, *args, **kwargs)
-            if request.META.get("HTTP_ORIGIN") and request.META.get("HTTP_ORIGIN") in origins:
-                response["Access-Control-Allow-Origin"] = request.META["HTTP_ORIGIN"]
-            return response
+            return add_headers(request, fn(request, *args, **kwargs))
 
         return wrapper
 
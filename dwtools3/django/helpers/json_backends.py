@@ -0,0 +1,163 @@
+"""
+Pluggable JSON encoding & decoding backends for Ajax views.
+
+The ``"json"`` backend uses the standard library and is the default.
+The ``"orjson"`` and ``"ujson"`` backends are considerably faster for large
+payloads, and are available if the respective package is installed.
+``"auto"`` selects ``orjson`` if installed, otherwise the standard library.
+
+Date/time, ``Decimal``, ``UUID`` and lazy string values are encoded via the
+given Django encoder class, so they're output the same as with the standard
+library. However the output of the faster backends is not byte-for-byte identical:
+
+    - No whitespace is output after ``,`` and ``:`` separators.
+    - ``ujson`` natively encodes ``Decimal`` values as floats, losing precision,
+      so the ``ujson`` backend first converts them with the encoder in an extra
+      pass over the data. This makes it slower than ``orjson``, and it isn't
+      selected by ``"auto"``.
+    - ``orjson`` outputs non-ASCII characters as UTF-8 rather than ``\\uXXXX``
+      escapes, and encodes ``NaN`` and ``Infinity`` as ``null``.
+    - ``orjson`` natively encodes ``Enum`` members as their value. As
+      ``DjangoJSONEncoderWithEnum`` (and ``EnumX``) encode enums using ``str()``,
+      the ``orjson`` backend falls back to the standard library when
+      ``DjangoJSONEncoderWithEnum`` (or a subclass) is the encoder.
+
+Usage::
+
+    backend = get_json_backend("auto")
+    content = backend.dumps(data, DjangoJSONEncoder)
+    data = backend.loads(request.body)
+"""
+from decimal import Decimal
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http.response import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class StdlibJSONBackend:
+    """
+    JSON backend using the standard library ``json`` module.
+    """
+
+    name = "json"
+
+    @staticmethod
+    def dumps(data, encoder):
+        return json.dumps(data, cls=encoder).encode("utf-8")
+
+    @staticmethod
+    def loads(content):
+        if isinstance(content, bytes):
+            content = content.decode("utf-8")
+        return json.loads(content)
+
+
+class OrjsonBackend:
+    """
+    JSON backend using the ``orjson`` package.
+    """
+
+    name = "orjson"
+
+    @staticmethod
+    def dumps(data, encoder):
+        # Imported here to avoid a circular import
+        from .ajax import DjangoJSONEncoderWithEnum  # pylint: disable=import-outside-toplevel
+
+        if issubclass(encoder, DjangoJSONEncoderWithEnum):
+            return StdlibJSONBackend.dumps(data, encoder)
+
+        return orjson.dumps(
+            data,
+            default=encoder().default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+        )
+
+    @staticmethod
+    def loads(content):
+        return orjson.loads(content)
+
+
+class UjsonBackend:
+    """
+    JSON backend using the ``ujson`` package.
+    """
+
+    name = "ujson"
+
+    @classmethod
+    def dumps(cls, data, encoder):
+        default = encoder().default
+        return ujson.dumps(
+            cls._encode_decimals(data, default), default=default, escape_forward_slashes=False
+        ).encode("utf-8")
+
+    @classmethod
+    def _encode_decimals(cls, data, default):
+        """
+        Returns the data with ``Decimal`` values encoded by ``default``, which
+        ujson would otherwise convert to floats.
+        """
+        if isinstance(data, Decimal):
+            return default(data)
+        if isinstance(data, dict):
+            return {k: cls._encode_decimals(v, default) for k, v in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [cls._encode_decimals(v, default) for v in data]
+        return data
+
+    @staticmethod
+    def loads(content):
+        return ujson.loads(content)
+
+
+JSON_BACKENDS = {
+    "json": StdlibJSONBackend,
+    "orjson": OrjsonBackend if orjson is not None else None,
+    "ujson": UjsonBackend if ujson is not None else None,
+}
+
+
+def get_json_backend(name="json"):
+    """
+    Returns the JSON backend with the given name: ``"json"``, ``"orjson"``,
+    ``"ujson"``, or ``"auto"`` for ``orjson`` if installed, otherwise ``"json"``.
+    """
+    if name == "auto":
+        return JSON_BACKENDS["orjson"] or StdlibJSONBackend
+
+    try:
+        backend = JSON_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown JSON backend: {}".format(name)) from None
+
+    if backend is None:
+        raise ImportError("The {} package is required for the {} JSON backend.".format(name, name))
+    return backend
+
+
+class FastJsonResponse(HttpResponse):
+    """
+    Equivalent of Django's ``JsonResponse`` using a pluggable JSON backend.
+    Unlike ``JsonResponse``, non-dict objects may always be serialized.
+
+    :param data: The data to encode.
+    :param encoder: The Django JSON encoder class for non-native types.
+    :param str json_backend: The JSON backend name, see ``get_json_backend()``.
+    """
+
+    def __init__(self, data, encoder=DjangoJSONEncoder, json_backend="auto", **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        content = get_json_backend(json_backend).dumps(data, encoder)
+        super().__init__(content=content, **kwargs)
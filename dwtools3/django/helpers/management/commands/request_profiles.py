@@ -0,0 +1,53 @@
+import io
+import os
+import pstats
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...middleware import get_profile_directory, list_request_profiles
+
+
+class Command(BaseCommand):
+    help = "List or render request profiles stored by ProfilerMiddleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "profile",
+            nargs="?",
+            help="Filename of the profile to render. Lists all profiles if omitted.",
+        )
+        parser.add_argument(
+            "--sort",
+            action="store",
+            dest="sort",
+            default="cumulative",
+            help="Sort order for rendering pstats profiles (eg. cumulative, tottime).",
+        )
+        parser.add_argument(
+            "--limit",
+            action="store",
+            type=int,
+            dest="limit",
+            default=40,
+            help="Maximum number of functions to render for pstats profiles.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["profile"]:
+            for filename in list_request_profiles():
+                self.stdout.write(filename)
+            return
+
+        filename = os.path.basename(options["profile"])
+        if filename not in list_request_profiles():
+            raise CommandError("Profile not found: {}".format(filename))
+
+        path = os.path.join(get_profile_directory(), filename)
+        if filename.endswith(".collapsed"):
+            with open(path, "r", encoding="utf-8") as f:
+                self.stdout.write(f.read(), ending="")
+        else:
+            stream = io.StringIO()
+            stats = pstats.Stats(path, stream=stream)
+            stats.sort_stats(options["sort"]).print_stats(options["limit"])
+            self.stdout.write(stream.getvalue())
@@ -1,9 +1,164 @@
+import asyncio
+import contextlib
+import contextvars
+import cProfile
 import functools
-from time import time
-import operator
-from django.db import connection
+import logging
+import marshal
+import os
+import random
+import re
+import tempfile
+import threading
+import traceback
+from datetime import datetime
+from time import perf_counter
 
+from asgiref.sync import markcoroutinefunction
+import django
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
 
+from ...http import verify_signed_url
+from ...system.profiler import StackSampler
+from .settings import SettingsProxy
+from .stats import fingerprint_sql, performance_stats, timed_db_execute
+from .timing import start_request_timings, stop_request_timings
+
+logger = logging.getLogger("dwtools3.django.helpers")
+
+
+class MiddlewareSettings(SettingsProxy):
+    """
+    Settings for the helpers middleware. Override these in your Django settings file.
+    """
+
+    PERFORMANCE_STATS_PRINT = True
+    """
+    Whether ``PerformanceStatsMiddleware`` prints the stats of each request to the shell.
+    """
+
+    PERFORMANCE_STATS_HISTOGRAMS = False
+    """
+    Whether ``PerformanceStatsMiddleware`` aggregates per-view latency,
+    database time and query counts into in-process histograms. These are
+    available from ``dwtools3.django.helpers.stats.performance_stats``
+    or the ``performance_stats_view`` view.
+    """
+
+    PERFORMANCE_STATS_NPLUSONE_THRESHOLD = None
+    """
+    If set, ``PerformanceStatsMiddleware`` reports N+1 query patterns when the
+    same SQL fingerprint is executed at least this many times in a single request.
+    """
+
+    PERFORMANCE_STATS_NPLUSONE_MODE = "log"
+    """
+    How N+1 query patterns are reported: ``"log"`` logs a warning to the
+    ``dwtools3.django.helpers`` logger, ``"raise"`` raises ``NPlusOneQueriesDetected``
+    (useful in tests) and ``"header"`` adds an ``X-NPlusOne-Queries`` response header.
+    """
+
+    PROFILER_SAMPLE_RATE = 0.0
+    """
+    The fraction of requests (0.0 - 1.0) profiled by ``ProfilerMiddleware``.
+    """
+
+    PROFILER_QUERY_PARAM = "_profile"
+    """
+    Requests to a URL including this GET parameter, signed with
+    ``dwtools3.http.sign_url()``, are always profiled by ``ProfilerMiddleware``.
+    """
+
+    PROFILER_SIGNING_SALT = None
+    """
+    The salt used to verify signed profiling URLs. Defaults to the
+    ``sign_url()`` default salt, so set this to a secret value in production.
+    """
+
+    PROFILER_FORMAT = "pstats"
+    """
+    ``"pstats"`` profiles requests with ``cProfile`` and stores ``pstats`` dumps.
+    ``"collapsed"`` samples the request thread's stack and stores collapsed stacks
+    for rendering flamegraphs, with much lower overhead.
+    """
+
+    PROFILER_SAMPLE_INTERVAL = 0.005
+    """
+    The stack sampling interval in seconds for the ``"collapsed"`` format.
+    """
+
+    PROFILER_DIRECTORY = None
+    """
+    The directory to store profiles in. Defaults to ``dwtools3-profiles``
+    in the system temp directory.
+    """
+
+    PROFILER_MAX_PROFILES = 100
+    """
+    The maximum number of profiles to keep. The oldest are deleted first.
+    """
+
+    SERVER_TIMING_ENABLED = True
+    """
+    Whether ``ServerTimingMiddleware`` adds ``Server-Timing`` headers to responses.
+    """
+
+
+class NPlusOneQueriesDetected(Exception):
+    """
+    Raised by ``PerformanceStatsMiddleware`` when ``PERFORMANCE_STATS_NPLUSONE_MODE``
+    is ``"raise"`` and N+1 query patterns are detected.
+    """
+
+
+@contextlib.contextmanager
+def _all_connections_execute_wrapper(wrapper):
+    """
+    Installs a database execute wrapper on all connections.
+    """
+    with contextlib.ExitStack() as stack:
+        for conn in connections.all():
+            stack.enter_context(conn.execute_wrapper(wrapper))
+        yield
+
+
+def _install_execute_wrapper(wrapper):
+    """
+    Permanently installs a database execute wrapper on all connections of
+    all threads: those of the current thread now, and others as they connect.
+    Unlike ``connection.execute_wrapper()``, this needs no per-request calls in
+    the thread running the queries, and is safe to interleave with other
+    requests served by the same thread under ASGI.
+    """
+
+    def install(connection, **kwargs):
+        # pylint: disable=unused-argument
+        if wrapper not in connection.execute_wrappers:
+            # Insert first, as connection.execute_wrapper() pops the last wrapper
+            connection.execute_wrappers.insert(0, wrapper)
+
+    for conn in connections.all():
+        install(conn)
+    connection_created.connect(install, weak=False, dispatch_uid=(__name__, wrapper))
+
+
+_IGNORED_STACK_PATHS = (os.path.dirname(django.__file__), os.path.dirname(__file__))
+
+
+def _get_stack_snippet(limit=3):
+    """
+    Returns the innermost stack frames outside of Django and this module,
+    formatted as ``file:line in function``.
+    """
+    frames = [
+        f for f in traceback.extract_stack() if not f.filename.startswith(_IGNORED_STACK_PATHS)
+    ]
+    return ["{}:{} in {}".format(f.filename, f.lineno, f.name) for f in frames[-limit:]]
+
+
+@sync_and_async_middleware
 def TranslateProxyRemoteAddrMiddleware(get_response):  # pylint: disable=invalid-name
     """
     Proxy servers (eg. nginx -> gunicorn) tend to override
@@ -21,7 +176,7 @@ def TranslateProxyRemoteAddrMiddleware(get_response):  # pylint: disable=invalid
         ]
     """
 
-    def middleware(request):
+    def translate(request):
         if "HTTP_X_FORWARDED_FOR" in request.META:
             fwd_ip = ""
             for ip in request.META["HTTP_X_FORWARDED_FOR"].split(","):
@@ -31,6 +186,16 @@ def TranslateProxyRemoteAddrMiddleware(get_response):  # pylint: disable=invalid
                     break
             request.META["REMOTE_ADDR"] = fwd_ip
 
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def async_middleware(request):
+            translate(request)
+            return await get_response(request)
+
+        return async_middleware
+
+    def middleware(request):
+        translate(request)
         return get_response(request)
 
     return middleware
@@ -38,8 +203,15 @@ def TranslateProxyRemoteAddrMiddleware(get_response):  # pylint: disable=invalid
 
 class PerformanceStatsMiddleware:
     """
-    Middleware class for printing out performance stats of each
-    request to the shell and browser console.
+    Middleware class for measuring the performance stats of each request.
+
+    Database time and query counts are measured with a database execute
+    wrapper, so don't depend on ``DEBUG`` being enabled.
+
+    By default stats are printed to the shell. For production use, set
+    ``PERFORMANCE_STATS_PRINT = False`` and ``PERFORMANCE_STATS_HISTOGRAMS = True``
+    to aggregate per-view histograms in-process instead, and expose them with
+    ``dwtools3.django.helpers.views.performance_stats_view``.
 
     Place this first in your middleware classes::
 
@@ -49,40 +221,146 @@ class PerformanceStatsMiddleware:
 
     If you have "debug only" middleware that shouldn't be measured, place it
     before ``PerformanceStatsMiddleware``.
+
+    To detect N+1 query patterns, set ``PERFORMANCE_STATS_NPLUSONE_THRESHOLD``.
+    Queries are fingerprinted by normalizing their literal values, and any
+    fingerprint repeated at least the threshold number of times within a request
+    is reported according to ``PERFORMANCE_STATS_NPLUSONE_MODE``, along with
+    a stack snippet showing where the queries originate.
+
+    Supports both WSGI and ASGI. Under ASGI, queries from async views are
+    measured when run through ``sync_to_async()``, and are attributed to the
+    correct request even when multiple requests share the sync thread. The
+    execute wrapper is installed once on each connection and finds the request's
+    stats in a context variable, so there's no per-request switching to the sync
+    thread to install it. Requires asgiref 3.6+.
     """
 
     STATS_KEY = "_performancestatsmiddleware"
+    sync_capable = True
+    async_capable = True
+
+    _current_stats = contextvars.ContextVar("dwtools3_performance_stats", default=None)
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self._is_async = asyncio.iscoroutinefunction(get_response)
+        if self._is_async:
+            markcoroutinefunction(self)
+            # An async process_view() isn't run in the sync thread by Django
+            self.process_view = self._aprocess_view
+        _install_execute_wrapper(self._db_execute_wrapper)
+
+    @classmethod
+    def _db_execute_wrapper(cls, execute, sql, params, many, context):
+        stats = cls._current_stats.get()
+        if stats is None:
+            # Not run within a request
+            return execute(sql, params, many, context)
+
+        try:
+            return timed_db_execute(stats, execute, sql, params, many, context)
+        finally:
+            threshold = MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_THRESHOLD
+            if threshold:
+                fingerprint = fingerprint_sql(sql)
+                counts = stats["fingerprints"]
+                counts[fingerprint] = counts.get(fingerprint, 0) + 1
+                if counts[fingerprint] == threshold:
+                    stats["fingerprint_stacks"][fingerprint] = _get_stack_snippet()
 
     def __call__(self, request):
-        setattr(
-            request,
-            self.STATS_KEY,
-            {
-                "start": time(),
-                "view_start": None,
-            },
-        )
+        if self._is_async:
+            return self.__acall__(request)
+
+        stats = self._start_request(request)
+        token = self._current_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            self._current_stats.reset(token)
+
+        return self._finish_request(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = self._start_request(request)
+        token = self._current_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self._current_stats.reset(token)
+
+        return self._finish_request(request, response, stats)
 
-        response = self.get_response(request)
+    def _start_request(self, request):
+        stats = {
+            "start": perf_counter(),
+            "view_start": None,
+            "db_queries": 0,
+            "db_time": 0.0,
+            "fingerprints": {},
+            "fingerprint_stacks": {},
+        }
+        setattr(request, self.STATS_KEY, stats)
+        return stats
 
-        stats = getattr(request, self.STATS_KEY, None)
+    def _finish_request(self, request, response, stats):
         if (
-            stats is None
-            or not stats["view_start"]
+            not stats["view_start"]
             or not request.resolver_match
             or request.resolver_match.view_name == "django.views.static.serve"
         ):
             return response
 
-        stats["end"] = time()
+        stats["end"] = perf_counter()
         stats["total_time"] = stats["end"] - stats["start"]
-        stats["db_queries"] = len(connection.queries)
-        stats["db_time"] = functools.reduce(
-            operator.add, (float(q["time"]) for q in connection.queries), 0.0
+
+        if MiddlewareSettings.PERFORMANCE_STATS_HISTOGRAMS:
+            performance_stats.record(
+                request.resolver_match.view_name,
+                stats["total_time"],
+                stats["db_time"],
+                stats["db_queries"],
+            )
+
+        if MiddlewareSettings.PERFORMANCE_STATS_PRINT:
+            self.print_stats(stats)
+
+        if stats["fingerprint_stacks"]:
+            self.report_nplusone(request, response, stats)
+
+        return response
+
+    @staticmethod
+    def report_nplusone(request, response, stats):
+        view_name = request.resolver_match.view_name
+        repeated = sorted(
+            (
+                (stats["fingerprints"][f], f, stack)
+                for f, stack in stats["fingerprint_stacks"].items()
+            ),
+            reverse=True,
         )
+
+        mode = MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_MODE
+        if mode == "header":
+            response["X-NPlusOne-Queries"] = "; ".join(
+                "{}x {}".format(count, fingerprint[:200]) for count, fingerprint, _ in repeated
+            )
+            return
+
+        message = "\n\n".join(
+            "N+1 queries in view {}: {} repeats of:\n    {}\n  from:\n    {}".format(
+                view_name, count, fingerprint, "\n    ".join(stack)
+            )
+            for count, fingerprint, stack in repeated
+        )
+        if mode == "raise":
+            raise NPlusOneQueriesDetected(message)
+        logger.warning(message)
+
+    @staticmethod
+    def print_stats(stats):
         stats["python_time"] = stats["total_time"] - stats["db_time"]
 
         stats["middleware_total_time"] = stats["view_start"] - stats["start"]
@@ -127,14 +405,224 @@ class PerformanceStatsMiddleware:
 
         print("")
         print(formatted)
-        return response
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         # pylint: disable=unused-argument
         stats = getattr(request, self.STATS_KEY)
-        stats["view_start"] = time()
-        stats["middleware_db_queries"] = len(connection.queries)
-        stats["middleware_db_time"] = functools.reduce(
-            operator.add, (float(q["time"]) for q in connection.queries), 0.0
-        )
+        stats["view_start"] = perf_counter()
+        stats["middleware_db_queries"] = stats["db_queries"]
+        stats["middleware_db_time"] = stats["db_time"]
+        return None
+
+    async def _aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return type(self).process_view(self, request, view_func, view_args, view_kwargs)
+
+
+PROFILE_EXTENSIONS = {"pstats": ".prof", "collapsed": ".collapsed"}
+_profile_lock = threading.Lock()
+
+
+def get_profile_directory():
+    """
+    Returns the directory ``ProfilerMiddleware`` stores profiles in.
+    """
+    return MiddlewareSettings.PROFILER_DIRECTORY or os.path.join(
+        tempfile.gettempdir(), "dwtools3-profiles"
+    )
+
+
+def list_request_profiles():
+    """
+    Returns the filenames of stored request profiles, oldest first.
+    """
+    try:
+        filenames = os.listdir(get_profile_directory())
+    except FileNotFoundError:
+        return []
+    return sorted(f for f in filenames if f.endswith(tuple(PROFILE_EXTENSIONS.values())))
+
+
+def save_request_profile(request, data, profile_format):
+    """
+    Saves profile data for a request, deleting the oldest profiles
+    beyond ``PROFILER_MAX_PROFILES``. Returns the saved filename.
+    """
+    directory = get_profile_directory()
+    os.makedirs(directory, exist_ok=True)
+
+    filename = "{}-{}-{}{}".format(
+        datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+        os.getpid(),
+        re.sub(r"\W+", "_", request.path).strip("_")[:60] or "root",
+        PROFILE_EXTENSIONS[profile_format],
+    )
+
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+        f.write(data)
+    os.replace(f.name, os.path.join(directory, filename))
+
+    with _profile_lock:
+        profiles = list_request_profiles()
+        for old in profiles[: max(0, len(profiles) - MiddlewareSettings.PROFILER_MAX_PROFILES)]:
+            try:
+                os.unlink(os.path.join(directory, old))
+            except FileNotFoundError:
+                pass
+
+    return filename
+
+
+class ProfilerMiddleware:
+    """
+    Middleware class for profiling a sample of requests in production, storing
+    the results in a bounded on-disk ring buffer. Use the ``request_profiles``
+    management command to list and render the stored profiles.
+
+    Requests are profiled at random with a probability of ``PROFILER_SAMPLE_RATE``,
+    or on demand by requesting a URL signed with ``dwtools3.http.sign_url()``
+    including the ``PROFILER_QUERY_PARAM`` GET parameter::
+
+        sign_url('/my/slow/page/?_profile=1', expiry_secs=3600, salt=PROFILER_SIGNING_SALT)
+
+    Place this first in your middleware classes::
+
+        MIDDLEWARE = [
+            'dwtools3.django.helpers.middleware.ProfilerMiddleware',
+        ] + MIDDLEWARE
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def should_profile(self, request):
+        sample_rate = MiddlewareSettings.PROFILER_SAMPLE_RATE
+        if sample_rate and random.random() < sample_rate:
+            return True
+
+        if MiddlewareSettings.PROFILER_QUERY_PARAM in request.GET:
+            return bool(
+                verify_signed_url(
+                    request.get_full_path(), salt=MiddlewareSettings.PROFILER_SIGNING_SALT
+                )
+            )
+
+        return False
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profile_format = MiddlewareSettings.PROFILER_FORMAT
+        if profile_format == "collapsed":
+            sampler = StackSampler(interval=MiddlewareSettings.PROFILER_SAMPLE_INTERVAL)
+            sampler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+            data = sampler.collapsed().encode("utf-8")
+        else:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already active in this process
+                return self.get_response(request)
+            try:
+                response = self.get_response(request)
+            finally:
+                profile.disable()
+            profile.create_stats()
+            data = marshal.dumps(profile.stats)
+
+        try:
+            save_request_profile(request, data, profile_format)
+        except OSError:
+            logger.exception("Failed to save request profile.")
+
+        return response
+
+
+class ServerTimingMiddleware:
+    """
+    Middleware class for adding a ``Server-Timing`` header to responses, to
+    view a breakdown of backend timings in the browser devtools.
+
+    Reports ``total``, ``middleware``, ``view``, ``db`` and ``template``
+    durations, as well as any custom spans added with
+    ``dwtools3.django.helpers.timing.timing_span()``.
+
+    The ``template`` span only covers the deferred rendering of
+    ``TemplateResponse`` objects. Templates rendered inside the view, eg. with
+    ``render()`` or ``render_to_string()``, are included in the ``view`` span
+    instead; wrap them in a ``timing_span()`` to report them separately.
+
+    Place this first in your middleware classes::
+
+        MIDDLEWARE = [
+            'dwtools3.django.helpers.middleware.ServerTimingMiddleware',
+        ] + MIDDLEWARE
+    """
+
+    TIMING_KEY = "_servertimingmiddleware"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not MiddlewareSettings.SERVER_TIMING_ENABLED:
+            return self.get_response(request)
+
+        stats = {
+            "start": perf_counter(),
+            "view_start": None,
+            "template_time": None,
+            "db_queries": 0,
+            "db_time": 0.0,
+        }
+        setattr(request, self.TIMING_KEY, stats)
+
+        token = start_request_timings()
+        try:
+            wrapper = functools.partial(timed_db_execute, stats)
+            with _all_connections_execute_wrapper(wrapper):
+                response = self.get_response(request)
+        finally:
+            timings = stop_request_timings(token)
+
+        end = perf_counter()
+        spans = [("total", end - stats["start"], None)]
+        if stats["view_start"] is not None:
+            spans.append(("middleware", stats["view_start"] - stats["start"], None))
+            spans.append(("view", end - stats["view_start"], None))
+        spans.append(("db", stats["db_time"], "{} queries".format(stats["db_queries"])))
+        if stats["template_time"] is not None:
+            spans.append(("template", stats["template_time"], None))
+
+        timings.spans[:0] = spans
+        response["Server-Timing"] = timings.as_header()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # pylint: disable=unused-argument
+        stats = getattr(request, self.TIMING_KEY, None)
+        if stats is not None:
+            stats["view_start"] = perf_counter()
         return None
+
+    def process_template_response(self, request, response):
+        stats = getattr(request, self.TIMING_KEY, None)
+        if stats is None:
+            return response
+
+        render = response.render
+
+        def timed_render():
+            start = perf_counter()
+            try:
+                return render()
+            finally:
+                stats["template_time"] = (stats["template_time"] or 0.0) + perf_counter() - start
+
+        response.render = timed_render
+        return response
@@ -17,8 +17,75 @@ Usage
 
     with sql.execute() as cursor:
         return cursor.fetchall()
+
+For large result sets, stream the rows in batches rather than
+fetching them all into memory. On PostgreSQL this uses a named
+server-side cursor, on other backends ``fetchmany()`` batches::
+
+    with sql.stream(batch_size=5000, row_format="dict") as rows:
+        for row in rows:
+            process(row)
+
+Hot queries with a fixed shape can be declared once as a ``RawSQLTemplate``.
+The joined SQL text is cached for each combination of conditional fragments,
+and on PostgreSQL the query may optionally be run as a server-side prepared
+statement (``PREPARE``/``EXECUTE``), which is planned once per connection::
+
+    REPORT_SQL = RawSQLTemplate(prepare=True)
+    REPORT_SQL.add('''
+        SELECT *
+          FROM my_table
+         WHERE 1=1
+    ''')
+    REPORT_SQL.add_if("type", '''
+           AND type=%s
+    ''')
+
+    sql = REPORT_SQL.builder()
+    sql.add_if(type, "type", [type])
+
+    with sql.execute() as cursor:
+        return cursor.fetchall()
+
+Expensive queries can have their results cached in the Django cache,
+keyed on the final SQL and params. Tags (such as table names) allow
+invalidating all cached results that depend on them::
+
+    result = sql.cached(ttl=300, tags=["my_table"])
+    for row in result.dicts():
+        ...
+
+    # After updating my_table
+    invalidate_sql_cache_tags("my_table")
+
+Large numbers of rows (eg. from ``ExcelReader`` or a CSV file) can be loaded
+into a table with ``RawSQLBulkLoader``. On PostgreSQL rows are streamed via
+``COPY FROM STDIN``, other backends use batched ``executemany()`` inserts::
+
+    loader = RawSQLBulkLoader("my_table", ["id", "name", "created_at"])
+    loader.load(row_generator)
+
+    # Insert new rows and update existing ones, matched on "id"
+    loader.upsert(row_generator, key_columns=["id"])
 """
-from django.db import connections, connection as django_default_connection
+from collections import namedtuple
+import datetime
+import decimal
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+import weakref
+
+from django.core.cache import caches
+from django.db import connections, connection as django_default_connection, transaction
+
+
+ROW_FORMATS = ("tuple", "namedtuple", "dict")
+SQL_CACHE_KEY_PREFIX = "dwtools3:sql:"
 
 
 class RawSQLBuilder:
@@ -58,6 +125,67 @@ class RawSQLBuilder:
         cursor.execute(*self.get_sql())
         return cursor
 
+    def stream(self, batch_size=2000, row_format="tuple"):
+        """
+        Returns a ``RawSQLStream`` for iterating over the results in batches
+        of ``batch_size`` rows, without loading the entire result into memory.
+
+        :param int batch_size: Number of rows to fetch from the database at a time.
+        :param str row_format: One of ``"tuple"``, ``"namedtuple"`` or ``"dict"``.
+        """
+        sql, params = self.get_sql()
+        return RawSQLStream(self._connection, sql, params, batch_size, row_format)
+
+    def cached(self, ttl, tags=None, cache_alias="default", lock_timeout=30):
+        """
+        Executes the query and returns the result as a ``CachedSQLResult``,
+        using the Django cache to store results for ``ttl`` seconds.
+
+        Concurrent callers requesting the same uncached query wait for
+        the first caller to populate the cache, rather than running the
+        query themselves.
+
+        :param int ttl: Number of seconds to cache the result for.
+        :param list tags: Tags (eg. table names) to use with
+            ``invalidate_sql_cache_tags()`` to invalidate the cached result.
+        :param str cache_alias: The Django cache to use.
+        :param int lock_timeout: Maximum number of seconds to wait for
+            another caller to populate the cache.
+        """
+        cache = caches[cache_alias]
+        sql, params = self.get_sql()
+        tags = sorted(tags or ())
+        key = _get_sql_cache_key(cache, self._connection.alias, sql, params, tags)
+
+        value = cache.get(key)
+        if value is not None:
+            return CachedSQLResult(*value)
+
+        lock_key = key + ":lock"
+        token = uuid.uuid4().hex
+        acquired = cache.add(lock_key, token, lock_timeout)
+        if not acquired:
+            deadline = time.monotonic() + lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = cache.get(key)
+                if value is not None:
+                    return CachedSQLResult(*value)
+                if cache.get(lock_key) is None:
+                    acquired = cache.add(lock_key, token, lock_timeout)
+                    break
+
+        try:
+            with self.execute() as cursor:
+                value = (tuple(self.columns(cursor)), [tuple(row) for row in cursor.fetchall()])
+            cache.set(key, value, ttl)
+        finally:
+            # Only release the lock if we still hold it, never another caller's
+            if acquired and cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+        return CachedSQLResult(*value)
+
     @staticmethod
     def columns(cursor):
         desc = cursor.description
@@ -65,10 +193,507 @@ class RawSQLBuilder:
 
     @staticmethod
     def dictfetchall(cursor):
-        desc = cursor.description
-        return [dict(zip([col[0] for col in desc], row)) for row in cursor.fetchall()]
+        columns = RawSQLBuilder.columns(cursor)
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
     @staticmethod
     def dictfetchalliter(cursor):
-        desc = cursor.description
-        return (dict(zip([col[0] for col in desc], row)) for row in cursor)
+        columns = RawSQLBuilder.columns(cursor)
+        return (dict(zip(columns, row)) for row in cursor)
+
+
+class CachedSQLResult(namedtuple("CachedSQLResult", ["columns", "rows"])):
+    """
+    Query result returned by ``RawSQLBuilder.cached()``, as a tuple of
+    column names and a list of row tuples.
+    """
+
+    __slots__ = ()
+
+    def dicts(self):
+        """
+        Returns the rows as a list of dicts.
+        """
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+
+def invalidate_sql_cache_tags(*tags, cache_alias="default"):
+    """
+    Invalidates all results cached by ``RawSQLBuilder.cached()`` with any of the given tags.
+    """
+    cache = caches[cache_alias]
+    cache.set_many(
+        {SQL_CACHE_KEY_PREFIX + "tag:" + tag: uuid.uuid4().hex for tag in tags}, timeout=None
+    )
+
+
+def _get_sql_cache_key(cache, alias, sql, params, tags):
+    """
+    Returns the cache key for a query, including the current version of each of its tags.
+    If a new tag version can't be stored, eg. with a dummy cache or after eviction,
+    the freshly generated version is used, so the result won't be found again.
+    """
+    tag_keys = [SQL_CACHE_KEY_PREFIX + "tag:" + tag for tag in tags]
+    versions = cache.get_many(tag_keys)
+    missing = {k: uuid.uuid4().hex for k in tag_keys if k not in versions}
+    if missing:
+        for k, version in missing.items():
+            cache.add(k, version, timeout=None)
+        missing.update(cache.get_many(list(missing)))
+        versions.update(missing)
+
+    h = hashlib.sha256()
+    for part in (alias, sql, repr(params)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    for k in tag_keys:
+        h.update(versions[k].encode("utf-8"))
+    return SQL_CACHE_KEY_PREFIX + h.hexdigest()
+
+
+class RawSQLStream:
+    """
+    Iterable context manager returned by ``RawSQLBuilder.stream()``.
+
+    The query is executed when entering the context (or on first iteration),
+    and the cursor is closed on exit, or once all rows have been consumed.
+    """
+
+    def __init__(self, connection, sql, params, batch_size, row_format):
+        assert row_format in ROW_FORMATS, "row_format must be one of {}".format(ROW_FORMATS)
+        assert batch_size > 0, "batch_size must be positive"
+        self._connection = connection
+        self._sql = sql
+        self._params = params
+        self._batch_size = batch_size
+        self._row_format = row_format
+        self._cursor = None
+        self._rows = None
+        self.columns = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        if self._cursor is None:
+            self.open()
+
+        try:
+            convert = self._get_row_converter()
+            cursor = self._cursor
+            rows, self._rows = self._rows, None
+            while rows:
+                if convert is None:
+                    yield from rows
+                else:
+                    yield from map(convert, rows)
+                rows = cursor.fetchmany(self._batch_size)
+        finally:
+            self.close()
+
+    def open(self):
+        """
+        Executes the query on a new cursor and fetches the first batch of rows.
+        Uses a named server-side cursor on backends that support it, unless
+        ``DISABLE_SERVER_SIDE_CURSORS`` is set for the connection.
+        """
+        assert self._cursor is None, "RawSQLStream is already open."
+        if self._connection.settings_dict.get("DISABLE_SERVER_SIDE_CURSORS"):
+            cursor = self._connection.cursor()
+        else:
+            cursor = self._connection.chunked_cursor()
+
+        try:
+            cursor.execute(self._sql, self._params)
+            # Named cursors (eg. psycopg2) have no description until the first fetch
+            self._rows = cursor.fetchmany(self._batch_size)
+            self.columns = RawSQLBuilder.columns(cursor)
+        except Exception:
+            cursor.close()
+            raise
+
+        self._cursor = cursor
+
+    def close(self):
+        """
+        Closes the underlying cursor. Safe to call multiple times.
+        """
+        self._rows = None
+        if self._cursor is not None:
+            cursor, self._cursor = self._cursor, None
+            cursor.close()
+
+    def _get_row_converter(self):
+        if self._row_format == "dict":
+            columns = self.columns
+            return lambda row: dict(zip(columns, row))
+        elif self._row_format == "namedtuple":
+            return namedtuple("Row", self.columns, rename=True)._make
+        else:
+            return None
+
+
+class RawSQLTemplate:
+    """
+    A fixed set of SQL fragments, declared once (eg. at module level) and
+    used to create ``RawSQLTemplateBuilder`` instances per query.
+
+    Fragments added with ``add()`` are always included. Fragments added
+    with ``add_if()`` are identified by a key, and only included if the
+    builder enables that key. The joined SQL text for each combination
+    of enabled keys is computed once and cached.
+
+    :param bool prepare: If True, ``execute()`` runs the query as a server-side
+        prepared statement on PostgreSQL connections. Prepared statements
+        are tied to the database session, so don't use this behind a
+        transaction-pooling connection pooler such as pgbouncer.
+    """
+
+    def __init__(self, prepare=False):
+        self.prepare = prepare
+        self._fragments = []
+        self._keys = {}
+        self._sql_cache = {}
+
+    def add(self, sql, key=None):
+        """
+        Adds a fragment that's always included in the query. The ``key`` is
+        only required if the fragment takes params.
+        """
+        self._add_fragment(key, sql, False)
+
+    def add_if(self, key, sql):
+        """
+        Adds a fragment that's only included if enabled on the builder by ``key``.
+        """
+        assert key is not None, "Conditional SQL fragments require a key."
+        self._add_fragment(key, sql, True)
+
+    def _add_fragment(self, key, sql, conditional):
+        if key is not None:
+            assert key not in self._keys, "Duplicate SQL fragment key: {}".format(key)
+            self._keys[key] = len(self._fragments)
+        self._fragments.append((sql, conditional))
+
+    def builder(self, connection=None):
+        """
+        Returns a new ``RawSQLTemplateBuilder`` for this template.
+        """
+        return RawSQLTemplateBuilder(self, connection)
+
+    def get_sql_text(self, enabled):
+        """
+        Returns the joined SQL text for the given set of enabled fragment indexes.
+        """
+        cache_key = frozenset(enabled)
+        try:
+            return self._sql_cache[cache_key]
+        except KeyError:
+            pass
+
+        sql = "\n".join(
+            sql
+            for i, (sql, conditional) in enumerate(self._fragments)
+            if not conditional or i in cache_key
+        )
+        self._sql_cache[cache_key] = sql
+        return sql
+
+
+class RawSQLTemplateBuilder(RawSQLBuilder):
+    """
+    Builds a query from a ``RawSQLTemplate``. Works the same as ``RawSQLBuilder``
+    except ``add()`` and ``add_if()`` take a fragment key rather than SQL text.
+
+    Params are ordered by the fragment order in the template, rather than
+    the order of calls to ``add()``.
+    """
+
+    def __init__(self, template, connection=None):
+        super().__init__(connection)
+        self._template = template
+        self._enabled = {}
+
+    def add(self, key, params=None):
+        self.add_if(True, key, params)
+
+    def add_if(self, condition_expr, key, params=None):
+        if condition_expr:
+            try:
+                idx = self._template._keys[key]
+            except KeyError:
+                raise KeyError("SQL fragment key not found in template: {}".format(key)) from None
+            self._enabled[idx] = params
+
+    def get_sql(self):
+        sql = self._template.get_sql_text(self._enabled)
+
+        self._params = None
+        for idx in sorted(self._enabled):
+            params = self._enabled[idx]
+            if self._params is None and isinstance(params, (list, tuple)):
+                params = list(params)
+            elif self._params is None and isinstance(params, dict):
+                params = dict(params)
+            self._add_params(params)
+
+        return (sql, self._params)
+
+    def execute(self):
+        if not self._template.prepare or self._connection.vendor != "postgresql":
+            return super().execute()
+
+        sql, params = self.get_sql()
+        cursor = self._connection.cursor()
+        try:
+            name, params = _prepare_statement(self._connection, cursor, sql, params)
+            if params:
+                placeholders = ", ".join(["%s"] * len(params))
+                cursor.execute("EXECUTE {}({})".format(name, placeholders), params)
+            else:
+                cursor.execute("EXECUTE {}".format(name))
+        except Exception:
+            cursor.close()
+            raise
+        return cursor
+
+
+_PARAM_PLACEHOLDER_RE = re.compile(r"%(?:\((\w+)\))?s|%%")
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+
+
+def _convert_to_numbered_placeholders(sql, params):
+    """
+    Converts a query using ``%s`` or ``%(name)s`` placeholders to ``$1, $2, ...``
+    placeholders for ``PREPARE``, and returns the params as a matching list.
+    """
+    names = []
+
+    def replace(m):
+        if m.group(0) == "%%":
+            return "%"
+        if m.group(1) is None:
+            names.append(len(names))
+            return "${}".format(len(names))
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return "${}".format(names.index(m.group(1)) + 1)
+
+    sql = _PARAM_PLACEHOLDER_RE.sub(replace, sql)
+    if isinstance(params, dict):
+        params = [params[name] for name in names]
+    return sql, list(params or ())
+
+
+def _prepare_statement(connection, cursor, sql, params):
+    """
+    Prepares the statement on the current database session if not already
+    prepared, and returns its name and the params as a list.
+    """
+    connection.ensure_connection()
+    prepared_sql, params = _convert_to_numbered_placeholders(sql, params)
+    name = "dwt_" + hashlib.sha1(prepared_sql.encode("utf-8")).hexdigest()[:20]
+
+    with _prepared_statements_lock:
+        prepared = _prepared_statements.setdefault(connection.connection, set())
+        is_prepared = name in prepared
+
+    if not is_prepared:
+        cursor.execute("PREPARE {} AS {}".format(name, prepared_sql))
+        with _prepared_statements_lock:
+            prepared.add(name)
+
+    return name, params
+
+
+class RawSQLBulkLoader:
+    """
+    Loads rows into an existing table in bulk. Rows may be any iterable
+    (including generators) of sequences, with values in the order of ``columns``.
+
+    On PostgreSQL rows are streamed to the server with ``COPY FROM STDIN``
+    in batches of ``batch_size``. Other backends use ``executemany()``
+    with a batch of rows at a time.
+
+    Upserts on PostgreSQL copy rows into a temporary staging table, then merge
+    them with ``INSERT ... ON CONFLICT``. SQLite and MySQL use
+    ``INSERT ... ON CONFLICT`` and ``INSERT ... ON DUPLICATE KEY UPDATE``
+    respectively.
+
+    :param str table: The name of the table to load into.
+    :param list columns: The names of the columns being loaded.
+    :param connection: A Django connection or connection alias.
+    :param int batch_size: The number of rows to send per batch.
+    """
+
+    def __init__(self, table, columns, connection=None, batch_size=5000):
+        if isinstance(connection, str):
+            connection = connections[connection]
+        assert columns, "At least one column is required."
+        assert batch_size > 0, "batch_size must be positive"
+        self._connection = connection or django_default_connection
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size
+
+    def _quote(self, name):
+        return self._connection.ops.quote_name(name)
+
+    def _column_list(self):
+        return ", ".join(self._quote(c) for c in self.columns)
+
+    def _batches(self, rows):
+        it = iter(rows)
+        while True:
+            batch = list(itertools.islice(it, self.batch_size))
+            if not batch:
+                break
+            yield batch
+
+    def load(self, rows):
+        """
+        Inserts all the rows into the table. Returns the number of rows loaded.
+        """
+        if self._connection.vendor == "postgresql":
+            with transaction.atomic(using=self._connection.alias):
+                with self._connection.cursor() as cursor:
+                    return self._copy(cursor, self.table, rows)
+
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            self._quote(self.table), self._column_list(), ", ".join(["%s"] * len(self.columns))
+        )
+        return self._executemany(sql, rows)
+
+    def upsert(self, rows, key_columns, update_columns=None):
+        """
+        Inserts the rows into the table, updating existing rows that conflict on
+        ``key_columns`` (which must have a unique constraint). Returns the number
+        of rows processed.
+
+        :param list key_columns: The columns identifying existing rows.
+        :param list update_columns: The columns to update on existing rows.
+            Defaults to all non-key columns.
+        """
+        assert key_columns, "At least one key column is required."
+        if update_columns is None:
+            update_columns = [c for c in self.columns if c not in key_columns]
+
+        vendor = self._connection.vendor
+        if vendor == "mysql":
+            if update_columns:
+                conflict = " ON DUPLICATE KEY UPDATE " + ", ".join(
+                    "{0}=VALUES({0})".format(self._quote(c)) for c in update_columns
+                )
+            else:
+                conflict = " ON DUPLICATE KEY UPDATE {0}={0}".format(self._quote(key_columns[0]))
+        else:
+            conflict = " ON CONFLICT ({}) ".format(", ".join(self._quote(c) for c in key_columns))
+            if update_columns:
+                conflict += "DO UPDATE SET " + ", ".join(
+                    "{0}=EXCLUDED.{0}".format(self._quote(c)) for c in update_columns
+                )
+            else:
+                conflict += "DO NOTHING"
+
+        if vendor == "postgresql":
+            return self._postgresql_upsert(rows, conflict)
+
+        sql = "INSERT INTO {} ({}) VALUES ({}){}".format(
+            self._quote(self.table),
+            self._column_list(),
+            ", ".join(["%s"] * len(self.columns)),
+            conflict,
+        )
+        return self._executemany(sql, rows)
+
+    def _executemany(self, sql, rows):
+        count = 0
+        with transaction.atomic(using=self._connection.alias):
+            with self._connection.cursor() as cursor:
+                for batch in self._batches(rows):
+                    cursor.executemany(sql, batch)
+                    count += len(batch)
+        return count
+
+    def _postgresql_upsert(self, rows, conflict):
+        # Unique per load, as the table lives until the outermost transaction commits
+        staging = "_dwt_staging_{}".format(uuid.uuid4().hex)
+        with transaction.atomic(using=self._connection.alias):
+            with self._connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP".format(
+                        self._quote(staging), self._quote(self.table)
+                    )
+                )
+                count = self._copy(cursor, staging, rows)
+                cursor.execute(
+                    "INSERT INTO {0} ({1}) SELECT {1} FROM {2}{3}".format(
+                        self._quote(self.table), self._column_list(), self._quote(staging), conflict
+                    )
+                )
+                cursor.execute("DROP TABLE {}".format(self._quote(staging)))
+        return count
+
+    def _copy(self, cursor, table, rows):
+        stream = _CopyStream(rows)
+        sql = "COPY {} ({}) FROM STDIN".format(self._quote(table), self._column_list())
+        cursor.copy_expert(sql, stream, size=65536)
+        return stream.count
+
+
+_COPY_ESCAPE_MAP = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_adapt(value):
+    """
+    Converts a python value to its PostgreSQL ``COPY`` text format representation.
+    """
+    if value is None:
+        return "\\N"
+    elif isinstance(value, str):
+        return value.translate(_COPY_ESCAPE_MAP)
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, (int, float, decimal.Decimal, uuid.UUID)):
+        return str(value)
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value).translate(_COPY_ESCAPE_MAP)
+    else:
+        return str(value).translate(_COPY_ESCAPE_MAP)
+
+
+class _CopyStream:
+    """
+    File-like object which encodes rows to ``COPY`` text format
+    lazily as the database reads them.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = b""
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            lines = []
+            for row in itertools.islice(self._rows, 1000):
+                lines.append("\t".join(map(_copy_adapt, row)))
+            if not lines:
+                break
+            self.count += len(lines)
+            self._buffer += ("\n".join(lines) + "\n").encode("utf-8")
+
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
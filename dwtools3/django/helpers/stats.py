@@ -0,0 +1,181 @@
+"""
+In-process histograms for aggregating request performance statistics.
+
+Histograms use HDR-style log-linear buckets: values are bucketed with a
+fixed number of sub-buckets per power of 2, giving a bounded memory
+footprint and a relative error of around 6% across the full value range.
+
+SQL statements can be fingerprinted with ``fingerprint_sql()`` to group
+queries that differ only by their literal values, and timed with the
+``timed_db_execute()`` database execute wrapper.
+"""
+import re
+import threading
+from time import perf_counter
+
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_PLACEHOLDER_RE = re.compile(r"%(?:\(\w+\))?s")
+_SQL_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_SQL_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint_sql(sql):
+    """
+    Normalizes an SQL statement by replacing string & numeric literals and
+    param placeholders with ``?``, collapsing ``IN (...)`` lists and whitespace.
+    """
+    sql = _SQL_STRING_RE.sub("?", sql)
+    sql = _SQL_PLACEHOLDER_RE.sub("?", sql)
+    sql = _SQL_NUMBER_RE.sub("?", sql)
+    sql = _SQL_IN_LIST_RE.sub("IN (...)", sql)
+    return _SQL_WHITESPACE_RE.sub(" ", sql).strip()
+
+
+def timed_db_execute(stats, execute, sql, params, many, context):
+    """
+    Database execute wrapper adding the query's duration to ``stats["db_time"]``
+    and incrementing ``stats["db_queries"]``. Bind ``stats`` with
+    ``functools.partial()`` before installing it with ``connection.execute_wrapper()``.
+    """
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats["db_time"] += perf_counter() - start
+        stats["db_queries"] += 1
+
+
+class Histogram:
+    """
+    A histogram of non-negative integer values, with log-linear buckets.
+
+    :param int max_value: Values above this are recorded as ``max_value``.
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+    def __init__(self, max_value=2**32):
+        self.max_value = max_value
+        self.counts = [0] * (self._bucket_index(max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def _bucket_index(cls, value):
+        shift = max(0, value.bit_length() - cls.SUB_BUCKET_BITS - 1)
+        return shift * cls.SUB_BUCKET_COUNT + (value >> shift)
+
+    @classmethod
+    def _bucket_value(cls, index):
+        """
+        Returns the midpoint of the range of values in the bucket.
+        """
+        shift = max(0, index // cls.SUB_BUCKET_COUNT - 1)
+        lower = (index - shift * cls.SUB_BUCKET_COUNT) << shift
+        return lower + ((1 << shift) - 1) / 2.0
+
+    def record(self, value):
+        """
+        Records a single value.
+        """
+        value = min(max(int(value), 0), self.max_value)
+        self.counts[self._bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Returns the approximate value at the given percentile (0-100).
+        """
+        if not self.count:
+            return None
+
+        target = max(1, self.count * percent / 100.0)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(max(self._bucket_value(index), self.min), self.max)
+        return self.max
+
+    def as_dict(self, scale=1.0, percentiles=(50, 90, 95, 99)):
+        """
+        Returns a summary of the histogram. All values are divided by ``scale``.
+        """
+        if not self.count:
+            return {"count": 0}
+
+        summary = {
+            "count": self.count,
+            "min": self.min / scale,
+            "max": self.max / scale,
+            "mean": self.total / self.count / scale,
+        }
+        for p in percentiles:
+            summary["p{}".format(p)] = self.percentile(p) / scale
+        return summary
+
+
+class PerformanceStats:
+    """
+    Thread-safe per-view aggregation of request latency, database time
+    and query counts. Times are recorded in seconds, and reported in
+    milliseconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def record(self, view_name, total_time, db_time, db_queries):
+        """
+        Records the stats of a single request to ``view_name``.
+        """
+        with self._lock:
+            try:
+                histograms = self._views[view_name]
+            except KeyError:
+                histograms = self._views[view_name] = (Histogram(), Histogram(), Histogram())
+
+            histograms[0].record(total_time * 1000000)
+            histograms[1].record(db_time * 1000000)
+            histograms[2].record(db_queries)
+
+    def snapshot(self, reset=False):
+        """
+        Returns a dict of ``{view_name: {"total_ms", "db_ms", "db_queries"}}`` summaries.
+        If ``reset``, atomically discards the stats after reading them.
+        """
+        with self._lock:
+            snapshot = {
+                view_name: {
+                    "total_ms": histograms[0].as_dict(scale=1000.0),
+                    "db_ms": histograms[1].as_dict(scale=1000.0),
+                    "db_queries": histograms[2].as_dict(),
+                }
+                for view_name, histograms in self._views.items()
+            }
+            if reset:
+                self._views = {}
+            return snapshot
+
+    def reset(self):
+        """
+        Discards all recorded stats.
+        """
+        with self._lock:
+            self._views = {}
+
+
+performance_stats = PerformanceStats()
+"""
+Process-wide stats recorded by ``PerformanceStatsMiddleware``.
+"""
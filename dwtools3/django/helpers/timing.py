@@ -0,0 +1,110 @@
+"""
+Collects timing spans for the current request, which are sent to the browser
+in the ``Server-Timing`` header by ``ServerTimingMiddleware``.
+
+Views can time their own code with ``timing_span()``, as a context manager
+or decorator::
+
+    @timing_span("build_report")
+    def build_report():
+        ...
+
+    def my_view(request):
+        with timing_span("fetch", "Fetch remote data"):
+            ...
+
+When ``ServerTimingMiddleware`` isn't active, ``timing_span()`` does nothing.
+"""
+import contextvars
+import functools
+import re
+from time import perf_counter
+
+
+_current_timings = contextvars.ContextVar("dwtools3_server_timings", default=None)
+_INVALID_NAME_CHARS_RE = re.compile(r"[^\w.-]+")
+
+
+class ServerTimings:
+    """
+    A list of ``(name, duration_secs, description)`` spans for a single request.
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    def add(self, name, duration, description=None):
+        self.spans.append((name, duration, description))
+
+    def as_header(self):
+        """
+        Returns the spans formatted as a ``Server-Timing`` header value.
+        """
+        parts = []
+        for name, duration, description in self.spans:
+            part = "{};dur={:.1f}".format(_INVALID_NAME_CHARS_RE.sub("_", name), duration * 1000.0)
+            if description:
+                part += ';desc="{}"'.format(description.replace("\\", "").replace('"', "'"))
+            parts.append(part)
+        return ", ".join(parts)
+
+
+def start_request_timings():
+    """
+    Starts collecting timings for the current request. Returns a token
+    for ``stop_request_timings()``.
+    """
+    return _current_timings.set(ServerTimings())
+
+
+def stop_request_timings(token):
+    """
+    Stops collecting timings for the current request, and returns its ``ServerTimings``.
+    """
+    timings = _current_timings.get()
+    _current_timings.reset(token)
+    return timings
+
+
+def get_request_timings():
+    """
+    Returns the ``ServerTimings`` for the current request, or None if not collecting.
+    """
+    return _current_timings.get()
+
+
+class timing_span:  # pylint: disable=invalid-name
+    """
+    Context manager and decorator to add a span to the ``Server-Timing`` header.
+
+    :param str name: The metric name shown in the browser devtools.
+    :param str description: Optional description of the span.
+    """
+
+    def __init__(self, name, description=None):
+        self.name = name
+        self.description = description
+        self._start = None
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Use a new instance per call, for thread safety & reentrancy
+            with self.__class__(self.name, self.description):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        if _current_timings.get() is not None:
+            self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._start is not None:
+            duration = perf_counter() - self._start
+            self._start = None
+            timings = _current_timings.get()
+            if timings is not None:
+                timings.add(self.name, duration, self.description)
+        return False
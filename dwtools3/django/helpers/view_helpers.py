@@ -2,50 +2,97 @@
 """
 Helper functions for views.
 """
+import functools
 import operator
 from functools import wraps
 
 from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http.response import Http404
 from django.template import engines, loader
 from django.template.base import TemplateSyntaxError
 
+TEMPLATE_STRING_CACHE_SIZE = 256
+"""
+The maximum number of compiled template strings kept by ``render_template_to_string()``.
+"""
 
-def render_template_to_string(template=None, vars=None, request=None, template_string=None):
+
+@functools.lru_cache(maxsize=TEMPLATE_STRING_CACHE_SIZE)
+def _compile_template_string(template_string):
     """
-    Renders a template file or template string to a rendered string.
+    Compiles a template string with the first template engine that can parse it.
+    """
+    chain = []
+    for engine in engines.all():
+        try:
+            return engine.from_string(template_string)
+        except TemplateSyntaxError as e:
+            chain.append((engine.name, e))
 
-    :param str template: The path & name of the template to render.
-    :param dict vars: Extra template variables to push onto the context.
-    :param HttpRequest request: The request object. May be None to exclude request context.
-    :param str template_string: String content to use as the template.
+    msg = ["Parsing failed in all template engines."]
+    msg += ["{}: {}".format(e[0], str(e[1])) for e in chain]
+    msg += ["Template Source:", template_string]
+    raise TemplateSyntaxError("\n".join(msg))
+
+
+def template_string_cache_info():
+    """
+    Returns the ``(hits, misses, maxsize, currsize)`` stats of the compiled
+    template string cache used by ``render_template_to_string()``.
+    """
+    return _compile_template_string.cache_info()
+
+
+def clear_template_string_cache():
+    """
+    Clears the compiled template string cache used by ``render_template_to_string()``.
+    """
+    _compile_template_string.cache_clear()
+
+
+@receiver(setting_changed)
+def _clear_template_string_cache_on_setting_changed(setting, **kwargs):
+    if setting == "TEMPLATES":
+        clear_template_string_cache()
+
+
+def get_compiled_template(template=None, template_string=None):
+    """
+    Returns a compiled template object for a template file or template string,
+    which can be rendered many times with ``template.render(vars, request)``.
+
+    :param str template: The path & name of the template to load.
+    :param str template_string: String content to use as the template. It's
+        compiled by the first template engine that can parse it, and the compiled
+        template is kept in an LRU cache of ``TEMPLATE_STRING_CACHE_SIZE`` entries.
     """
     assert operator.xor(
         bool(template), bool(template_string)
     ), "Exactly one of template or template_string must be specified."
 
     if template_string:
-        chain = []
-        template_obj = None
-        for engine in engines.all():
-            try:
-                template_obj = engine.from_string(template_string)
-            except TemplateSyntaxError as e:
-                chain.append((engine.name, e))
-
-        if not template_obj:
-            msg = ["Parsing failed in all template engines."]
-            msg += ["{}: {}".format(e[0], str(e[1])) for e in chain]
-            msg += ["Template Source:", template_string]
-            raise TemplateSyntaxError("\n".join(msg))
-
-        output = template_obj.render(vars, request)
-    else:
-        output = loader.render_to_string(template, vars, request=request)
+        return _compile_template_string(template_string)
+    if isinstance(template, (list, tuple)):
+        return loader.select_template(template)
+    return loader.get_template(template)
+
 
-    return output
+def render_template_to_string(template=None, vars=None, request=None, template_string=None):
+    """
+    Renders a template file or template string to a rendered string.
+
+    :param str template: The path & name of the template to render.
+    :param dict vars: Extra template variables to push onto the context.
+    :param HttpRequest request: The request object. May be None to exclude request context.
+    :param str template_string: String content to use as the template. Compiled
+        template strings are cached, so rendering the same string repeatedly
+        (eg. for mass email) is fast. See ``get_compiled_template()``.
+    """
+    return get_compiled_template(template, template_string).render(vars, request)
 
 
 def validate_form(
@@ -1,8 +1,12 @@
 """
 Common views.
 """
+from django.http import JsonResponse
 from django.shortcuts import redirect, render
 
+from .stats import performance_stats
+from .view_helpers import superuser_required
+
 
 def redirect_view(to, *args, **kwargs):
     """
@@ -31,3 +35,17 @@ def template_view(template, *args, **kwargs):
         return render(req, template, *args, **kwargs)
 
     return view_func
+
+
+@superuser_required
+def performance_stats_view(request):
+    """
+    Returns the per-view histograms aggregated by ``PerformanceStatsMiddleware``
+    in this process as JSON. Pass ``?reset=1`` to reset the stats after reading.
+
+    Example usage::
+
+        path('admin/performance-stats/', performance_stats_view),
+    """
+    stats = performance_stats.snapshot(reset=bool(request.GET.get("reset")))
+    return JsonResponse(stats)
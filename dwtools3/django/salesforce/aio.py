@@ -0,0 +1,104 @@
+"""
+Asyncio versions of the salesforce helpers, with the same signatures,
+so sync functions can run many API calls concurrently::
+
+    from dwtools3.django.salesforce import aio
+
+    async def sync_users(user_ids):
+        contacts = await asyncio.gather(*(aio.get_contact(id) for id in user_ids))
+        ...
+
+``salesforce_sync --concurrency N`` runs sync functions defined with
+``async def`` concurrently in a single event loop.
+
+API calls are made by the shared simple-salesforce instance in a pool of
+``SALESFORCE_MAX_CONCURRENT_REQUESTS`` threads, so no more requests than
+that are ever in flight, and each thread reuses a pooled connection.
+Database connections opened by the threads, eg. by the database cache
+backend of the lookup cache, are closed after each call.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import threading
+
+from django.db import connections
+
+from . import helpers
+from .settings import SalesforceSettings
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor  # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=SalesforceSettings.SALESFORCE_MAX_CONCURRENT_REQUESTS,
+                thread_name_prefix="SalesforceAPI",
+            )
+        return _executor
+
+
+def _run_in_thread(context, func, args, kwargs):
+    try:
+        return context.run(func, *args, **kwargs)
+    finally:
+        # The threads are long lived, and not managed by Django's request cycle
+        connections.close_all()
+
+
+def run_in_executor(func, *args, **kwargs):
+    """
+    Runs a synchronous salesforce API function in the API thread pool,
+    in a copy of the current context. Returns an awaitable of its result.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return loop.run_in_executor(_get_executor(), _run_in_thread, context, func, args, kwargs)
+
+
+def _make_async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_executor(func, *args, **kwargs)
+
+    return wrapper
+
+
+get_by_id = _make_async(helpers.get_by_id)
+get_by_external_id = _make_async(helpers.get_by_external_id)
+get_by_email = _make_async(helpers.get_by_email)
+create_record = _make_async(helpers.create_record)
+update_record = _make_async(helpers.update_record)
+upsert_record = _make_async(helpers.upsert_record)
+create_or_update_record = _make_async(helpers.create_or_update_record)
+delete_record = _make_async(helpers.delete_record)
+
+
+# ----------------------------
+# Accounts
+# ----------------------------
+
+get_account = functools.partial(get_by_external_id, "Account")
+create_account = functools.partial(create_record, "Account")
+update_account = functools.partial(update_record, "Account")
+upsert_account = functools.partial(upsert_record, "Account")
+create_or_update_account = functools.partial(create_or_update_record, "Account")
+delete_account = functools.partial(delete_record, "Account")
+
+
+# ----------------------------
+# Contacts
+# ----------------------------
+
+get_contact = functools.partial(get_by_external_id, "Contact")
+get_contact_by_email = functools.partial(get_by_email, "Contact")
+create_contact = functools.partial(create_record, "Contact")
+update_contact = functools.partial(update_record, "Contact")
+upsert_contact = functools.partial(upsert_record, "Contact")
+create_or_update_contact = functools.partial(create_or_update_record, "Contact")
+delete_contact = functools.partial(delete_record, "Contact")
@@ -1,14 +1,24 @@
+import asyncio
 from datetime import timedelta
+import functools
 import importlib
 import logging
+import threading
+import time
+import uuid
 
-from django.db import transaction
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import OperationalError, connections, router, transaction
+from django.db.models import Count, Min, Q
 from django.utils import timezone
-from django.utils.functional import SimpleLazyObject
+from django.utils.functional import SimpleLazyObject, empty
+import requests
+from requests.adapters import HTTPAdapter
 from simple_salesforce import Salesforce
 from simple_salesforce.api import DEFAULT_API_VERSION
 from .models import SyncQueueItem
 from .settings import SalesforceSettings
+from .stats import instrument_session
 
 
 # ----------------------------
@@ -30,18 +40,42 @@ are sent to the ``dwtools3.django.salesforce`` logger.
 def create_salesforce_instance():
     """
     Create a low-level simple-salesforce instance to query over the REST API.
+    Its connection pool holds up to ``SALESFORCE_MAX_CONCURRENT_REQUESTS``
+    connections, so they're reused by concurrent requests.
     """
+    session = instrument_session(requests.Session())
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_maxsize=SalesforceSettings.SALESFORCE_MAX_CONCURRENT_REQUESTS),
+    )
     return Salesforce(
         username=SalesforceSettings.SALESFORCE_USERNAME,
         password=SalesforceSettings.SALESFORCE_PASSWORD,
         security_token=SalesforceSettings.SALESFORCE_SECURITY_TOKEN,
         domain="test" if SalesforceSettings.SALESFORCE_USE_SANDBOX else None,
         version=SalesforceSettings.SALESFORCE_API_VERSION or DEFAULT_API_VERSION,
+        session=session,
     )
 
 
+class _ThreadSafeLazyObject(SimpleLazyObject):
+    """
+    ``SimpleLazyObject`` which is set up only once when first used by
+    multiple threads at the same time, eg. by the ``aio`` helpers' thread pool.
+    """
+
+    def __init__(self, func):
+        self.__dict__["_lock"] = threading.Lock()
+        super().__init__(func)
+
+    def _setup(self):
+        with self._lock:
+            if self._wrapped is empty:
+                super()._setup()
+
+
 # Process-shared Salesforce instance from simple_salesforce
-sf = SimpleLazyObject(create_salesforce_instance)
+sf = _ThreadSafeLazyObject(create_salesforce_instance)
 
 
 # ----------------------------
@@ -49,19 +83,63 @@ sf = SimpleLazyObject(create_salesforce_instance)
 # ----------------------------
 
 
+def coalesce_sync_calls(key, merge=None):
+    """
+    Decorator for sync functions, declaring that multiple scheduled calls
+    with the same coalescing key can be run as a single call.
+
+    When ``salesforce_sync`` runs a call, any other due calls with the same key
+    are removed from the queue, and the function is called once with the params
+    of the latest call, or the params merged with ``merge(older, newer)``::
+
+        @coalesce_sync_calls(key=lambda params: params["user_id"])
+        def update_contact(user_id, fields):
+            ...
+
+        @coalesce_sync_calls(
+            key=lambda params: params["user_id"],
+            merge=lambda older, newer: dict(newer, fields={**older["fields"], **newer["fields"]}),
+        )
+        def update_contact_fields(user_id, fields):
+            ...
+
+    :param key: Function returning the coalescing key from the call params.
+    :param merge: Optional function merging the params of an older and newer call.
+    """
+
+    def decorator(func):
+        func.sync_coalesce_key = key
+        func.sync_coalesce_merge = merge
+        return func
+
+    return decorator
+
+
 def schedule_sync_function(
-    func, params, scheduled_at=None, reschedule_on_error=None, prevent_repetition=False
+    func,
+    params,
+    scheduled_at=None,
+    reschedule_on_error=None,
+    prevent_repetition=False,
+    coalesce_key=None,
 ):
     """
     Schedule a sync function to run in the future to update salesforce
     via the API.
+
+    ``coalesce_key`` overrides the key of a function decorated with
+    ``coalesce_sync_calls()``.
     """
+    if coalesce_key is None and getattr(func, "sync_coalesce_key", None):
+        coalesce_key = func.sync_coalesce_key(params)
+
     item = SyncQueueItem()
     item.scheduled_at = scheduled_at
     item.reschedule_on_error = reschedule_on_error
     item.module = func.__module__
     item.function = func.__name__
     item.params = params
+    item.coalesce_key = "" if coalesce_key is None else str(coalesce_key)
     item.full_clean()
 
     with transaction.atomic():
@@ -77,20 +155,165 @@ def schedule_sync_function(
     logger.info("Salesforce: Scheduled function %s()", item.function)
 
 
-def get_next_scheduled_sync_function(delay_secs=0):
+def get_sync_queue_stats():
     """
-    Pop the next sync function entry that needs to run from the queue.
+    Returns a dict with the number of entries in the queue (``depth``), the number
+    due to run (``due``), and how long the oldest due entry has been waiting
+    (``oldest_due_secs``).
     """
     now = timezone.now()
+    stats = SyncQueueItem.objects.aggregate(
+        depth=Count("id"),
+        due=Count("id", filter=Q(scheduled_at__lte=now)),
+        oldest_due=Min("scheduled_at", filter=Q(scheduled_at__lte=now)),
+    )
+    oldest_due = stats.pop("oldest_due")
+    stats["oldest_due_secs"] = (now - oldest_due).total_seconds() if oldest_due else 0.0
+    return stats
+
+
+SYNC_QUEUE_LOCK_RETRIES = 8
+"""
+The number of times a sync queue statement is retried when SQLite reports
+a lock conflict, with exponential backoff from 10ms.
+"""
+
+_SQLITE_LOCKED_ERRORS = ("database is locked", "database table is locked")
+
+
+def _retry_if_locked(fn):
+    """
+    Returns ``fn()``, retrying if SQLite reports the table or database as locked.
+    Shared-cache SQLite databases (eg. in-memory test databases) fail immediately
+    on lock conflicts between threads rather than waiting, which concurrent
+    ``salesforce_sync --workers`` threads run into. Other databases wait for
+    locks, so statements are never retried on them.
+    """
+    if connections[router.db_for_write(SyncQueueItem)].vendor != "sqlite":
+        return fn()
+
+    for attempt in range(SYNC_QUEUE_LOCK_RETRIES + 1):
+        try:
+            return fn()
+        except OperationalError as e:
+            if attempt == SYNC_QUEUE_LOCK_RETRIES or not str(e).startswith(_SQLITE_LOCKED_ERRORS):
+                raise
+            time.sleep(0.01 * 2**attempt)
+
+
+def _get_claimable_items(now, delay_secs):
+    """
+    Returns the queryset of due items which aren't claimed, or whose lease expired.
+    """
+    scheduled_before = now - timedelta(seconds=delay_secs) if delay_secs > 0 else now
+    return SyncQueueItem.objects.filter(
+        Q(claim_expires_at__isnull=True) | Q(claim_expires_at__lt=now),
+        scheduled_at__lte=scheduled_before,
+    )
+
+
+def claim_next_scheduled_sync_function(delay_secs=0, lease_secs=None):
+    """
+    Claim the next sync function entry that needs to run from the queue,
+    so no other worker runs it. Returns the claimed item or None.
+
+    The item stays in the queue until ``complete_sync_function()`` or
+    ``reschedule_sync_function()`` is called. If neither is called within
+    ``lease_secs`` (default ``SALESFORCE_SYNC_LEASE_SECS``), eg. because
+    the worker crashed, the item is released to be claimed again.
+
+    Uses ``SELECT ... FOR UPDATE SKIP LOCKED`` where supported by the database,
+    otherwise an atomic conditional ``UPDATE`` with a claim token.
+    """
+    now = timezone.now()
+    lease_secs = SalesforceSettings.SALESFORCE_SYNC_LEASE_SECS if lease_secs is None else lease_secs
+
+    claimable = _get_claimable_items(now, delay_secs)
+    claim = {
+        "claimed_by": uuid.uuid4().hex,
+        "claim_expires_at": now + timedelta(seconds=lease_secs),
+    }
+
+    using = router.db_for_write(SyncQueueItem)
+    if connections[using].features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=using):
+            item = claimable.select_for_update(skip_locked=True).order_by("scheduled_at").first()
+            if item:
+                SyncQueueItem.objects.filter(id=item.id).update(**claim)
+                item.claimed_by = claim["claimed_by"]
+                item.claim_expires_at = claim["claim_expires_at"]
+            return item
+
+    while True:
+        item_ids = _retry_if_locked(
+            lambda: list(claimable.order_by("scheduled_at").values_list("id", flat=True)[:10])
+        )
+        if not item_ids:
+            return None
+
+        for item_id in item_ids:
+            if _retry_if_locked(functools.partial(claimable.filter(id=item_id).update, **claim)):
+                return _retry_if_locked(lambda: SyncQueueItem.objects.get(id=item_id))
+
+
+def coalesce_sync_function(item, delay_secs=0):
+    """
+    Claims all other due entries with the same function and coalescing key
+    as a claimed entry, and merges their params into the entry's params.
+    See ``coalesce_sync_calls()``.
+
+    :return: The number of entries coalesced, ie. the number of calls saved.
+    """
+    if not item.coalesce_key or not item.claimed_by:
+        return 0
+
+    coalesced = _get_claimable_items(timezone.now(), delay_secs).filter(
+        module=item.module, function=item.function, coalesce_key=item.coalesce_key
+    )
+    count = _retry_if_locked(
+        functools.partial(
+            coalesced.update, claimed_by=item.claimed_by, claim_expires_at=item.claim_expires_at
+        )
+    )
+    if not count:
+        return 0
+
+    items = _retry_if_locked(
+        lambda: list(
+            SyncQueueItem.objects.filter(claimed_by=item.claimed_by).order_by("scheduled_at", "id")
+        )
+    )
+    merge = getattr(_get_sync_function(item), "sync_coalesce_merge", None)
+    if merge:
+        item.params = functools.reduce(merge, (i.params for i in items))
+    else:
+        item.params = items[-1].params
+
+    logger.info("Salesforce: Coalesced %d calls to function %s()", count, item.function)
+    return count
 
-    if delay_secs > 0:
-        now -= timedelta(seconds=delay_secs)
 
-    item = SyncQueueItem.objects.filter(scheduled_at__lte=now).order_by("scheduled_at").first()
+def complete_sync_function(item):
+    """
+    Remove a claimed sync function entry (and any entries coalesced
+    into it) from the queue after it has run.
+    """
+    if item.claimed_by:
+        items = SyncQueueItem.objects.filter(claimed_by=item.claimed_by)
+    else:
+        items = SyncQueueItem.objects.filter(id=item.id)
+    _retry_if_locked(items.delete)
+    item.pk = None
+
+
+def get_next_scheduled_sync_function(delay_secs=0):
+    """
+    Pop the next sync function entry that needs to run from the queue.
+    """
+    item = claim_next_scheduled_sync_function(delay_secs)
 
     if item:
-        SyncQueueItem.objects.filter(id=item.id).delete()
-        item.pk = None
+        complete_sync_function(item)
 
     return item
 
@@ -98,25 +321,52 @@ def get_next_scheduled_sync_function(delay_secs=0):
 def reschedule_sync_function(item, delay_mins=None):
     """
     Reschedule a sync function entry (for example after failure due to error).
+    Releases the claim on the item if claimed.
+
+    If the claim was lost, eg. because its lease expired and another worker
+    claimed the item, the item is left as is and a warning is logged.
     """
     if delay_mins is None:
         delay_mins = item.reschedule_on_error or 0
 
-    item.pk = None
+    claimed_by = item.claimed_by
     item.scheduled_at = timezone.now() + timedelta(minutes=delay_mins)
+    item.claimed_by = ""
+    item.claim_expires_at = None
     item.full_clean()
-    item.save(force_insert=True)
+
+    if item.pk is None:
+        _retry_if_locked(functools.partial(item.save, force_insert=True))
+    elif not claimed_by:
+        _retry_if_locked(item.save)
+    else:
+        updated = _retry_if_locked(
+            functools.partial(
+                SyncQueueItem.objects.filter(pk=item.pk, claimed_by=claimed_by).update,
+                scheduled_at=item.scheduled_at,
+                claimed_by="",
+                claim_expires_at=None,
+                _params=item._params,  # pylint: disable=protected-access
+            )
+        )
+        if not updated:
+            logger.warning(
+                "Salesforce: Lost the claim on function %s(), not rescheduling", item.function
+            )
+            return
+
+        # Remove entries coalesced into this one, as their params are merged
+        _retry_if_locked(
+            SyncQueueItem.objects.filter(claimed_by=claimed_by).exclude(id=item.id).delete
+        )
 
     logger.info("Salesforce: Rescheduled function %s() in %s mins", item.function, delay_mins)
 
 
-def run_sync_function(item):
-    """
-    Execute the sync function for the given entry.
-    """
+def _get_sync_function(item):
     module = importlib.import_module(item.module)
     try:
-        func = getattr(module, item.function)
+        return getattr(module, item.function)
     except AttributeError:
         raise AttributeError(
             'Salesforce: Function "{}" not defined in module "{}".'.format(
@@ -124,18 +374,47 @@ def run_sync_function(item):
             )
         )
 
-    params = item.params
 
+def _call_sync_function(func, params):
+    if isinstance(params, (list, tuple)):
+        return func(*params)
+    elif isinstance(params, dict):
+        return func(**params)
+    else:
+        return func(params)
+
+
+def _should_run_sync_function(item):
     if not SalesforceSettings.SALESFORCE_ENABLED:
         logger.info(
             "MOCKING: Salesforce: Running function %s(%s)", item.function, repr(item.params)
         )
-    else:
-        logger.info("Salesforce: Running function %s()", item.function)
-
-        if isinstance(params, (list, tuple)):
-            func(*params)
-        elif isinstance(params, dict):
-            func(**params)
-        else:
-            func(params)
+        return False
+
+    logger.info("Salesforce: Running function %s()", item.function)
+    return True
+
+
+def run_sync_function(item):
+    """
+    Execute the sync function for the given entry.
+    Sync functions defined with ``async def`` are run in a new event loop.
+    """
+    func = _get_sync_function(item)
+    if _should_run_sync_function(item):
+        if asyncio.iscoroutinefunction(func):
+            func = async_to_sync(func)
+        _call_sync_function(func, item.params)
+
+
+async def run_sync_function_async(item):
+    """
+    Execute the sync function for the given entry from an event loop.
+    Sync functions defined with ``async def`` are awaited, so they can
+    run concurrently. Others are run one at a time in the main thread.
+    """
+    func = _get_sync_function(item)
+    if _should_run_sync_function(item):
+        if not asyncio.iscoroutinefunction(func):
+            func = sync_to_async(func)
+        await _call_sync_function(func, item.params)
@@ -0,0 +1,341 @@
+"""
+Bulk API 2.0 ingest jobs, for creating, updating, upserting or deleting
+large numbers of salesforce records, eg. when backfilling data.
+
+Records are streamed into CSV, split into jobs of up to ``max_job_bytes``
+and uploaded. The jobs are then polled with exponential backoff until
+salesforce has processed them, and their results downloaded::
+
+    records = ({"LastName": u.last_name, "ExternalID__c": u.id} for u in users.iterator())
+    jobs = bulk_ingest("Contact", records, operation="upsert")
+
+    # Re-queue failed records to be retried individually by salesforce_sync
+    requeue_bulk_failures(jobs, sync_contact, lambda row: {"user_id": int(row["ExternalID__c"])})
+
+Jobs cost a handful of API calls each, regardless of the number of records.
+"""
+import csv
+import io
+import itertools
+import time
+
+from simple_salesforce.util import exception_handler
+
+from .api import logger, schedule_sync_function, sf
+from .settings import SalesforceSettings
+
+BULK_NULL_VALUE = "#N/A"
+BULK_MAX_JOB_BYTES = 100 * 1024 * 1024
+BULK_FINISHED_STATES = ("JobComplete", "Failed", "Aborted")
+
+
+class SalesforceBulkError(Exception):
+    """
+    Raised when a bulk ingest job can't be created, or doesn't finish in time.
+    """
+
+
+class BulkIngestJob:
+    """
+    A Bulk API 2.0 ingest job created by ``bulk_ingest()``.
+
+    Each result row is a dict of the uploaded CSV fields, along with ``sf__Id``
+    and ``sf__Created`` for successful results, or ``sf__Id`` and ``sf__Error``
+    for failed results.
+
+    :ivar str id: The salesforce id of the job.
+    :ivar str state: The job state, ``JobComplete``, ``Failed`` or ``Aborted`` once finished.
+    :ivar str error_message: The reason the job failed, if it did.
+    :ivar int records: The number of records uploaded.
+    :ivar list successful_results: The rows of records processed successfully.
+    :ivar list failed_results: The rows of records which failed.
+    :ivar list unprocessed_records: The rows of records not processed, eg. if the job was aborted.
+    """
+
+    def __init__(self, id, sobject, operation, records):
+        self.id = id
+        self.sobject = sobject
+        self.operation = operation
+        self.records = records
+        self.state = "Open"
+        self.error_message = None
+        self.successful_results = []
+        self.failed_results = []
+        self.unprocessed_records = []
+
+    def __repr__(self):
+        return "<BulkIngestJob {}({}) id={} state={}>".format(
+            self.operation, self.sobject, self.id, self.state
+        )
+
+    @property
+    def finished(self):
+        return self.state in BULK_FINISHED_STATES
+
+
+def _format_value(value):
+    if value is None:
+        return BULK_NULL_VALUE
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _iter_csv_chunks(records, fields, max_bytes):
+    """
+    Yields ``(csv_bytes, num_records)`` tuples of the records in CSV format,
+    each with a header row and no more than ``max_bytes`` long.
+
+    Raises ``ValueError`` if a record's keys differ from ``fields``, as
+    missing fields would be uploaded as ``#N/A`` and clear salesforce data,
+    and extra fields would be silently dropped.
+    """
+    field_set = set(fields)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(fields)
+    header = buffer.getvalue().encode("utf-8")
+
+    rows = []
+    size = len(header)
+    for index, record in enumerate(records):
+        if record.keys() != field_set:
+            raise ValueError(
+                "Bulk record {} has fields {}, expected {}.".format(
+                    index, sorted(record.keys()), sorted(fields)
+                )
+            )
+
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([_format_value(record[field]) for field in fields])
+        row = buffer.getvalue().encode("utf-8")
+
+        if rows and size + len(row) > max_bytes:
+            yield b"".join([header] + rows), len(rows)
+            rows = []
+            size = len(header)
+        rows.append(row)
+        size += len(row)
+
+    if rows:
+        yield b"".join([header] + rows), len(rows)
+
+
+def _parse_csv(content):
+    return list(csv.DictReader(io.StringIO(content)))
+
+
+class _BulkIngestClient:
+    """
+    Makes the Bulk API 2.0 ingest calls with the session, headers and base URL
+    of a simple-salesforce instance. Error responses raise simple-salesforce's
+    exceptions.
+    """
+
+    def __init__(self, sf_instance):
+        self.sf = sf_instance
+
+    def request(self, method, path, headers=None, **kwargs):
+        response = self.sf.session.request(
+            method,
+            self.sf.base_url + path,
+            headers=dict(self.sf.headers, **(headers or {})),
+            **kwargs,
+        )
+        if response.status_code >= 300:
+            exception_handler(response, name=path)
+        return response
+
+    def create_job(self, sobject, operation, external_id_field, csv_data, records):
+        params = {
+            "object": sobject,
+            "operation": operation,
+            "contentType": "CSV",
+            "lineEnding": "LF",
+        }
+        if operation == "upsert":
+            params["externalIdFieldName"] = external_id_field
+
+        job_info = self.request("POST", "jobs/ingest/", json=params).json()
+        job = BulkIngestJob(job_info["id"], sobject, operation, records)
+
+        try:
+            self.request(
+                "PUT",
+                "jobs/ingest/{}/batches/".format(job.id),
+                data=csv_data,
+                headers={"Content-Type": "text/csv"},
+            )
+            self.set_job_state(job, "UploadComplete")
+        except Exception:
+            self.set_job_state(job, "Aborted")
+            raise
+
+        logger.info("Salesforce: %s.bulk_%s(%d) job %s", sobject, operation, records, job.id)
+        return job
+
+    def set_job_state(self, job, state):
+        job_info = self.request("PATCH", "jobs/ingest/{}/".format(job.id), json={"state": state})
+        job.state = job_info.json()["state"]
+
+    def update_job(self, job):
+        job_info = self.request("GET", "jobs/ingest/{}/".format(job.id)).json()
+        job.state = job_info["state"]
+        job.error_message = job_info.get("errorMessage")
+
+    def get_results(self, job, result_type):
+        response = self.request("GET", "jobs/ingest/{}/{}/".format(job.id, result_type))
+        response.encoding = "utf-8"
+        return _parse_csv(response.text)
+
+
+def bulk_ingest(
+    sobject,
+    records,
+    operation="upsert",
+    *,
+    fields=None,
+    external_id_field=None,
+    max_job_bytes=BULK_MAX_JOB_BYTES,
+    poll_interval=1.0,
+    max_poll_interval=30.0,
+    timeout=3600,
+    sf_instance=None,
+):
+    """
+    Creates, updates, upserts or deletes salesforce records with Bulk API 2.0
+    ingest jobs, waits for salesforce to process them, and downloads the results.
+
+    All records must have the same fields. Values are converted to CSV as follows:
+    ``None`` is uploaded as ``#N/A``, which clears the field, booleans as
+    ``true``/``false`` and dates with ``isoformat()``. Updates and deletes must
+    include the ``Id`` field.
+
+    If creating a job fails, the jobs already created are aborted before the
+    error is raised.
+
+    :param str sobject: The sObject name, eg. ``Contact``.
+    :param records: An iterable of dicts of field values, which is consumed lazily.
+    :param str operation: ``insert``, ``update``, ``upsert``, ``delete`` or ``hardDelete``.
+    :param list fields: The CSV columns, which must match the keys of every record.
+        Defaults to the keys of the first record.
+    :param str external_id_field: The external id field for upserts.
+        Defaults to ``SALESFORCE_EXTERNAL_ID_FIELD``.
+    :param int max_job_bytes: The maximum CSV size of a single job.
+    :param float poll_interval: Initial delay between checks of the job states, doubling
+        after each check up to ``max_poll_interval``.
+    :param float timeout: Maximum seconds to wait for the jobs to finish.
+    :param sf_instance: The simple-salesforce instance. Defaults to ``api.sf``.
+    :return: The list of finished ``BulkIngestJob``.
+    """
+    client = _BulkIngestClient(sf_instance or sf)
+    external_id_field = external_id_field or SalesforceSettings.SALESFORCE_EXTERNAL_ID_FIELD
+
+    records = iter(records)
+    if fields is None:
+        first = next(records, None)
+        if first is None:
+            return []
+        fields = list(first.keys())
+        records = itertools.chain([first], records)
+
+    if operation == "upsert" and external_id_field not in fields:
+        raise SalesforceBulkError(
+            "The external id field {} must be included in upserted records.".format(
+                external_id_field
+            )
+        )
+
+    jobs = []
+    try:
+        for csv_data, num_records in _iter_csv_chunks(records, fields, max_job_bytes):
+            jobs.append(
+                client.create_job(sobject, operation, external_id_field, csv_data, num_records)
+            )
+    except Exception:
+        _abort_jobs(client, jobs)
+        raise
+
+    _wait_for_jobs(client, jobs, poll_interval, max_poll_interval, timeout)
+
+    for job in jobs:
+        job.successful_results = client.get_results(job, "successfulResults")
+        job.failed_results = client.get_results(job, "failedResults")
+        job.unprocessed_records = client.get_results(job, "unprocessedrecords")
+        logger.info(
+            "Salesforce: Bulk job %s %s, %d succeeded, %d failed, %d unprocessed",
+            job.id,
+            job.state,
+            len(job.successful_results),
+            len(job.failed_results),
+            len(job.unprocessed_records),
+        )
+        if job.error_message:
+            logger.error("Salesforce: Bulk job %s failed: %s", job.id, job.error_message)
+
+    return jobs
+
+
+def _abort_jobs(client, jobs):
+    for job in jobs:
+        try:
+            client.set_job_state(job, "Aborted")
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Salesforce: Failed to abort bulk job %s", job.id)
+
+
+def _wait_for_jobs(client, jobs, poll_interval, max_poll_interval, timeout):
+    deadline = time.monotonic() + timeout
+    pending = list(jobs)
+    while True:
+        for job in pending:
+            client.update_job(job)
+        pending = [job for job in pending if not job.finished]
+        if not pending:
+            return
+
+        if time.monotonic() + poll_interval > deadline:
+            raise SalesforceBulkError(
+                "Salesforce: Timed out waiting for bulk jobs {}.".format(
+                    ", ".join(job.id for job in pending)
+                )
+            )
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+
+
+def requeue_bulk_failures(
+    jobs, func, params_fn=None, *, scheduled_at=None, reschedule_on_error=None
+):
+    """
+    Schedules a sync function for each failed or unprocessed record of
+    the given bulk ingest jobs, so they're retried by ``salesforce_sync``.
+
+    :param jobs: The ``BulkIngestJob`` list returned by ``bulk_ingest()``.
+    :param func: The sync function to schedule.
+    :param params_fn: Function returning the sync function params from a
+        result row. Defaults to the row's uploaded fields.
+    :return: The number of sync functions scheduled.
+    """
+    count = 0
+    for job in jobs:
+        for row in job.failed_results + job.unprocessed_records:
+            if "sf__Error" in row:
+                logger.warning(
+                    "Salesforce: Bulk %s of %s failed: %s",
+                    job.operation,
+                    job.sobject,
+                    row["sf__Error"],
+                )
+            if params_fn:
+                params = params_fn(row)
+            else:
+                params = {k: v for k, v in row.items() if not k.startswith("sf__")}
+            schedule_sync_function(
+                func, params, scheduled_at=scheduled_at, reschedule_on_error=reschedule_on_error
+            )
+            count += 1
+    return count
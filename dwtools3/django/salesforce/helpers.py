@@ -1,6 +1,15 @@
+from collections import OrderedDict
+import copy
+from decimal import Decimal
 import functools
+import hashlib
 import operator
+import threading
+import time
+from urllib.parse import quote
+import uuid
 
+from django.core.cache import caches
 from simple_salesforce import SalesforceResourceNotFound
 
 from .api import logger, sf
@@ -35,6 +44,13 @@ def _resolve_sf_obj(name_or_obj):
         return name_or_obj
 
 
+def _get_sf_obj_name(name_or_obj):
+    if isinstance(name_or_obj, str):
+        return name_or_obj
+    else:
+        return name_or_obj.name
+
+
 def escape(s):
     return s.translate(_STRING_ESCAPE_MAP)
 
@@ -43,6 +59,219 @@ def escape_for_like(s):
     return escape(s).translate(_LIKE_ESCAPE_MAP)
 
 
+def format_soql_value(value):
+    """
+    Formats a value as a SOQL literal according to its python type: strings
+    are quoted and escaped, while numbers, booleans and None are not.
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    return "'{}'".format(escape(str(value)))
+
+
+def _normalize_field_value(value):
+    """
+    Returns a value for comparing field values sent to and returned by salesforce,
+    which returns number fields as floats, eg. ``123.0`` for ``123``.
+    """
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return Decimal(str(value))
+    return value
+
+
+# ----------------------------
+# Lookup Cache
+# ----------------------------
+
+
+class SalesforceLookupCache:
+    """
+    Read-through cache of the records found by ``get_by_external_id()`` and
+    ``get_by_email()``, keyed on ``(sObject, field, value)``. Records which
+    aren't found are cached too.
+
+    Cached records are held in memory until the cache is disabled, and
+    optionally in the Django cache given by ``SALESFORCE_LOOKUP_CACHE_ALIAS``.
+    Both expire after ``SALESFORCE_LOOKUP_CACHE_TTL`` seconds.
+
+    Creating, updating or deleting records with the helpers in this module
+    or ``SalesforceBatch`` invalidates their cached lookups, including in the
+    Django cache when made outside of a sync run. In the Django cache,
+    each record's lookups are stored with a version token of the record's id,
+    and invalidating the id replaces its token, so no read-modify-write of
+    shared keys is needed.
+
+    Lookups return copies of the cached records, which may be modified freely.
+
+    ``salesforce_sync`` enables the cache for the duration of a run if
+    ``SALESFORCE_LOOKUP_CACHE`` is set, and logs its hit rate at the end.
+    """
+
+    KEY_PREFIX = "dwtools3.salesforce.lookup:"
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def enable(self):
+        """
+        Starts caching lookups, resetting the cache and its stats.
+        """
+        with self.lock:
+            self.enabled = True
+            self.entries = {}
+            self.hits = self.misses = self.invalidations = 0
+
+    def disable(self):
+        """
+        Stops caching lookups and clears the in-memory cache.
+        """
+        with self.lock:
+            self.enabled = False
+            self.entries = {}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _get_django_cache(self):
+        alias = SalesforceSettings.SALESFORCE_LOOKUP_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def _get_cache_key(self, key):
+        return self.KEY_PREFIX + hashlib.md5("\0".join(key).encode("utf-8")).hexdigest()
+
+    def _get_version_key(self, sobject, id):
+        return "{}{}:{}".format(self.KEY_PREFIX, sobject, id)
+
+    def _get_version(self, django_cache, sobject, id, ttl):
+        """
+        Returns the current version token of a record's id, adding one if needed.
+        """
+        version_key = self._get_version_key(sobject, id)
+        version = django_cache.get(version_key)
+        if version is None:
+            django_cache.add(version_key, uuid.uuid4().hex, ttl)
+            version = django_cache.get(version_key)
+        return version
+
+    def _get_django_cached(self, django_cache, sobject, key):
+        """
+        Returns a ``(record,)`` tuple cached in the Django cache if its
+        version is current, otherwise None.
+        """
+        cached = django_cache.get(self._get_cache_key(key))
+        if cached is None:
+            return None
+        record, version = cached
+        if record is not None:
+            current = django_cache.get(self._get_version_key(sobject, record["Id"]))
+            if version is None or version != current:
+                return None
+        return (record,)
+
+    def _trim(self, record):
+        fields = SalesforceSettings.SALESFORCE_LOOKUP_CACHE_FIELDS
+        if record is None or fields is None:
+            return record
+        return OrderedDict(
+            (k, v) for k, v in record.items() if k in ("attributes", "Id") or k in fields
+        )
+
+    def lookup(self, sobject, field, value, fetch):
+        """
+        Returns the record with the given field value from the cache,
+        or from ``fetch()`` if it isn't cached.
+        """
+        if not self.enabled:
+            return fetch()
+
+        key = (sobject, field, str(value))
+        django_cache = self._get_django_cache()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+
+        cached = self._get_django_cached(django_cache, sobject, key) if django_cache else None
+        if cached is not None:
+            record = cached[0]
+            hit = True
+        else:
+            record = self._trim(fetch())
+            hit = False
+
+        ttl = SalesforceSettings.SALESFORCE_LOOKUP_CACHE_TTL
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if self.enabled:
+                self.entries[key] = (time.monotonic() + ttl, record)
+
+        if django_cache and not hit:
+            version = None
+            if record is not None:
+                version = self._get_version(django_cache, sobject, record["Id"], ttl)
+            django_cache.set(self._get_cache_key(key), (record, version), ttl)
+
+        return copy.deepcopy(record)
+
+    def invalidate(self, sobject, id=None, fields=None):
+        """
+        Removes the cached lookups of a record by its salesforce id, and the
+        lookups of ``sobject`` by the given field values.
+
+        The Django cache is invalidated even while the cache is disabled, eg.
+        when records are changed by web requests, as it's shared with sync runs.
+        """
+        keys = {(sobject, k, str(v)) for k, v in (fields or {}).items() if v is not None}
+        with self.lock:
+            if self.enabled:
+                if id:
+                    keys.update(
+                        key
+                        for key, (_, record) in self.entries.items()
+                        if key[0] == sobject and record and record["Id"] == id
+                    )
+                for key in keys:
+                    self.entries.pop(key, None)
+                self.invalidations += 1
+
+        django_cache = self._get_django_cache()
+        if django_cache:
+            django_cache.delete_many([self._get_cache_key(key) for key in keys])
+            if id:
+                # Replacing the version invalidates all lookups of the record
+                django_cache.set(
+                    self._get_version_key(sobject, id),
+                    uuid.uuid4().hex,
+                    SalesforceSettings.SALESFORCE_LOOKUP_CACHE_TTL,
+                )
+
+
+lookup_cache = SalesforceLookupCache()
+"""
+The process-wide ``SalesforceLookupCache``.
+"""
+
+
+# ----------------------------
+# Records
+# ----------------------------
+
+
 def get_by_id(sf_obj, id):
     sf_obj = _resolve_sf_obj(sf_obj)
     logger.info("Salesforce: %s.get_by_id(%s)", sf_obj.name, id)
@@ -60,12 +289,14 @@ def get_by_external_id(sf_obj, external_id, *, external_id_field=None):
     sf_obj = _resolve_sf_obj(sf_obj)
     external_id_field = external_id_field or SalesforceSettings.SALESFORCE_EXTERNAL_ID_FIELD
 
-    logger.info("Salesforce: %s.get_by_custom_id(%s)", sf_obj.name, external_id)
+    def fetch():
+        logger.info("Salesforce: %s.get_by_custom_id(%s)", sf_obj.name, external_id)
+        try:
+            return sf_obj.get_by_custom_id(external_id_field, external_id)
+        except SalesforceResourceNotFound:
+            return None
 
-    try:
-        return sf_obj.get_by_custom_id(external_id_field, external_id)
-    except SalesforceResourceNotFound:
-        return None
+    return lookup_cache.lookup(sf_obj.name, external_id_field, external_id, fetch)
 
 
 def get_by_email(sf_obj, email):
@@ -74,12 +305,14 @@ def get_by_email(sf_obj, email):
     """
     sf_obj = _resolve_sf_obj(sf_obj)
 
-    logger.info("Salesforce: %s.get_by_email(%s)", sf_obj.name, email)
+    def fetch():
+        logger.info("Salesforce: %s.get_by_email(%s)", sf_obj.name, email)
+        try:
+            return sf_obj.get_by_custom_id("Email", email)
+        except SalesforceResourceNotFound:
+            return None
 
-    try:
-        return sf_obj.get_by_custom_id("Email", email)
-    except SalesforceResourceNotFound:
-        return None
+    return lookup_cache.lookup(sf_obj.name, "Email", email, fetch)
 
 
 def create_record(sf_obj, data, *, external_id=None, external_id_field=None):
@@ -97,6 +330,7 @@ def create_record(sf_obj, data, *, external_id=None, external_id_field=None):
 
     logger.info("Salesforce: %s.create(%s)", sf_obj.name, external_id or "")
     ret = sf_obj.create(data)
+    lookup_cache.invalidate(sf_obj.name, fields=data)
     logger.info("Salesforce: >>> %s", ret["id"])
     return ret["id"]
 
@@ -120,11 +354,43 @@ def update_record(sf_obj, data, *, id=None, external_id=None, external_id_field=
         id = obj["Id"]
 
     logger.info("Salesforce: %s.update(%s)", sf_obj.name, id)
+    updated_id = id
     try:
         sf_obj.update(id, data)
     except SalesforceResourceNotFound:
-        id = None
+        updated_id = None
+    finally:
+        # After the update, so concurrent lookups can't cache the old record
+        lookup_cache.invalidate(sf_obj.name, id, fields=data)
+
+    logger.info("Salesforce: >>> %s", updated_id)
+    return updated_id
 
+
+def upsert_record(sf_obj, data, *, external_id, external_id_field=None):
+    """
+    Creates or updates a salesforce record identified by its external id,
+    in a single API call using the native external id upsert.
+
+    :return: The salesforce id of the updated or created record.
+    """
+    sf_obj = _resolve_sf_obj(sf_obj)
+    external_id_field = external_id_field or SalesforceSettings.SALESFORCE_EXTERNAL_ID_FIELD
+    data = {k: v for k, v in data.items() if k != external_id_field}
+
+    logger.info("Salesforce: %s.upsert(%s)", sf_obj.name, external_id)
+    response = sf_obj.upsert(
+        "{}/{}".format(external_id_field, quote(str(external_id), safe="")),
+        data,
+        raw_response=True,
+    )
+    if response.content:
+        id = response.json()["id"]
+    else:
+        # Before API v46, updates return no content
+        id = sf_obj.get_by_custom_id(external_id_field, str(external_id))["Id"]
+
+    lookup_cache.invalidate(sf_obj.name, id, fields=dict(data, **{external_id_field: external_id}))
     logger.info("Salesforce: >>> %s", id)
     return id
 
@@ -132,10 +398,16 @@ def update_record(sf_obj, data, *, id=None, external_id=None, external_id_field=
 def create_or_update_record(sf_obj, data, *, id=None, external_id=None, external_id_field=None):
     """
     Creates or updates a salesforce record with the given salesforce id or
-    external id.
+    external id. Records identified by external id are upserted in a
+    single API call with ``upsert_record()``.
 
     :return: The salesforce id of the updated or created record.
     """
+    if external_id and not id:
+        return upsert_record(
+            sf_obj, data, external_id=external_id, external_id_field=external_id_field
+        )
+
     id = update_record(
         sf_obj, data, id=id, external_id=external_id, external_id_field=external_id_field
     )
@@ -167,13 +439,233 @@ def delete_record(sf_obj, *, id=None, external_id=None, external_id_field=None):
         id = obj["Id"]
 
     logger.info("Salesforce: %s.delete(%s)", sf_obj.name, id)
+    deleted_id = id
     try:
         sf_obj.delete(id)
     except SalesforceResourceNotFound:
-        id = None
+        deleted_id = None
+    finally:
+        lookup_cache.invalidate(sf_obj.name, id)
 
-    logger.info("Salesforce: >>> %s", id)
-    return id
+    logger.info("Salesforce: >>> %s", deleted_id)
+    return deleted_id
+
+
+# ----------------------------
+# Batched Operations
+# ----------------------------
+
+
+class SalesforceBatchResult:
+    """
+    The result of a single record operation in a ``SalesforceBatch``.
+    ``success`` is None until the batch is executed.
+
+    :ivar str id: The salesforce id of the record, or None if not found or failed.
+    :ivar bool success: Whether the operation succeeded.
+    :ivar bool created: For upserts, whether the record was created.
+    :ivar list errors: The salesforce error dicts (``statusCode``, ``message``, ``fields``).
+    """
+
+    def __init__(self, batch, operation, sobject, id=None, external_id=None):
+        self.batch = batch
+        self.operation = operation
+        self.sobject = sobject
+        self.id = id
+        self.external_id = external_id
+        self.success = None
+        self.created = False
+        self.errors = []
+
+    def __repr__(self):
+        return "<SalesforceBatchResult {}({}) id={} success={}>".format(
+            self.operation, self.sobject, self.id, self.success
+        )
+
+    def _set_response(self, response):
+        self.success = response["success"]
+        self.id = response.get("id") or self.id
+        self.created = response.get("created", False)
+        self.errors = response.get("errors", [])
+
+
+class SalesforceBatch:
+    """
+    Queues record operations and sends them to salesforce in batches of up to
+    200 records per API call, using the sObject Collections API. Operations
+    are grouped by sObject, operation and external id field.
+
+    Equivalent to the ``create_record()``, ``update_record()``, ``upsert_record()``
+    and ``delete_record()`` helpers, which each cost one or more API calls per
+    record. Records identified by external id are looked up with a single
+    SOQL query per group for updates and deletes, and upserted natively::
+
+        batch = SalesforceBatch()
+        results = [batch.upsert('Contact', data, external_id=user.id) for data, user in ...]
+        batch.execute()
+        for result in results:
+            if not result.success:
+                logger.error("Failed: %s", result.errors)
+
+    Batched upserts require ``SALESFORCE_API_VERSION`` 46.0 or later.
+
+    :param bool all_or_none: Whether to roll back all records in an API call if
+        any fail. Otherwise each record succeeds or fails separately.
+    :param sf_instance: The simple-salesforce instance. Defaults to ``api.sf``.
+    """
+
+    MAX_RECORDS = 200
+
+    def __init__(self, all_or_none=False, sf_instance=None):
+        self.all_or_none = all_or_none
+        self.sf = sf_instance or sf
+        self._groups = OrderedDict()
+
+    def _add(self, operation, sf_obj, data, id, external_id, external_id_field):
+        sobject = _get_sf_obj_name(sf_obj)
+        external_id_field = external_id_field or SalesforceSettings.SALESFORCE_EXTERNAL_ID_FIELD
+        result = SalesforceBatchResult(self, operation, sobject, id=id, external_id=external_id)
+        key = (operation, sobject, None if id else external_id_field)
+        self._groups.setdefault(key, []).append((result, data))
+        return result
+
+    def create(self, sf_obj, data, *, external_id=None, external_id_field=None):
+        """
+        Queues creation of a record. See ``create_record()``.
+        """
+        external_id_field = external_id_field or SalesforceSettings.SALESFORCE_EXTERNAL_ID_FIELD
+        if external_id and external_id_field not in data:
+            data = dict(data, **{external_id_field: external_id})
+        return self._add("create", sf_obj, data, None, None, None)
+
+    def update(self, sf_obj, data, *, id=None, external_id=None, external_id_field=None):
+        """
+        Queues an update of a record by salesforce id or external id. See ``update_record()``.
+        """
+        assert operator.xor(
+            bool(id), bool(external_id)
+        ), "Exactly one of id or external id must be specified."
+        return self._add("update", sf_obj, data, id, external_id, external_id_field)
+
+    def upsert(self, sf_obj, data, *, external_id, external_id_field=None):
+        """
+        Queues creation or update of a record by external id. See ``upsert_record()``.
+        """
+        assert external_id, "The external id must be specified."
+        return self._add("upsert", sf_obj, data, None, external_id, external_id_field)
+
+    def delete(self, sf_obj, *, id=None, external_id=None, external_id_field=None):
+        """
+        Queues deletion of a record by salesforce id or external id. See ``delete_record()``.
+        """
+        assert operator.xor(
+            bool(id), bool(external_id)
+        ), "Exactly one of id or external id must be specified."
+        return self._add("delete", sf_obj, None, id, external_id, external_id_field)
+
+    def execute(self):
+        """
+        Sends all queued operations to salesforce, in the order their
+        groups were first queued. Returns the list of ``SalesforceBatchResult``.
+        """
+        groups, self._groups = self._groups, OrderedDict()
+        results = []
+        for (operation, sobject, external_id_field), items in groups.items():
+            for start in range(0, len(items), self.MAX_RECORDS):
+                chunk = items[start : start + self.MAX_RECORDS]
+                if operation in ("update", "delete") and external_id_field:
+                    chunk = self._resolve_external_ids(sobject, external_id_field, chunk)
+                if chunk:
+                    logger.info("Salesforce: %s.%s_batch(%d)", sobject, operation, len(chunk))
+                    getattr(self, "_execute_" + operation)(sobject, external_id_field, chunk)
+            self._invalidate_lookups(sobject, external_id_field, items)
+            results.extend(result for result, _ in items)
+        return results
+
+    def _invalidate_lookups(self, sobject, external_id_field, items):
+        if not lookup_cache.enabled:
+            return
+        for result, data in items:
+            fields = dict(data or {})
+            if result.external_id:
+                fields[external_id_field] = result.external_id
+            lookup_cache.invalidate(sobject, result.id, fields=fields)
+
+    def _resolve_external_ids(self, sobject, external_id_field, chunk):
+        """
+        Looks up the salesforce ids of records identified by external id, returning
+        the found items. Items not found are marked as failed.
+
+        External ids are formatted by python type, so must be numbers for number
+        fields and strings for text fields.
+        """
+        soql = "SELECT Id, {field} FROM {sobject} WHERE {field} IN ({values})".format(
+            field=external_id_field,
+            sobject=sobject,
+            values=", ".join(format_soql_value(result.external_id) for result, _ in chunk),
+        )
+        ids = {
+            _normalize_field_value(record[external_id_field]): record["Id"]
+            for record in self.sf.query_all(soql)["records"]
+        }
+
+        found = []
+        for result, data in chunk:
+            result.id = ids.get(_normalize_field_value(result.external_id))
+            if result.id:
+                found.append((result, data))
+            else:
+                result.success = False
+                result.errors = [{"statusCode": "NOT_FOUND", "message": "Record not found."}]
+        return found
+
+    def _set_responses(self, chunk, responses):
+        for (result, _), response in zip(chunk, responses):
+            result._set_response(response)  # pylint: disable=protected-access
+
+    def _execute_create(self, sobject, external_id_field, chunk):
+        # pylint: disable=unused-argument
+        records = [dict(data, attributes={"type": sobject}) for _, data in chunk]
+        responses = self.sf.restful(
+            "composite/sobjects",
+            method="POST",
+            json={"allOrNone": self.all_or_none, "records": records},
+        )
+        self._set_responses(chunk, responses)
+
+    def _execute_update(self, sobject, external_id_field, chunk):
+        # pylint: disable=unused-argument
+        records = [dict(data, attributes={"type": sobject}, id=result.id) for result, data in chunk]
+        responses = self.sf.restful(
+            "composite/sobjects",
+            method="PATCH",
+            json={"allOrNone": self.all_or_none, "records": records},
+        )
+        self._set_responses(chunk, responses)
+
+    def _execute_upsert(self, sobject, external_id_field, chunk):
+        records = [
+            dict(data, attributes={"type": sobject}, **{external_id_field: result.external_id})
+            for result, data in chunk
+        ]
+        responses = self.sf.restful(
+            "composite/sobjects/{}/{}".format(sobject, external_id_field),
+            method="PATCH",
+            json={"allOrNone": self.all_or_none, "records": records},
+        )
+        self._set_responses(chunk, responses)
+
+    def _execute_delete(self, sobject, external_id_field, chunk):
+        # pylint: disable=unused-argument
+        responses = self.sf.restful(
+            "composite/sobjects",
+            method="DELETE",
+            params={
+                "ids": ",".join(result.id for result, _ in chunk),
+                "allOrNone": "true" if self.all_or_none else "false",
+            },
+        )
+        self._set_responses(chunk, responses)
 
 
 # ----------------------------
@@ -195,6 +687,11 @@ update_account = functools.partial(update_record, "Account")
 Updates a Salesforce Account.
 """
 
+upsert_account = functools.partial(upsert_record, "Account")
+"""
+Creates or updates a salesforce Account by its External ID.
+"""
+
 create_or_update_account = functools.partial(create_or_update_record, "Account")
 """
 Creates or updates a salesforce Account.
@@ -230,6 +727,11 @@ update_contact = functools.partial(update_record, "Contact")
 Updates a Salesforce Contact.
 """
 
+upsert_contact = functools.partial(upsert_record, "Contact")
+"""
+Creates or updates a salesforce Contact by its External ID.
+"""
+
 create_or_update_contact = functools.partial(create_or_update_record, "Contact")
 """
 Creates or updates a salesforce Contact.
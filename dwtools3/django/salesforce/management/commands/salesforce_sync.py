@@ -1,13 +1,33 @@
+import asyncio
+import json
 import time
 import logging
 import pprint
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from ... import api
+from ...helpers import lookup_cache
+from ...settings import SalesforceSettings
+from ...stats import SyncStats, track_api_calls
 
 
 class Command(BaseCommand):
     help = "Synchronize scheduled salesforce updates from the sync queue"
 
+    STATS_COLUMNS = (
+        "Function",
+        "Runs",
+        "Errors",
+        "Resched",
+        "Coalesced",
+        "p50 ms",
+        "p95 ms",
+        "max ms",
+        "API/run",
+    )
+
     def add_arguments(self, parser):
         parser.add_argument(
             "--max-runtime",
@@ -27,6 +47,39 @@ class Command(BaseCommand):
                 "Don't run updates until they've been scheduled " "for at least this long (secs)."
             ),
         )
+        parser.add_argument(
+            "--workers",
+            action="store",
+            type=int,
+            dest="workers",
+            default=1,
+            help="Number of sync functions to run concurrently in worker threads.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            action="store",
+            type=int,
+            dest="concurrency",
+            default=1,
+            help=(
+                "Number of sync functions to run concurrently in an asyncio event loop. "
+                "Only sync functions defined with async def run concurrently."
+            ),
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            dest="stats",
+            default=False,
+            help="Print a summary of queue depth, latency and API calls per sync function.",
+        )
+        parser.add_argument(
+            "--stats-file",
+            action="store",
+            dest="stats_file",
+            default=None,
+            help="Write the stats of the run to this file in JSON format.",
+        )
 
     def set_verbosity(self, options):
         verbosity = int(options.get("verbosity"))
@@ -36,34 +89,210 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         self.set_verbosity(options)
+        if options["workers"] > 1 and options["concurrency"] > 1:
+            raise CommandError("Use only one of --workers and --concurrency.")
 
         api.logger.info("Starting salesforce sync...")
 
-        start_time = time.time()
+        self.start_time = time.time()
+        self.stats = SyncStats()
+        collect_stats = options["stats"] or options["stats_file"]
+        queue_stats = api.get_sync_queue_stats() if collect_stats else None
+        lookup_cache_stats = None
+        if SalesforceSettings.SALESFORCE_LOOKUP_CACHE:
+            lookup_cache.enable()
+
+        try:
+            if options["concurrency"] > 1:
+                async_to_sync(self.run_async_workers)(options)
+            elif options["workers"] <= 1:
+                self.run_worker(options)
+            else:
+                with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                    futures = [
+                        executor.submit(self.run_threaded_worker, options)
+                        for _ in range(options["workers"])
+                    ]
+                    for future in futures:
+                        future.result()
+        finally:
+            if lookup_cache.enabled:
+                lookup_cache_stats = self.get_lookup_cache_stats()
+                lookup_cache.disable()
+
+        self.log_coalesced_calls()
+
+        if collect_stats:
+            report = self.get_stats_report(queue_stats, lookup_cache_stats)
+            if options["stats"]:
+                self.print_stats_report(report)
+            if options["stats_file"]:
+                with open(options["stats_file"], "w", encoding="utf-8") as f:
+                    json.dump(report, f, indent=2)
+
+    def get_lookup_cache_stats(self):
+        stats = {
+            "hits": lookup_cache.hits,
+            "misses": lookup_cache.misses,
+            "hit_rate": lookup_cache.hit_rate,
+            "invalidations": lookup_cache.invalidations,
+        }
+        api.logger.info(
+            "Lookup cache: %d hits, %d misses (%.0f%% hit rate), %d invalidations",
+            stats["hits"],
+            stats["misses"],
+            stats["hit_rate"] * 100,
+            stats["invalidations"],
+        )
+        return stats
+
+    def log_coalesced_calls(self):
+        coalesced = sorted(
+            ((f, s["coalesced"]) for f, s in self.stats.snapshot().items() if s["coalesced"]),
+            key=lambda c: -c[1],
+        )
+        if coalesced:
+            api.logger.info(
+                "Coalesced %d duplicate calls: %s",
+                sum(count for _, count in coalesced),
+                ", ".join("{}() x{}".format(function, count) for function, count in coalesced),
+            )
+
+    def get_stats_report(self, queue_stats, lookup_cache_stats):
+        functions = self.stats.snapshot()
+        return {
+            "duration_secs": time.time() - self.start_time,
+            "queue": {"start": queue_stats, "end": api.get_sync_queue_stats()},
+            "runs": sum(s["runs"] for s in functions.values()),
+            "api_calls": sum(s["api_calls"].get("total", 0) for s in functions.values()),
+            "functions": functions,
+            "lookup_cache": lookup_cache_stats,
+        }
+
+    def print_stats_report(self, report):
+        row_format = "{:<40} {:>6} {:>6} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8}"
+        for name, queue in report["queue"].items():
+            self.stdout.write(
+                "Queue at {}: {} items, {} due, oldest due waiting {:.0f}s".format(
+                    name, queue["depth"], queue["due"], queue["oldest_due_secs"]
+                )
+            )
+
+        self.stdout.write("")
+        self.stdout.write(row_format.format(*self.STATS_COLUMNS))
+        functions = sorted(
+            report["functions"].items(),
+            key=lambda f: -f[1]["latency_ms"].get("mean", 0) * f[1]["runs"],
+        )
+        for function, stats in functions:
+            latency = stats["latency_ms"]
+            self.stdout.write(
+                row_format.format(
+                    function,
+                    stats["runs"],
+                    stats["errors"],
+                    stats["reschedules"],
+                    stats["coalesced"],
+                    "{:.1f}".format(latency.get("p50", 0)),
+                    "{:.1f}".format(latency.get("p95", 0)),
+                    "{:.1f}".format(latency.get("max", 0)),
+                    "{:.1f}".format(stats["api_calls"].get("mean", 0)),
+                )
+            )
+
+        self.stdout.write("")
+        self.stdout.write(
+            "{} runs in {:.1f}s, {} API calls".format(
+                report["runs"], report["duration_secs"], report["api_calls"]
+            )
+        )
+
+    def run_threaded_worker(self, options):
+        try:
+            self.run_worker(options)
+        finally:
+            connections.close_all()
+
+    def run_worker(self, options):
         while True:
-            if (
-                options["max_runtime"] > 0
-                and time.time() - start_time + 30 > options["max_runtime"]
-            ):
-                api.logger.info("Max runtime exceeded, exiting.")
+            item = self.claim_item(options)
+            if not item:
                 break
+            self.process_item(item, options)
+
+    async def run_async_workers(self, options):
+        await asyncio.gather(
+            *(self.run_async_worker(options) for _ in range(options["concurrency"]))
+        )
 
-            item = api.get_next_scheduled_sync_function(delay_secs=options["delay"])
+    async def run_async_worker(self, options):
+        while True:
+            item = await sync_to_async(self.claim_item)(options)
             if not item:
-                api.logger.info("All items processed, exiting.")
                 break
+            await self.process_item_async(item, options)
+
+    def claim_item(self, options):
+        if (
+            options["max_runtime"] > 0
+            and time.time() - self.start_time + 30 > options["max_runtime"]
+        ):
+            api.logger.info("Max runtime exceeded, exiting.")
+            return None
 
-            api.logger.info("\n%s()\n%s", item.function, "-" * (len(item.function) + 2))
+        item = api.claim_next_scheduled_sync_function(delay_secs=options["delay"])
+        if not item:
+            api.logger.info("All items processed, exiting.")
+        return item
 
+    def process_item(self, item, options):
+        self.start_item(item, options)
+        with track_api_calls() as api_calls:
+            start = time.perf_counter()
             try:
                 api.run_sync_function(item)
             except Exception:
-                api.logger.exception(
-                    "Error while processing salesforce sync function %s().\n\n"
-                    "Parameters:\n%s\n\n",
-                    item.function,
-                    pprint.pformat(item.params, indent=2),
-                )
+                self.log_item_error(item)
+                failed = True
+            else:
+                failed = False
+            duration = time.perf_counter() - start
+        self.finish_item(item, failed, duration, api_calls.count)
+
+    async def process_item_async(self, item, options):
+        await sync_to_async(self.start_item)(item, options)
+        with track_api_calls() as api_calls:
+            start = time.perf_counter()
+            try:
+                await api.run_sync_function_async(item)
+            except Exception:
+                self.log_item_error(item)
+                failed = True
+            else:
+                failed = False
+            duration = time.perf_counter() - start
+        await sync_to_async(self.finish_item)(item, failed, duration, api_calls.count)
+
+    def start_item(self, item, options):
+        coalesced = api.coalesce_sync_function(item, delay_secs=options["delay"])
+        if coalesced:
+            self.stats.record_coalesced(item.function, coalesced)
+
+        api.logger.info("\n%s()\n%s", item.function, "-" * (len(item.function) + 2))
+
+    def log_item_error(self, item):
+        api.logger.exception(
+            "Error while processing salesforce sync function %s().\n\n"
+            "Parameters:\n%s\n\n",
+            item.function,
+            pprint.pformat(item.params, indent=2),
+        )
+
+    def finish_item(self, item, failed, duration, api_calls):
+        rescheduled = failed and item.reschedule_on_error is not None
+        self.stats.record(item.function, duration, api_calls, failed, rescheduled)
 
-                if item.reschedule_on_error is not None:
-                    api.reschedule_sync_function(item)
+        if rescheduled:
+            api.reschedule_sync_function(item)
+        else:
+            api.complete_sync_function(item)
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("salesforce", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="syncqueueitem",
+            name="claimed_by",
+            field=models.CharField(blank=True, default="", max_length=32),
+        ),
+        migrations.AddField(
+            model_name="syncqueueitem",
+            name="claim_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("salesforce", "0002_syncqueueitem_claim"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="syncqueueitem",
+            name="coalesce_key",
+            field=models.CharField(blank=True, db_index=True, default="", max_length=255),
+        ),
+    ]
@@ -22,6 +22,9 @@ class SyncQueueItem(models.Model):
     module = models.CharField(max_length=255)
     function = models.CharField(max_length=128)
     _params = models.TextField(blank=True)
+    coalesce_key = models.CharField(max_length=255, blank=True, default="", db_index=True)
+    claimed_by = models.CharField(max_length=32, blank=True, default="")
+    claim_expires_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         ordering = ("scheduled_at",)
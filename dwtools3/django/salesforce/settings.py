@@ -42,3 +42,44 @@ class SalesforceSettings(SettingsProxy):
     """
     Specify the salesforce API version to use, eg '39.0'
     """
+
+    SALESFORCE_SYNC_LEASE_SECS = 600
+    """
+    How long a ``salesforce_sync`` worker holds a claimed sync queue item.
+    If the worker crashes, the item is released after this many seconds.
+    Should be longer than any single sync function takes to run.
+    """
+
+    SALESFORCE_LOOKUP_CACHE = False
+    """
+    Whether ``salesforce_sync`` caches the records found by ``get_by_external_id()``
+    and ``get_by_email()`` during a run. Records changed with the helpers are
+    invalidated automatically, but changes made elsewhere may be missed until
+    ``SALESFORCE_LOOKUP_CACHE_TTL`` expires.
+    """
+
+    SALESFORCE_LOOKUP_CACHE_TTL = 300
+    """
+    How many seconds a cached salesforce lookup is valid for.
+    """
+
+    SALESFORCE_LOOKUP_CACHE_ALIAS = None
+    """
+    The Django cache alias in which to also cache salesforce lookups, so they're
+    shared between sync runs and processes. Records changed with the helpers are
+    invalidated in it from any process, not just during sync runs. If ``None``,
+    lookups are only cached in memory for the duration of a run.
+    """
+
+    SALESFORCE_LOOKUP_CACHE_FIELDS = None
+    """
+    The fields of looked up records to cache, along with ``Id``. If ``None``,
+    all fields are cached.
+    """
+
+    SALESFORCE_MAX_CONCURRENT_REQUESTS = 10
+    """
+    Maximum number of concurrent salesforce API requests made by the
+    ``aio`` helpers, and the size of the API connection pool. Salesforce
+    limits the number of concurrent long-running requests per org.
+    """
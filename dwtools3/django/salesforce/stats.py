@@ -0,0 +1,132 @@
+"""
+Instrumentation of ``salesforce_sync`` runs: per sync function latency
+histograms, salesforce API calls per run, error, reschedule and coalescing
+counts.
+
+API calls are counted by a response hook on the ``requests`` session of the
+simple-salesforce instance, see ``instrument_session()``. Calls are
+attributed to the sync function running in the current context, including
+calls made from the ``aio`` helpers' thread pool.
+"""
+import contextvars
+import threading
+
+from ..helpers.stats import Histogram
+
+_current_api_calls = contextvars.ContextVar("dwtools3_salesforce_api_calls", default=None)
+
+
+class APICallCounter:
+    """
+    Thread-safe count of the salesforce API calls made while it's active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.count += 1
+
+
+class track_api_calls:  # pylint: disable=invalid-name
+    """
+    Context manager counting the salesforce API calls made in the current
+    context, returning an ``APICallCounter``::
+
+        with track_api_calls() as api_calls:
+            sync_contact(user_id)
+        print(api_calls.count)
+    """
+
+    def __enter__(self):
+        self.counter = APICallCounter()
+        self.token = _current_api_calls.set(self.counter)
+        return self.counter
+
+    def __exit__(self, *exc_info):
+        _current_api_calls.reset(self.token)
+
+
+def _count_api_call(response, *args, **kwargs):
+    # pylint: disable=unused-argument
+    counter = _current_api_calls.get()
+    if counter is not None:
+        counter.increment()
+    return response
+
+
+def instrument_session(session):
+    """
+    Adds a response hook to a ``requests`` session, counting its requests
+    in the active ``track_api_calls()``.
+    """
+    if _count_api_call not in session.hooks["response"]:
+        session.hooks["response"].append(_count_api_call)
+    return session
+
+
+class _FunctionStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.api_calls = Histogram()
+        self.runs = 0
+        self.errors = 0
+        self.reschedules = 0
+        self.coalesced = 0
+
+
+class SyncStats:
+    """
+    Thread-safe per-function aggregation of sync function runs.
+    Times are recorded in seconds, and reported in milliseconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._functions = {}
+
+    def _get_function_stats(self, function):
+        try:
+            return self._functions[function]
+        except KeyError:
+            stats = self._functions[function] = _FunctionStats()
+            return stats
+
+    def record(self, function, duration, api_calls, failed=False, rescheduled=False):
+        """
+        Records a single run of the sync function named ``function``.
+        """
+        with self._lock:
+            stats = self._get_function_stats(function)
+            stats.latency.record(duration * 1000000)
+            stats.api_calls.record(api_calls)
+            stats.runs += 1
+            stats.errors += int(failed)
+            stats.reschedules += int(rescheduled)
+
+    def record_coalesced(self, function, count):
+        """
+        Records ``count`` queued calls to ``function`` coalesced into another.
+        """
+        with self._lock:
+            self._get_function_stats(function).coalesced += count
+
+    def snapshot(self):
+        """
+        Returns a dict of ``{function: {"runs", "errors", "reschedules", "coalesced",
+        "latency_ms", "api_calls"}}`` summaries.
+        """
+        with self._lock:
+            return {
+                function: {
+                    "runs": stats.runs,
+                    "errors": stats.errors,
+                    "reschedules": stats.reschedules,
+                    "coalesced": stats.coalesced,
+                    "latency_ms": stats.latency.as_dict(scale=1000.0),
+                    "api_calls": dict(stats.api_calls.as_dict(), total=stats.api_calls.total),
+                }
+                for function, stats in self._functions.items()
+            }
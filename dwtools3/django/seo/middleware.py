@@ -1,20 +1,20 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import redirect
+from django.utils.decorators import sync_and_async_middleware
 from ...http import modify_url_query_string
 from .models import Redirect, normalize_url
 
 
+@sync_and_async_middleware
 def SEORedirectMiddleware(get_response):
     """
     Intercepts 404 errors and checks the database for any defined
     redirecs that match the current request path.
     """
 
-    def middleware(request):
-        response = get_response(request)
-
-        if response.status_code != 404:
-            return response
-
+    def get_redirect(request, response):
         try:
             r = Redirect.objects.get(url=normalize_url(request.path))
         except Redirect.DoesNotExist:
@@ -28,4 +28,24 @@ def SEORedirectMiddleware(get_response):
 
         return redirect(to, **kwargs)
 
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def async_middleware(request):
+            response = await get_response(request)
+
+            if response.status_code != 404:
+                return response
+
+            return await sync_to_async(get_redirect)(request, response)
+
+        return async_middleware
+
+    def middleware(request):
+        response = get_response(request)
+
+        if response.status_code != 404:
+            return response
+
+        return get_redirect(request, response)
+
     return middleware
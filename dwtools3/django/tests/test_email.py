@@ -0,0 +1,321 @@
+import os
+import smtplib
+import tempfile
+from unittest import mock
+
+from django.core import mail
+from django.core.management import call_command
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase, override_settings
+
+from ..email import messages
+from ..email.backends import PooledSMTPEmailBackend, _smtp_connection_pool
+from ..email.messages import HTMLEmail, html_to_text, send_mail
+from ..email.queue import list_queued_messages
+from ..email.settings import EmailSettings
+from ..email.templates import send_bulk_email, send_email
+
+
+class FlakyEmailBackend(EmailBackend):
+    """
+    Locmem backend which fails the first ``fail_count`` calls to ``send_messages()``.
+    """
+
+    fail_count = 0
+
+    def send_messages(self, messages):
+        if FlakyEmailBackend.fail_count:
+            FlakyEmailBackend.fail_count -= 1
+            raise ConnectionError("Connection lost")
+        return super().send_messages(messages)
+
+
+class FakeSMTP:
+    """
+    Stand-in for ``smtplib.SMTP`` recording connections and sent emails.
+    """
+
+    connections = []
+
+    def __init__(self, host, port, **kwargs):
+        self.sent = []
+        self.noops = 0
+        self.healthy = True
+        self.failing = False
+        self.refused = set()
+        self.closed = False
+        FakeSMTP.connections.append(self)
+
+    def login(self, username, password):
+        pass
+
+    def noop(self):
+        self.noops += 1
+        if not self.healthy:
+            raise smtplib.SMTPServerDisconnected()
+        return (250, b"OK")
+
+    def sendmail(self, from_email, recipients, message):
+        if self.failing:
+            raise smtplib.SMTPDataError(451, b"Temporary failure")
+        if self.refused.intersection(recipients):
+            raise smtplib.SMTPRecipientsRefused({r: (550, b"Refused") for r in recipients})
+        self.sent.append(recipients)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakePooledSMTPEmailBackend(PooledSMTPEmailBackend):
+    connection_class = FakeSMTP
+
+
+class DjangoEmailTestCase(TestCase):
+    def test_send_bulk_email(self):
+        recipients = ["user{}@example.com".format(i) for i in range(5)]
+        recipients.append(("Last User", "last@example.com"))
+
+        result = send_bulk_email(
+            recipients,
+            subject="Hello\n  {{ name }}",
+            body="<p>Dear {{ name }},</p><p>{{ SUBJECT }}</p>",
+            vars_fn=lambda r: {"name": r[0] if isinstance(r, tuple) else r.split("@")[0]},
+            batch_size=2,
+        )
+
+        self.assertEqual(result, (6, 0, []))
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(mail.outbox[0].subject, "Hello user0")
+        self.assertEqual(mail.outbox[0].to, ["user0@example.com"])
+        self.assertEqual(mail.outbox[5].to, ['"Last User" <last@example.com>'])
+        self.assertIn("Dear Last User", mail.outbox[5].message().as_string())
+
+    def test_send_bulk_email_context_precedence(self):
+        old_context = EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT
+        EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT = {"site": "extra", "footer": "Footer"}
+        try:
+            template = "{{ site }} {{ footer }} {{ name }}"
+            send_email(
+                "a@example.com",
+                subject=template,
+                body=template,
+                vars={"site": "caller", "name": "A"},
+            )
+            send_bulk_email(
+                ["b@example.com"],
+                subject=template,
+                body=template,
+                vars_fn=lambda r: {"site": "caller", "name": "B"},
+            )
+        finally:
+            EmailSettings.EMAIL_EXTRA_TEMPLATE_CONTEXT = old_context
+
+        self.assertEqual([m.subject for m in mail.outbox], ["extra Footer A", "extra Footer B"])
+
+    def test_send_bulk_email_render_errors(self):
+        recipients = ["user{}@example.com".format(i) for i in range(5)]
+
+        def vars_fn(recipient):
+            if recipient == recipients[1]:
+                raise ValueError("Bad recipient")
+            return {"name": recipient.split("@")[0]}
+
+        with self.assertLogs("dwtools3.django.email", "ERROR"):
+            result = send_bulk_email(
+                recipients, subject="Hi {{ name }}", body="Body", vars_fn=vars_fn, batch_size=2
+            )
+        self.assertEqual(result.sent, 4)
+        self.assertEqual(result.failed, 1)
+        self.assertEqual(result.errors[0].batch, 0)
+        self.assertEqual(result.errors[0].recipients, [recipients[1]])
+        self.assertIsInstance(result.errors[0].exception, ValueError)
+        self.assertEqual(
+            [m.subject for m in mail.outbox], ["Hi user0", "Hi user2", "Hi user3", "Hi user4"]
+        )
+
+    @override_settings(EMAIL_BACKEND="dwtools3.django.tests.test_email.FlakyEmailBackend")
+    def test_send_bulk_email_retry(self):
+        recipients = ["user{}@example.com".format(i) for i in range(5)]
+
+        FlakyEmailBackend.fail_count = 1
+        with self.assertLogs("dwtools3.django.email", "WARNING"):
+            result = send_bulk_email(
+                recipients, subject="Hi", body="Body", batch_size=2, retry_delay=0
+            )
+        self.assertEqual(result, (5, 0, []))
+        self.assertEqual(len(mail.outbox), 5)
+
+        mail.outbox = []
+        FlakyEmailBackend.fail_count = 2
+        with self.assertLogs("dwtools3.django.email", "WARNING"):
+            result = send_bulk_email(
+                recipients, subject="Hi", body="Body", batch_size=2, max_retries=1, retry_delay=0
+            )
+        self.assertEqual(result.sent, 3)
+        self.assertEqual(result.failed, 2)
+        self.assertEqual(result.errors[0].batch, 0)
+        self.assertEqual(result.errors[0].recipients, recipients[:2])
+        self.assertIsInstance(result.errors[0].exception, ConnectionError)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_html_to_text(self):
+        html = """<html><head><title>Title</title><style>p { color: red; }</style></head>
+            <body>
+              <!-- comment -->
+              <h1>Welcome &amp; hello</h1>
+              <p>Dear Bob,<br>
+                 thanks for <b>joining</b> &quot;Us&quot; &lt;3&nbsp;&copy;</p>
+              <ul>
+                <li>One</li>
+                <li>Two</li>
+              </ul>
+              <p>Bye</p><p>Again</p>
+              <script>var x = "<p>";</script>
+            </body></html>"""
+        expected = (
+            "Welcome & hello\n\n"
+            'Dear Bob,\nthanks for joining "Us" <3 \u00a9\n\n'
+            "- One\n- Two\n\n"
+            "Bye\n\nAgain"
+        )
+        self.assertEqual(html_to_text(html), expected)
+        self.assertEqual(
+            html_to_text("Line 1\n\n\n\n  Line 2<br><br><br>Line 3"), "Line 1\n\nLine 2\n\nLine 3"
+        )
+
+        email = HTMLEmail("Subject", html, to=["a@example.com"])
+        email.message()
+        self.assertEqual(email.body, expected)
+        self.assertEqual(email.alternatives, [(html, "text/html")])
+
+    def test_html_to_text_memoized(self):
+        with mock.patch.object(
+            messages, "_convert_html_to_text", wraps=messages._convert_html_to_text
+        ) as convert:
+            for i in range(3):
+                self.assertEqual(html_to_text("<p>Newsletter</p>"), "Newsletter")
+            self.assertEqual(convert.call_count, 1)
+
+            for i in range(messages.HTML_TO_TEXT_CACHE_SIZE):
+                html_to_text("<p>{}</p>".format(i))
+            html_to_text("<p>Newsletter</p>")
+            self.assertEqual(convert.call_count, messages.HTML_TO_TEXT_CACHE_SIZE + 2)
+        self.assertLessEqual(len(messages._html_to_text_cache), messages.HTML_TO_TEXT_CACHE_SIZE)
+
+    @override_settings(EMAIL_BACKEND="dwtools3.django.email.backends.QueuedEmailBackend")
+    def test_email_queue(self):
+        old_directory = EmailSettings.EMAIL_QUEUE_DIRECTORY
+        old_backend = EmailSettings.EMAIL_QUEUE_BACKEND
+        with tempfile.TemporaryDirectory() as directory:
+            EmailSettings.EMAIL_QUEUE_DIRECTORY = directory
+            EmailSettings.EMAIL_QUEUE_BACKEND = "dwtools3.django.tests.test_email.FlakyEmailBackend"
+            try:
+                for i in range(5):
+                    send_mail(
+                        "Subject {}".format(i),
+                        "<p>Body</p>",
+                        "user{}@example.com".format(i),
+                        bcc="b@example.com",
+                    )
+                self.assertEqual(len(mail.outbox), 0)
+                self.assertEqual(len(list_queued_messages()), 5)
+
+                FlakyEmailBackend.fail_count = 1
+                with self.assertLogs("dwtools3.django.email", "INFO"):
+                    call_command("send_queued_email", workers=2)
+                self.assertEqual(len(mail.outbox), 4)
+                self.assertEqual(len(list_queued_messages(due_only=False)), 1)
+                self.assertEqual(len(list_queued_messages()), 0)
+
+                message = mail.outbox[0]
+                self.assertEqual(message.recipients()[1], "b@example.com")
+                self.assertTrue(message.message()["Subject"].startswith("Subject "))
+                self.assertNotIn("b@example.com", message.message().as_string())
+
+                EmailSettings.EMAIL_QUEUE_RETRY_DELAY = 0
+                os.rename(
+                    os.path.join(directory, "queue", list_queued_messages(due_only=False)[0]),
+                    os.path.join(directory, "queue", "0000000000.000000-1-retry.eml"),
+                )
+                FlakyEmailBackend.fail_count = 1
+                with self.assertLogs("dwtools3.django.email", "WARNING"):
+                    call_command("send_queued_email", workers=2)
+                self.assertEqual(len(list_queued_messages()), 1)
+                self.assertIn("-2-", list_queued_messages()[0])
+
+                EmailSettings.EMAIL_QUEUE_MAX_RETRIES = 2
+                FlakyEmailBackend.fail_count = 1
+                with self.assertLogs("dwtools3.django.email", "ERROR"):
+                    call_command("send_queued_email")
+                self.assertEqual(len(list_queued_messages(due_only=False)), 0)
+                self.assertEqual(len(os.listdir(os.path.join(directory, "failed"))), 1)
+                self.assertEqual(len(mail.outbox), 4)
+            finally:
+                EmailSettings.EMAIL_QUEUE_DIRECTORY = old_directory
+                EmailSettings.EMAIL_QUEUE_BACKEND = old_backend
+                EmailSettings.EMAIL_QUEUE_RETRY_DELAY = 60
+                EmailSettings.EMAIL_QUEUE_MAX_RETRIES = 5
+
+    @override_settings(EMAIL_BACKEND="dwtools3.django.tests.test_email.FakePooledSMTPEmailBackend")
+    def test_pooled_smtp_backend(self):
+        FakeSMTP.connections = []
+        _smtp_connection_pool.clear()
+        EmailSettings.EMAIL_POOL_MAX_MESSAGES = 3
+        try:
+            for i in range(4):
+                send_mail("Subject", "Body", "user{}@example.com".format(i))
+
+            self.assertEqual(len(FakeSMTP.connections), 2)
+            first, second = FakeSMTP.connections
+            self.assertEqual(len(first.sent), 3)
+            self.assertEqual(first.noops, 2)
+            self.assertTrue(first.closed)
+            self.assertEqual(second.sent, [["user3@example.com"]])
+            self.assertFalse(second.closed)
+
+            second.healthy = False
+            send_mail("Subject", "Body", "user4@example.com")
+            self.assertEqual(len(FakeSMTP.connections), 3)
+            self.assertTrue(second.closed)
+            self.assertEqual(FakeSMTP.connections[2].sent, [["user4@example.com"]])
+
+            FakeSMTP.connections[2].failing = True
+            connection = mail.get_connection(fail_silently=True)
+            self.assertEqual(connection.send_messages([HTMLEmail("S", "B", to=["a@b.com"])]), 0)
+            self.assertTrue(FakeSMTP.connections[2].closed)
+            send_mail("Subject", "Body", "user5@example.com")
+            self.assertEqual(len(FakeSMTP.connections), 4)
+
+            _smtp_connection_pool.clear()
+            self.assertTrue(FakeSMTP.connections[3].closed)
+        finally:
+            EmailSettings.EMAIL_POOL_MAX_MESSAGES = 100
+            _smtp_connection_pool.clear()
+
+    @override_settings(EMAIL_BACKEND="dwtools3.django.tests.test_email.FakePooledSMTPEmailBackend")
+    def test_pooled_smtp_backend_fail_silently(self):
+        FakeSMTP.connections = []
+        _smtp_connection_pool.clear()
+        try:
+            send_mail("Subject", "Body", "user0@example.com")
+            pooled = FakeSMTP.connections[0]
+            pooled.refused = {"user2@example.com"}
+
+            messages = [
+                HTMLEmail("S", "B", to=["user{}@example.com".format(i)]) for i in range(1, 5)
+            ]
+            connection = mail.get_connection(fail_silently=True)
+            self.assertEqual(connection.send_messages(messages), 3)
+            self.assertEqual(
+                pooled.sent,
+                [["user{}@example.com".format(i)] for i in (0, 1, 3, 4)],
+            )
+            self.assertTrue(pooled.closed)
+
+            send_mail("Subject", "Body", "user5@example.com")
+            self.assertEqual(len(FakeSMTP.connections), 2)
+        finally:
+            _smtp_connection_pool.clear()
@@ -1,8 +1,56 @@
+import asyncio
+import datetime
+import decimal
+import io
+import json
+import uuid
+import tempfile
 from collections import namedtuple
+from unittest import mock
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.http import Http404, HttpResponse
+from django.template import TemplateSyntaxError, engines
+from django.template.response import TemplateResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import ResolverMatch, path, resolve
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
 
-from ..helpers.middleware import TranslateProxyRemoteAddrMiddleware
+from .test_models import TestModel
+from ...http import sign_url
+from ...datatypes.enumx import EnumX
+from ..helpers.ajax import DjangoJSONEncoderWithEnum, ajax, ajax_batch_view, cors
+from ..helpers.json_backends import JSON_BACKENDS, get_json_backend
+from ..helpers.middleware import (
+    MiddlewareSettings,
+    NPlusOneQueriesDetected,
+    PerformanceStatsMiddleware,
+    ProfilerMiddleware,
+    ServerTimingMiddleware,
+    list_request_profiles,
+    TranslateProxyRemoteAddrMiddleware,
+)
+from ..helpers.stats import Histogram, fingerprint_sql, performance_stats
+from ..helpers.timing import timing_span
+from ..helpers.view_helpers import (
+    clear_template_string_cache,
+    render_template_to_string,
+    template_string_cache_info,
+)
+from ..helpers.sql import (
+    RawSQLBuilder,
+    RawSQLBulkLoader,
+    RawSQLTemplate,
+    _convert_to_numbered_placeholders,
+    invalidate_sql_cache_tags,
+)
 
 
 class DjangoHelpersMiddlewareTestCase(TestCase):
@@ -31,3 +79,671 @@ class DjangoHelpersMiddlewareTestCase(TestCase):
             request = Request(META={"HTTP_X_FORWARDED_FOR": header})
             result = TranslateProxyRemoteAddrMiddleware(get_response)(request)
             self.assertEqual(result, expected)
+
+    def test_performance_stats_middleware(self):
+        def view(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.execute("SELECT 2")
+            return "response"
+
+        def get_response(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 0")
+            request.resolver_match = ResolverMatch(view, (), {}, url_name="my-view")
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        performance_stats.reset()
+        middleware = PerformanceStatsMiddleware(get_response)
+        request = RequestFactory().get("/")
+
+        MiddlewareSettings.PERFORMANCE_STATS_PRINT = False
+        MiddlewareSettings.PERFORMANCE_STATS_HISTOGRAMS = True
+        try:
+            with override_settings(DEBUG=False):
+                self.assertEqual(middleware(request), "response")
+                self.assertEqual(middleware(request), "response")
+        finally:
+            MiddlewareSettings.PERFORMANCE_STATS_PRINT = True
+            MiddlewareSettings.PERFORMANCE_STATS_HISTOGRAMS = False
+
+        stats = getattr(request, PerformanceStatsMiddleware.STATS_KEY)
+        self.assertEqual(stats["db_queries"], 3)
+        self.assertEqual(stats["middleware_db_queries"], 1)
+
+        snapshot = performance_stats.snapshot(reset=True)
+        self.assertEqual(list(snapshot), ["my-view"])
+        self.assertEqual(snapshot["my-view"]["total_ms"]["count"], 2)
+        self.assertEqual(snapshot["my-view"]["db_queries"]["p50"], 3)
+        self.assertEqual(performance_stats.snapshot(), {})
+
+    def test_nplusone_detection(self):
+        def view(request):
+            with connection.cursor() as cursor:
+                for i in range(5):
+                    cursor.execute("SELECT %s", [i])
+                cursor.execute("SELECT 'other' AS x")
+            return HttpResponse()
+
+        def get_response(request):
+            request.resolver_match = ResolverMatch(view, (), {}, url_name="my-view")
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        middleware = PerformanceStatsMiddleware(get_response)
+        request = RequestFactory().get("/")
+
+        MiddlewareSettings.PERFORMANCE_STATS_PRINT = False
+        MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_THRESHOLD = 5
+        try:
+            MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_MODE = "header"
+            response = middleware(request)
+            self.assertEqual(response["X-NPlusOne-Queries"], "5x SELECT ?")
+
+            MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_MODE = "raise"
+            with self.assertRaises(NPlusOneQueriesDetected) as cm:
+                middleware(request)
+            self.assertIn("my-view: 5 repeats", str(cm.exception))
+            self.assertIn("test_helpers.py", str(cm.exception))
+
+            MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_THRESHOLD = 6
+            self.assertNotIn("X-NPlusOne-Queries", middleware(request))
+        finally:
+            MiddlewareSettings.PERFORMANCE_STATS_PRINT = True
+            MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_THRESHOLD = None
+            MiddlewareSettings.PERFORMANCE_STATS_NPLUSONE_MODE = "log"
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            request.resolver_match = ResolverMatch(run_queries, (), {}, url_name="my-view")
+            await stats_middleware.process_view(request, run_queries, (), {})
+            await sync_to_async(run_queries)()
+            # A new thread & connection
+            await sync_to_async(run_queries, thread_sensitive=False)(close=True)
+            return request.META["REMOTE_ADDR"]
+
+        def run_queries(close=False):
+            with connections["default"].cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.execute("SELECT 2")
+            if close:
+                connections.close_all()
+
+        proxy_middleware = TranslateProxyRemoteAddrMiddleware(get_response)
+        stats_middleware = PerformanceStatsMiddleware(proxy_middleware)
+        self.assertTrue(asyncio.iscoroutinefunction(proxy_middleware))
+        self.assertTrue(asyncio.iscoroutinefunction(stats_middleware))
+
+        request = RequestFactory().get("/", HTTP_X_FORWARDED_FOR="1.2.3.4")
+        MiddlewareSettings.PERFORMANCE_STATS_PRINT = False
+        try:
+            self.assertEqual(async_to_sync(stats_middleware)(request), "1.2.3.4")
+        finally:
+            MiddlewareSettings.PERFORMANCE_STATS_PRINT = True
+
+        stats = getattr(request, PerformanceStatsMiddleware.STATS_KEY)
+        self.assertEqual(stats["db_queries"], 4)
+        self.assertEqual(stats["middleware_db_queries"], 0)
+
+        run_queries()
+        self.assertEqual(stats["db_queries"], 4)
+
+    def test_profiler_middleware(self):
+        def get_response(request):
+            sum(range(10000))
+            return "response"
+
+        middleware = ProfilerMiddleware(get_response)
+        with tempfile.TemporaryDirectory() as directory:
+            MiddlewareSettings.PROFILER_DIRECTORY = directory
+            MiddlewareSettings.PROFILER_MAX_PROFILES = 2
+            try:
+                self.assertEqual(middleware(RequestFactory().get("/page/?_profile=1")), "response")
+                self.assertEqual(list_request_profiles(), [])
+
+                url = sign_url("/page/?_profile=1", 60)
+                for _ in range(3):
+                    self.assertEqual(middleware(RequestFactory().get(url)), "response")
+                profiles = list_request_profiles()
+                self.assertEqual(len(profiles), 2)
+                self.assertTrue(profiles[0].endswith("-page.prof"))
+
+                out = io.StringIO()
+                call_command("request_profiles", profiles[0], stdout=out)
+                self.assertIn("function calls", out.getvalue())
+
+                MiddlewareSettings.PROFILER_FORMAT = "collapsed"
+                MiddlewareSettings.PROFILER_SAMPLE_RATE = 1.0
+                middleware(RequestFactory().get("/"))
+                self.assertTrue(list_request_profiles()[-1].endswith("-root.collapsed"))
+            finally:
+                MiddlewareSettings.PROFILER_DIRECTORY = None
+                MiddlewareSettings.PROFILER_MAX_PROFILES = 100
+                MiddlewareSettings.PROFILER_FORMAT = "pstats"
+                MiddlewareSettings.PROFILER_SAMPLE_RATE = 0.0
+
+    def test_server_timing_middleware(self):
+        @timing_span("custom", 'My "span"')
+        def view(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return TemplateResponse(
+                request, engines["django"].from_string("{{ value }}"), {"value": "x"}
+            )
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            response = middleware.process_template_response(request, view(request))
+            return response.render()
+
+        middleware = ServerTimingMiddleware(get_response)
+        response = middleware(RequestFactory().get("/"))
+        self.assertEqual(response.content, b"x")
+        names = [part.split(";")[0] for part in response["Server-Timing"].split(", ")]
+        self.assertEqual(names, ["total", "middleware", "view", "db", "template", "custom"])
+        self.assertIn("db;dur=", response["Server-Timing"])
+        self.assertIn(';desc="1 queries"', response["Server-Timing"])
+        self.assertIn(";desc=\"My 'span'\"", response["Server-Timing"])
+
+        # No-op outside of the middleware
+        view(RequestFactory().get("/"))
+
+    def test_fingerprint_sql(self):
+        self.assertEqual(
+            fingerprint_sql("SELECT * FROM t1\n WHERE id = 12 AND name = 'it''s'"),
+            "SELECT * FROM t1 WHERE id = ? AND name = ?",
+        )
+        self.assertEqual(
+            fingerprint_sql('SELECT "a" FROM "t" WHERE "id" IN (%s, %s, %s) AND x=%(x)s'),
+            'SELECT "a" FROM "t" WHERE "id" IN (...) AND x=?',
+        )
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+
+        summary = histogram.as_dict()
+        self.assertEqual(summary["count"], 1000)
+        self.assertEqual(summary["min"], 1)
+        self.assertEqual(summary["max"], 1000)
+        self.assertAlmostEqual(summary["p50"], 500, delta=500 * 0.07)
+        self.assertAlmostEqual(summary["p99"], 990, delta=990 * 0.07)
+
+
+class DjangoHelpersViewHelpersTestCase(TestCase):
+    def test_template_string_cache(self):
+        clear_template_string_cache()
+
+        for name in ("a", "b", "c"):
+            output = render_template_to_string(template_string="Hi {{ name }}", vars={"name": name})
+            self.assertEqual(output, "Hi " + name)
+
+        info = template_string_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 1, 1))
+
+        with self.assertRaises(TemplateSyntaxError):
+            render_template_to_string(template_string="{% bad_tag %}")
+
+        with override_settings(TEMPLATES=[]):
+            self.assertEqual(template_string_cache_info().currsize, 0)
+
+
+class DjangoHelpersRawSQLBuilderTestCase(TestCase):
+    def make_sql(self):
+        sql = RawSQLBuilder()
+        sql.add("SELECT 1 AS num, 'one' AS name")
+        sql.add("UNION ALL SELECT 2, 'two'")
+        sql.add_if(True, "UNION ALL SELECT %s, %s", [3, "three"])
+        sql.add_if(False, "UNION ALL SELECT %s, %s", [4, "four"])
+        return sql
+
+    def test_stream(self):
+        with self.make_sql().stream(batch_size=2) as rows:
+            self.assertEqual(rows.columns, ["num", "name"])
+            self.assertEqual(list(rows), [(1, "one"), (2, "two"), (3, "three")])
+
+        with self.make_sql().stream(row_format="dict") as rows:
+            self.assertEqual(list(rows)[2], {"num": 3, "name": "three"})
+
+        with self.make_sql().stream(row_format="namedtuple") as rows:
+            row = next(iter(rows))
+            self.assertEqual((row.num, row.name), (1, "one"))
+
+    def test_stream_named_cursor(self):
+        # Named server-side cursors only have a description after the first fetch
+        class NamedCursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+                self.fetched = False
+
+            @property
+            def description(self):
+                return self.cursor.description if self.fetched else None
+
+            def fetchmany(self, size):
+                self.fetched = True
+                return self.cursor.fetchmany(size)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+        chunked_cursor = connection.chunked_cursor
+        with mock.patch.object(connection, "chunked_cursor", lambda: NamedCursor(chunked_cursor())):
+            with self.make_sql().stream(batch_size=2, row_format="dict") as rows:
+                self.assertEqual(rows.columns, ["num", "name"])
+                self.assertEqual([row["num"] for row in rows], [1, 2, 3])
+
+    def test_stream_closes_cursor(self):
+        stream = self.make_sql().stream(batch_size=1)
+        with stream as rows:
+            cursor = rows._cursor
+            next(iter(rows))
+        self.assertIsNone(stream._cursor)
+        with self.assertRaises(Exception):
+            cursor.execute("SELECT 1")
+
+        stream = self.make_sql().stream()
+        self.assertEqual(len(list(stream)), 3)
+        self.assertIsNone(stream._cursor)
+
+    def test_template(self):
+        template = RawSQLTemplate()
+        template.add("SELECT * FROM (SELECT 1 AS num UNION ALL SELECT 2 UNION ALL SELECT 3) t")
+        template.add("WHERE num >= %s", key="min")
+        template.add_if("max", "AND num <= %s")
+        template.add_if("not", "AND num <> %s")
+
+        sql = template.builder()
+        sql.add_if(True, "not", [2])
+        sql.add("min", [1])
+        sql.add_if(False, "max", [2])
+        self.assertEqual(
+            sql.get_sql(),
+            (
+                "SELECT * FROM (SELECT 1 AS num UNION ALL SELECT 2 UNION ALL SELECT 3) t\n"
+                "WHERE num >= %s\nAND num <> %s",
+                [1, 2],
+            ),
+        )
+        with sql.execute() as cursor:
+            self.assertEqual(cursor.fetchall(), [(1,), (3,)])
+
+        sql2 = template.builder()
+        sql2.add("min", [1])
+        sql2.add("not", [3])
+        self.assertIs(sql.get_sql()[0], sql2.get_sql()[0])
+
+        with self.assertRaises(KeyError):
+            template.builder().add("unknown")
+
+    def test_numbered_placeholders(self):
+        self.assertEqual(
+            _convert_to_numbered_placeholders("a=%s AND b LIKE '%%x' AND c=%s", (1, 2)),
+            ("a=$1 AND b LIKE '%x' AND c=$2", [1, 2]),
+        )
+        self.assertEqual(
+            _convert_to_numbered_placeholders("a=%(a)s OR b=%(b)s OR c=%(a)s", {"b": 2, "a": 1}),
+            ("a=$1 OR b=$2 OR c=$1", [1, 2]),
+        )
+
+    def test_cached(self):
+        cache.clear()
+        sql = RawSQLBuilder()
+        sql.add("SELECT %s AS num, 'one' AS name", [1])
+
+        with self.assertNumQueries(1):
+            result = sql.cached(ttl=60, tags=["t1", "t2"])
+            self.assertEqual(result.columns, ("num", "name"))
+            self.assertEqual(result.rows, [(1, "one")])
+            self.assertEqual(result.dicts(), [{"num": 1, "name": "one"}])
+            self.assertEqual(sql.cached(ttl=60, tags=["t2", "t1"]), result)
+
+        with self.assertNumQueries(1):
+            invalidate_sql_cache_tags("t2")
+            sql.cached(ttl=60, tags=["t1", "t2"])
+            sql.cached(ttl=60, tags=["t1", "t2"])
+
+        # A caller timing out waiting for the lock doesn't release another caller's lock
+        invalidate_sql_cache_tags("t1")
+        with mock.patch.object(cache, "add", return_value=False):
+            with mock.patch.object(cache, "delete") as delete:
+                sql.cached(ttl=60, tags=["t1"], lock_timeout=0)
+        delete.assert_not_called()
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+    )
+    def test_cached_dummy_cache(self):
+        sql = RawSQLBuilder()
+        sql.add("SELECT %s AS num", [1])
+        with self.assertNumQueries(2):
+            self.assertEqual(sql.cached(ttl=60, tags=["t1"]).rows, [(1,)])
+            self.assertEqual(sql.cached(ttl=60, tags=["t1"]).rows, [(1,)])
+
+    def test_bulk_loader(self):
+        loader = RawSQLBulkLoader(
+            TestModel._meta.db_table, ["fk", "name", "slug", "ordering"], batch_size=3
+        )
+        rows = ((1, "name-{}".format(i), "slug", i) for i in range(10))
+        self.assertEqual(loader.load(rows), 10)
+        self.assertEqual(TestModel.objects.count(), 10)
+
+        rows = ((2, "name-{}".format(i), "updated", i) for i in range(5, 15))
+        self.assertEqual(loader.upsert(rows, key_columns=["name"]), 10)
+        self.assertEqual(TestModel.objects.count(), 15)
+        self.assertEqual(TestModel.objects.filter(slug="updated").count(), 10)
+        self.assertEqual(TestModel.objects.get(name="name-5").fk, 2)
+
+        rows = [(3, "name-0", "ignored", 0)]
+        loader.upsert(rows, key_columns=["name"], update_columns=[])
+        self.assertEqual(TestModel.objects.get(name="name-0").slug, "slug")
+
+    def test_bulk_loader_postgresql_staging(self):
+        pg_connection = mock.MagicMock(vendor="postgresql", alias="default")
+        pg_connection.ops.quote_name = '"{}"'.format
+        executed = pg_connection.cursor.return_value.__enter__.return_value.execute
+        loader = RawSQLBulkLoader("table", ["id", "name"], connection=pg_connection)
+
+        with mock.patch.object(loader, "_copy", return_value=1):
+            loader.upsert([(1, "one")], key_columns=["id"])
+            loader.upsert([(1, "one")], key_columns=["id"])
+
+        sqls = [call.args[0] for call in executed.call_args_list]
+        staging = [sql.split('"')[1] for sql in sqls if sql.startswith("CREATE")]
+        self.assertEqual(len(set(staging)), 2)
+        self.assertEqual(
+            [sql for sql in sqls if sql.startswith("DROP")],
+            ['DROP TABLE "{}"'.format(name) for name in staging],
+        )
+
+
+@ajax(["GET", "POST"])
+def _batch_echo_view(request, id, jsondata=None):
+    return {
+        "id": int(id),
+        "method": request.method,
+        "page": request.GET.get("page"),
+        "data": jsondata,
+    }
+
+
+@ajax(["GET"], login_required=True)
+def _batch_private_view(request):
+    return {"private": True}
+
+
+def _batch_plain_view(request):
+    return HttpResponse("plain")
+
+
+@ajax(["GET"])
+def _batch_error_view(request, status):
+    exceptions = {
+        "400": SuspiciousOperation,
+        "403": PermissionDenied,
+        "404": Http404,
+        "500": ValueError,
+    }
+    raise exceptions[status]()
+
+
+urlpatterns = [
+    path("echo/<id>/", _batch_echo_view),
+    path("private/", _batch_private_view),
+    path("plain/", _batch_plain_view),
+    path("error/<status>/", _batch_error_view),
+    path("batch/", ajax_batch_view(max_requests=5)),
+]
+
+
+class DjangoHelpersAjaxTestCase(TestCase):
+    def test_ajax_cache(self):
+        calls = []
+
+        @ajax(["GET", "POST"], cache_ttl=60, vary_on=["user"])
+        def view(request, id, jsondata=None):
+            calls.append(id)
+            return {"id": id, "data": jsondata}
+
+        def request(method="get", path="/", **kwargs):
+            req = getattr(RequestFactory(), method)(path, **kwargs)
+            req.user = AnonymousUser()
+            return req
+
+        cache.clear()
+        response = view(request(), 1)
+        self.assertEqual(json.loads(response.content), {"id": 1, "data": None})
+        etag = response["ETag"]
+
+        response = view(request(), 1)
+        self.assertEqual(json.loads(response.content), {"id": 1, "data": None})
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(calls, [1])
+
+        response = view(request(HTTP_IF_NONE_MATCH=etag), 1)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(calls, [1])
+
+        view(request(), 2)
+        view(request(path="/?page=2"), 1)
+        view(request("post", data={"a": 1}, content_type="application/json"), 1)
+        view(request("post", data={"a": 1}, content_type="application/json"), 1)
+        view(request("post", data={"a": 2}, content_type="application/json"), 1)
+        self.assertEqual(calls, [1, 2, 1, 1, 1])
+
+    def test_ajax_cache_login_required(self):
+        @ajax(["GET"], login_required=True, cache_ttl=60)
+        def view(request):
+            return {"username": request.user.username}
+
+        alice = User.objects.create_user("alice")
+        bob = User.objects.create_user("bob")
+
+        cache.clear()
+        for user in (alice, bob, alice, bob):
+            request = RequestFactory().get("/")
+            request.user = user
+            self.assertEqual(json.loads(view(request).content), {"username": user.username})
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "db": {
+                "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                "LOCATION": "test_ajax_cache",
+            },
+        }
+    )
+    def test_async_ajax_cache(self):
+        calls = []
+
+        @ajax(["GET"], login_required=True, cache_ttl=60, cache_alias="db")
+        async def view(request):
+            calls.append(request.user.username)
+            return {"username": request.user.username}
+
+        call_command("createcachetable", "test_ajax_cache", verbosity=0)
+        alice = User.objects.create_user("alice")
+        bob = User.objects.create_user("bob")
+
+        for user in (alice, bob, alice, bob):
+            request = RequestFactory().get("/")
+            request.user = user
+            response = async_to_sync(view)(request)
+            self.assertEqual(json.loads(response.content), {"username": user.username})
+        self.assertEqual(calls, ["alice", "bob"])
+
+    def test_json_backends(self):
+        class Color(EnumX):
+            RED = ("R", "Red")
+
+        data = {
+            "date": datetime.date(2020, 1, 2),
+            "datetime": datetime.datetime(2020, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc),
+            "decimal": decimal.Decimal("1.50"),
+            "uuid": uuid.UUID(int=1),
+            "list": [1, 2.5, None, True, "text"],
+            1: "int key",
+        }
+        expected = json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+        enum_expected = json.dumps([Color.RED], cls=DjangoJSONEncoderWithEnum).encode("utf-8")
+
+        for name in ("json", "auto"):
+            backend = get_json_backend(name)
+            content = backend.dumps(data, DjangoJSONEncoder)
+            self.assertEqual(backend.loads(content), expected)
+            self.assertEqual(backend.dumps([Color.RED], DjangoJSONEncoderWithEnum), enum_expected)
+
+        @ajax(["POST"], json_backend="auto")
+        def view(request, jsondata=None):
+            return jsondata
+
+        request = RequestFactory().post("/", data=[1, "a"], content_type="application/json")
+        self.assertEqual(json.loads(view(request).content), [1, "a"])
+        request = RequestFactory().post("/", data="{", content_type="application/json")
+        self.assertEqual(view(request).status_code, 400)
+
+    def test_json_backends_output(self):
+        data = {
+            "decimals": [decimal.Decimal("1.10"), decimal.Decimal("-0.000001")],
+            "uuid": uuid.UUID(int=1),
+            "datetime": datetime.datetime(2020, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc),
+            "time": datetime.time(1, 2, 3, 456789),
+            "lazy": gettext_lazy("Lazy text"),
+            "nested": ({"decimal": decimal.Decimal("2.50")},),
+        }
+        expected = json.dumps(data, cls=DjangoJSONEncoder)
+
+        for name, backend in JSON_BACKENDS.items():
+            if backend is not None:
+                with self.subTest(backend=name):
+                    content = backend.dumps(data, DjangoJSONEncoder)
+                    self.assertEqual(json.loads(content), json.loads(expected))
+
+    def test_async_ajax(self):
+        @cors(["http://example.com"])
+        @ajax(["POST"])
+        async def view(request, jsondata=None):
+            await asyncio.sleep(0)
+            return {"received": jsondata}
+
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        self.assertTrue(view.ajax_batchable)
+
+        request = RequestFactory().post(
+            "/", data=[1], content_type="application/json", HTTP_ORIGIN="http://example.com"
+        )
+        response = async_to_sync(view)(request)
+        self.assertEqual(json.loads(response.content), {"received": [1]})
+        self.assertEqual(response["Access-Control-Allow-Origin"], "http://example.com")
+        self.assertTrue(request.META["CSRF_COOKIE_USED"])
+
+        response = async_to_sync(view)(RequestFactory().get("/"))
+        self.assertEqual(response.status_code, 400)
+
+    def test_ajax_streaming(self):
+        @ajax(["GET"])
+        def view(request, count):
+            return ({"id": i} for i in range(count))
+
+        for count in (0, 1, 3):
+            response = view(RequestFactory().get("/"), count)
+            self.assertTrue(response.streaming)
+            content = b"".join(response.streaming_content)
+            self.assertEqual(json.loads(content), [{"id": i} for i in range(count)])
+
+        response = view(RequestFactory().get("/", HTTP_ACCEPT="application/x-ndjson"), 2)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(b"".join(response.streaming_content), b'{"id": 0}\n{"id": 1}\n')
+
+        @ajax(["GET"])
+        def queryset_view(request):
+            return TestModel.objects.values("name").order_by("name")
+
+        TestModel.objects.create(fk=1, name="a")
+        TestModel.objects.create(fk=1, name="b")
+        response = queryset_view(RequestFactory().get("/"))
+        content = b"".join(response.streaming_content)
+        self.assertEqual(json.loads(content), [{"name": "a"}, {"name": "b"}])
+
+    def test_async_ajax_streaming(self):
+        @ajax(["GET"])
+        async def queryset_view(request):
+            return TestModel.objects.values("name").order_by("name")
+
+        async def get_content(request):
+            # Iterate the response in the event loop, as the ASGI handler does
+            response = await queryset_view(request)
+            self.assertTrue(response.streaming)
+            return b"".join(response.streaming_content)
+
+        TestModel.objects.create(fk=1, name="a")
+        TestModel.objects.create(fk=1, name="b")
+        content = async_to_sync(get_content)(RequestFactory().get("/"))
+        self.assertEqual(json.loads(content), [{"name": "a"}, {"name": "b"}])
+
+    @override_settings(ROOT_URLCONF=__name__)
+    def test_ajax_batch_view(self):
+        def batch(data):
+            request = RequestFactory().post("/batch/", data=data, content_type="application/json")
+            request.user = AnonymousUser()
+            return resolve("/batch/").func(request)
+
+        response = batch(
+            [
+                {"path": "/echo/1/?page=2"},
+                {"path": "/echo/2/", "method": "post", "body": {"a": 1}},
+                {"path": "/private/"},
+                {"path": "/plain/"},
+                {"path": "/missing/"},
+            ]
+        )
+        self.assertEqual(
+            json.loads(response.content),
+            [
+                {"status": 200, "body": {"id": 1, "method": "GET", "page": "2", "data": None}},
+                {
+                    "status": 200,
+                    "body": {"id": 2, "method": "POST", "page": None, "data": {"a": 1}},
+                },
+                {"status": 403, "body": "Permission denied."},
+                {"status": 404, "body": "Not an ajax view."},
+                {"status": 404, "body": "Not found."},
+            ],
+        )
+
+        response = batch(
+            {"parallel": True, "requests": [{"path": "/echo/{}/".format(i)} for i in range(5)]}
+        )
+        self.assertEqual([r["body"]["id"] for r in json.loads(response.content)], list(range(5)))
+
+        for parallel in (False, True):
+            with self.assertLogs("dwtools3.django.helpers", "ERROR"):
+                response = batch(
+                    {
+                        "parallel": parallel,
+                        "requests": [
+                            {"path": "/echo/1/"},
+                            {"path": "/error/404/"},
+                            {"path": "/error/403/"},
+                            {"path": "/error/400/"},
+                            {"path": "/error/500/"},
+                        ],
+                    }
+                )
+            self.assertEqual(
+                [(r["status"], r["body"]) for r in json.loads(response.content)],
+                [
+                    (200, {"id": 1, "method": "GET", "page": None, "data": None}),
+                    (404, "Not found."),
+                    (403, "Permission denied."),
+                    (400, "Bad request."),
+                    (500, "Server error."),
+                ],
+            )
+
+        self.assertEqual(batch([{"path": "/echo/1/"}] * 6).status_code, 400)
+        self.assertEqual(batch([{"method": "GET"}]).status_code, 400)
+        self.assertEqual(json.loads(batch([{"path": "/batch/"}]).content)[0]["status"], 404)
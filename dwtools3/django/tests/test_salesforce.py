@@ -0,0 +1,851 @@
+import csv
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlparse
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from simple_salesforce import (
+    Salesforce,
+    SalesforceError,
+    SalesforceMalformedRequest,
+    SalesforceResourceNotFound,
+    SFType,
+)
+
+from ..salesforce import aio, api, bulk, helpers, stats
+from ..salesforce.models import SyncQueueItem
+from ..salesforce.settings import SalesforceSettings
+
+sync_calls = []
+
+
+class FakeSalesforceHandler(BaseHTTPRequestHandler):
+    """
+    Implements the subset of the salesforce REST API used by the helpers,
+    storing records in memory.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        path = url.path.split("/services/data/v59.0/", 1)[1]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else None
+        if body and self.headers.get("Content-Type") != "text/csv":
+            body = json.loads(body)
+
+        with server.lock:
+            server.calls.append((method, path))
+            status, response = server.dispatch(method, path, query, body)
+
+        if response is None:
+            content_type, content = "application/json", b""
+        elif isinstance(response, str):
+            content_type, content = "text/csv", response.encode("utf-8")
+        else:
+            content_type, content = "application/json", json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeSalesforce(Salesforce):
+    """
+    ``Salesforce`` instance whose sObject types use its own ``base_url``,
+    rather than HTTPS to the instance.
+    """
+
+    def __getattr__(self, name):
+        sf_type = super().__getattr__(name)
+        if isinstance(sf_type, SFType):
+            sf_type.base_url = "{}sobjects/{}/".format(self.base_url, name)
+        return sf_type
+
+
+class FakeSalesforceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    QUERY_RE = re.compile(r"SELECT Id, (\w+) FROM (\w+) WHERE \w+ IN \((.*)\)")
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSalesforceHandler)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.records = {}
+        self.jobs = {}
+        self.next_id = 1
+        # Before API v46, upserts which update a record return no content
+        self.legacy_upsert = False
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def create_sf_instance(self):
+        sf_instance = FakeSalesforce(instance_url="http://127.0.0.1", session_id="test")
+        sf_instance.base_url = "http://127.0.0.1:{}/services/data/v59.0/".format(
+            self.server_address[1]
+        )
+        return sf_instance
+
+    def find(self, sobject, field, value):
+        for record in self.records.values():
+            if record["attributes"]["type"] == sobject and str(record.get(field)) == str(value):
+                return record
+        return None
+
+    def save(self, record, id=None):
+        if record.get("LastName") == "":
+            return {"success": False, "errors": [{"statusCode": "REQUIRED_FIELD_MISSING"}]}
+        if id is None:
+            id = "003{:015d}".format(self.next_id)
+            self.next_id += 1
+            self.records[id] = {"Id": id}
+        self.records[id].update(record)
+        return {"id": id, "success": True, "errors": []}
+
+    def dispatch(self, method, path, query, body):
+        if method == "GET" and path == "query/":
+            field, sobject, values = self.QUERY_RE.match(query["q"]).groups()
+            records = [self.find(sobject, field, v.strip(" '")) for v in values.split(",")]
+            # Number fields are returned as floats
+            records = [
+                dict(r, **{field: float(r[field])}) if isinstance(r[field], int) else r
+                for r in records
+                if r
+            ]
+            return 200, {"totalSize": len(records), "done": True, "records": records}
+
+        if path == "composite/sobjects" and method == "POST":
+            return 200, [self.save(r) for r in body["records"]]
+
+        if path == "composite/sobjects" and method == "PATCH":
+            return 200, [
+                (
+                    self.save(r, r.pop("id"))
+                    if r["id"] in self.records
+                    else {"id": r["id"], "success": False, "errors": [{"statusCode": "NOT_FOUND"}]}
+                )
+                for r in body["records"]
+            ]
+
+        if path.startswith("composite/sobjects/") and method == "PATCH":
+            sobject, field = path.split("/")[2:4]
+            responses = []
+            for r in body["records"]:
+                existing = self.find(sobject, field, r[field])
+                response = self.save(r, existing["Id"] if existing else None)
+                response["created"] = existing is None
+                responses.append(response)
+            return 200, responses
+
+        if path.startswith("sobjects/") and path.count("/") == 3:
+            sobject, field, value = [unquote(part) for part in path.split("/")[1:]]
+            existing = self.find(sobject, field, value)
+            if method == "GET":
+                if existing is None:
+                    return 404, [{"errorCode": "NOT_FOUND", "message": "Not found"}]
+                return 200, existing
+            record = dict(body, attributes={"type": sobject}, **{field: value})
+            response = self.save(record, existing["Id"] if existing else None)
+            if not response["success"]:
+                error = response["errors"][0]["statusCode"]
+                return 400, [{"errorCode": error, "message": error}]
+            if existing and self.legacy_upsert:
+                return 204, None
+            return (200 if existing else 201), dict(response, created=existing is None)
+
+        if path == "composite/sobjects" and method == "DELETE":
+            return 200, [
+                {"id": id, "success": self.records.pop(id, None) is not None, "errors": []}
+                for id in query["ids"].split(",")
+            ]
+
+        if path.startswith("jobs/ingest/"):
+            return self.dispatch_bulk_job(method, path.split("/")[2:-1], body)
+
+        return 404, [{"errorCode": "NOT_FOUND", "message": "Not found"}]
+
+    def dispatch_bulk_job(self, method, path, body):
+        """
+        Implements Bulk API 2.0 ingest jobs, which are processed once uploaded
+        and complete on the second status check.
+        """
+        if not path:
+            id = "750{:015d}".format(len(self.jobs) + 1)
+            self.jobs[id] = dict(body, id=id, state="Open", polls=0, rows=[], results={})
+            return 200, self.jobs[id]
+
+        job = self.jobs[path[0]]
+        if len(path) == 1 and method == "PATCH":
+            job["state"] = body["state"]
+            if body["state"] == "UploadComplete":
+                self.process_bulk_job(job)
+            return 200, job
+        if len(path) == 1:
+            job["polls"] += 1
+            if job["state"] == "UploadComplete" and job["polls"] >= 2:
+                job["state"] = "JobComplete"
+            return 200, {"id": job["id"], "state": job["state"]}
+        if path[1] == "batches":
+            job["rows"] = list(csv.DictReader(io.StringIO(body)))
+            return 201, ""
+        return 200, job["results"][path[1]]
+
+    def process_bulk_job(self, job):
+        results = {"successfulResults": [], "failedResults": [], "unprocessedrecords": []}
+        for row in job["rows"]:
+            existing = self.find(
+                job["object"], job["externalIdFieldName"], row[job["externalIdFieldName"]]
+            )
+            record = dict(row, attributes={"type": job["object"]})
+            response = self.save(record, existing["Id"] if existing else None)
+            if response["success"]:
+                row = dict(sf__Id=response["id"], sf__Created=str(existing is None).lower(), **row)
+                results["successfulResults"].append(row)
+            else:
+                row = dict(sf__Id="", sf__Error=response["errors"][0]["statusCode"], **row)
+                results["failedResults"].append(row)
+
+        job["results"] = {}
+        for name, rows in results.items():
+            fields = list(rows[0].keys()) if rows else ["sf__Id"]
+            content = io.StringIO()
+            writer = csv.DictWriter(content, fields, lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rows)
+            job["results"][name] = content.getvalue()
+
+
+class FakeSFType:
+    """
+    Stand-in for a simple-salesforce ``SFType``, storing records in memory.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.records = {}
+        self.lookups = 0
+
+    def get_by_custom_id(self, field, value):
+        self.lookups += 1
+        for record in self.records.values():
+            if str(record.get(field)) == str(value):
+                return dict(record)
+        raise SalesforceResourceNotFound("", 404, self.name, [])
+
+    def create(self, data):
+        id = "003{:015d}".format(len(self.records) + 1)
+        self.records[id] = dict(data, Id=id)
+        return {"id": id, "success": True, "errors": []}
+
+    def update(self, id, data):
+        if id not in self.records:
+            raise SalesforceResourceNotFound("", 404, self.name, [])
+        self.records[id].update(data)
+        return 204
+
+    def delete(self, id):
+        if self.records.pop(id, None) is None:
+            raise SalesforceResourceNotFound("", 404, self.name, [])
+        return 204
+
+
+fake_contacts = FakeSFType("Contact")
+
+
+def lookup_sync_call(value):
+    helpers.get_by_external_id(fake_contacts, value)
+
+
+class SlowFakeSFType(FakeSFType):
+    """
+    ``FakeSFType`` whose lookups are slow, recording the most concurrent lookups.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def get_by_custom_id(self, field, value):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+            return super().get_by_custom_id(field, value)
+
+
+slow_fake_contacts = SlowFakeSFType("Contact")
+
+
+def batch_sync_call(value):
+    batch = helpers.SalesforceBatch()
+    batch.create("Contact", {"LastName": str(value)})
+    batch.execute()
+
+
+async def async_batch_sync_call(value):
+    await aio.run_in_executor(batch_sync_call, value)
+
+
+async def async_lookup_sync_call(value):
+    sync_calls.append(await aio.get_by_external_id(slow_fake_contacts, value))
+
+
+def record_sync_call(value):
+    sync_calls.append(value)
+
+
+def failing_sync_call(value):
+    raise ValueError(value)
+
+
+@api.coalesce_sync_calls(key=lambda params: params["id"])
+def coalesced_sync_call(id, value):
+    sync_calls.append((id, value))
+
+
+@api.coalesce_sync_calls(
+    key=lambda params: params["id"],
+    merge=lambda older, newer: dict(newer, fields={**older["fields"], **newer["fields"]}),
+)
+def merged_sync_call(id, fields):
+    sync_calls.append((id, fields))
+
+
+class DjangoSalesforceSyncQueueTestCase(TestCase):
+    def test_claim_sync_function(self):
+        api.schedule_sync_function(record_sync_call, 1)
+        api.schedule_sync_function(record_sync_call, 2)
+
+        first = api.claim_next_scheduled_sync_function()
+        second = api.claim_next_scheduled_sync_function()
+        self.assertEqual((first.params, second.params), (1, 2))
+        self.assertNotEqual(first.claimed_by, second.claimed_by)
+        self.assertIsNone(api.claim_next_scheduled_sync_function())
+
+        api.complete_sync_function(first)
+        self.assertEqual(SyncQueueItem.objects.count(), 1)
+
+        # Expired leases are released to other workers
+        SyncQueueItem.objects.update(claim_expires_at=timezone.now() - timedelta(seconds=1))
+        reclaimed = api.claim_next_scheduled_sync_function()
+        self.assertEqual(reclaimed.params, 2)
+        api.complete_sync_function(second)
+        self.assertEqual(SyncQueueItem.objects.count(), 1)
+
+        api.reschedule_sync_function(reclaimed, delay_mins=0)
+        item = SyncQueueItem.objects.get()
+        self.assertEqual(
+            (item.id, item.claimed_by, item.claim_expires_at), (reclaimed.id, "", None)
+        )
+
+        self.assertEqual(api.get_next_scheduled_sync_function().params, 2)
+        self.assertFalse(SyncQueueItem.objects.exists())
+
+    def test_reschedule_lost_claim(self):
+        api.schedule_sync_function(record_sync_call, 1)
+        item = api.claim_next_scheduled_sync_function()
+
+        # The lease expired and another worker claimed the item
+        SyncQueueItem.objects.update(claim_expires_at=timezone.now() - timedelta(seconds=1))
+        other = api.claim_next_scheduled_sync_function()
+
+        with self.assertLogs("dwtools3.django.salesforce", "WARNING"):
+            api.reschedule_sync_function(item, delay_mins=5)
+        self.assertEqual(SyncQueueItem.objects.get().claimed_by, other.claimed_by)
+
+    def test_retry_if_locked(self):
+        fn = mock.Mock(side_effect=[OperationalError("database table is locked"), 1])
+        with mock.patch.object(api.time, "sleep"):
+            self.assertEqual(api._retry_if_locked(fn), 1)
+        self.assertEqual(fn.call_count, 2)
+
+        fn = mock.Mock(side_effect=OperationalError("no such table: locked_items"))
+        with self.assertRaises(OperationalError):
+            api._retry_if_locked(fn)
+        self.assertEqual(fn.call_count, 1)
+
+        fn = mock.Mock(side_effect=OperationalError("database is locked"))
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            with self.assertRaises(OperationalError):
+                api._retry_if_locked(fn)
+        self.assertEqual(fn.call_count, 1)
+
+    def test_coalesce_sync_function(self):
+        for i in range(3):
+            api.schedule_sync_function(merged_sync_call, {"id": 1, "fields": {"F{}".format(i): i}})
+        api.schedule_sync_function(merged_sync_call, {"id": 2, "fields": {}})
+        api.schedule_sync_function(
+            merged_sync_call, {"id": 1, "fields": {}}, scheduled_at=timezone.now() + timedelta(1)
+        )
+
+        item = api.claim_next_scheduled_sync_function()
+        self.assertEqual(item.coalesce_key, "1")
+        with self.assertLogs("dwtools3.django.salesforce", "INFO"):
+            self.assertEqual(api.coalesce_sync_function(item), 2)
+        self.assertEqual(item.params["fields"], {"F0": 0, "F1": 1, "F2": 2})
+        self.assertEqual(api.coalesce_sync_function(item), 0)
+
+        # Rescheduling keeps a single entry with the merged params
+        api.reschedule_sync_function(item, delay_mins=0)
+        self.assertEqual(SyncQueueItem.objects.filter(coalesce_key="1").count(), 2)
+        self.assertEqual(SyncQueueItem.objects.get(id=item.id).params, item.params)
+
+        item = api.claim_next_scheduled_sync_function()
+        api.complete_sync_function(item)
+        self.assertEqual(SyncQueueItem.objects.count(), 2)
+
+
+class DjangoSalesforceSyncCommandTestCase(TransactionTestCase):
+    def test_salesforce_sync_workers(self):
+        for i in range(10):
+            api.schedule_sync_function(record_sync_call, i)
+        api.schedule_sync_function(failing_sync_call, "error", reschedule_on_error=5)
+
+        del sync_calls[:]
+        SalesforceSettings.SALESFORCE_ENABLED = True
+        try:
+            with self.assertLogs("dwtools3.django.salesforce", "INFO"):
+                call_command("salesforce_sync", workers=3)
+        finally:
+            SalesforceSettings.SALESFORCE_ENABLED = False
+
+        self.assertEqual(sorted(sync_calls), list(range(10)))
+        item = SyncQueueItem.objects.get()
+        self.assertEqual(item.function, "failing_sync_call")
+        self.assertGreater(item.scheduled_at, timezone.now() + timedelta(minutes=4))
+
+    def test_salesforce_sync_concurrency(self):
+        for i in range(6):
+            api.schedule_sync_function(async_lookup_sync_call, i)
+        api.schedule_sync_function(record_sync_call, "sync")
+        api.schedule_sync_function(failing_sync_call, "error", reschedule_on_error=5)
+
+        del sync_calls[:]
+        slow_fake_contacts.max_active = 0
+        SalesforceSettings.SALESFORCE_ENABLED = True
+        try:
+            with self.assertLogs("dwtools3.django.salesforce", "INFO"):
+                call_command("salesforce_sync", concurrency=4)
+        finally:
+            SalesforceSettings.SALESFORCE_ENABLED = False
+
+        self.assertEqual(sorted(sync_calls, key=str), [None] * 6 + ["sync"])
+        self.assertIn(slow_fake_contacts.max_active, (2, 3, 4))
+        self.assertEqual(SyncQueueItem.objects.get().function, "failing_sync_call")
+
+        with self.assertRaises(CommandError):
+            call_command("salesforce_sync", concurrency=4, workers=2)
+
+    def test_salesforce_sync_stats(self):
+        for i in range(3):
+            api.schedule_sync_function(batch_sync_call, i)
+        api.schedule_sync_function(async_batch_sync_call, 3)
+        api.schedule_sync_function(failing_sync_call, "error", reschedule_on_error=5)
+        api.schedule_sync_function(
+            record_sync_call, "later", scheduled_at=timezone.now() + timedelta(1)
+        )
+
+        SalesforceSettings.SALESFORCE_ENABLED = True
+        try:
+            with FakeSalesforceServer() as server, tempfile.TemporaryDirectory() as directory:
+                sf_instance = server.create_sf_instance()
+                stats.instrument_session(sf_instance.session)
+                path = os.path.join(directory, "stats.json")
+                out = io.StringIO()
+                with mock.patch.object(helpers, "sf", sf_instance):
+                    with self.assertLogs("dwtools3.django.salesforce", "INFO"):
+                        call_command("salesforce_sync", stats=True, stats_file=path, stdout=out)
+                with open(path, encoding="utf-8") as f:
+                    report = json.load(f)
+        finally:
+            SalesforceSettings.SALESFORCE_ENABLED = False
+
+        self.assertEqual(report["queue"]["start"]["depth"], 6)
+        self.assertEqual(report["queue"]["start"]["due"], 5)
+        self.assertGreater(report["queue"]["start"]["oldest_due_secs"], 0)
+        self.assertEqual(report["queue"]["end"], {"depth": 2, "due": 0, "oldest_due_secs": 0})
+        self.assertEqual((report["runs"], report["api_calls"]), (5, 4))
+
+        functions = report["functions"]
+        self.assertEqual(functions["batch_sync_call"]["runs"], 3)
+        self.assertEqual(functions["batch_sync_call"]["api_calls"]["total"], 3)
+        self.assertEqual(functions["batch_sync_call"]["latency_ms"]["count"], 3)
+        self.assertEqual(functions["async_batch_sync_call"]["api_calls"]["total"], 1)
+        self.assertEqual(functions["failing_sync_call"]["errors"], 1)
+        self.assertEqual(functions["failing_sync_call"]["reschedules"], 1)
+        self.assertIn("batch_sync_call", out.getvalue())
+        self.assertIn("5 runs in", out.getvalue())
+
+    def test_salesforce_sync_lookup_cache(self):
+        for i in range(4):
+            api.schedule_sync_function(lookup_sync_call, i % 2)
+
+        fake_contacts.lookups = 0
+        SalesforceSettings.SALESFORCE_ENABLED = True
+        SalesforceSettings.SALESFORCE_LOOKUP_CACHE = True
+        try:
+            with self.assertLogs("dwtools3.django.salesforce", "INFO") as logs:
+                call_command("salesforce_sync")
+        finally:
+            SalesforceSettings.SALESFORCE_ENABLED = False
+            SalesforceSettings.SALESFORCE_LOOKUP_CACHE = False
+
+        self.assertEqual(fake_contacts.lookups, 2)
+        self.assertIn("Lookup cache: 2 hits, 2 misses (50% hit rate)", logs.output[-1])
+        self.assertFalse(helpers.lookup_cache.enabled)
+
+    def test_salesforce_sync_coalesce(self):
+        for i in range(10):
+            api.schedule_sync_function(coalesced_sync_call, {"id": i % 3, "value": i})
+        api.schedule_sync_function(coalesced_sync_call, {"id": 0, "value": 10}, coalesce_key="")
+
+        del sync_calls[:]
+        SalesforceSettings.SALESFORCE_ENABLED = True
+        try:
+            with self.assertLogs("dwtools3.django.salesforce", "INFO") as logs:
+                call_command("salesforce_sync")
+        finally:
+            SalesforceSettings.SALESFORCE_ENABLED = False
+
+        self.assertEqual(sorted(sync_calls), [(0, 9), (0, 10), (1, 7), (2, 8)])
+        self.assertFalse(SyncQueueItem.objects.exists())
+        self.assertIn("Coalesced 7 duplicate calls: coalesced_sync_call() x7", logs.output[-1])
+
+
+class DjangoSalesforceAioTestCase(TestCase):
+    def test_run_in_executor_closes_connections(self):
+        async def run():
+            return await aio.run_in_executor(threading.current_thread)
+
+        with mock.patch.object(aio.connections, "close_all") as close_all:
+            thread = async_to_sync(run)()
+        self.assertNotEqual(thread, threading.current_thread())
+        close_all.assert_called_once_with()
+
+    def test_sf_setup_once(self):
+        instances = []
+
+        def create_instance():
+            time.sleep(0.05)
+            instances.append(object())
+            return instances[-1]
+
+        lazy_sf = api._ThreadSafeLazyObject(create_instance)
+        threads = [threading.Thread(target=lambda: str(lazy_sf)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(instances), 1)
+
+
+class DjangoSalesforceBatchTestCase(TestCase):
+    def test_batch(self):
+        with FakeSalesforceServer() as server:
+            batch = helpers.SalesforceBatch(sf_instance=server.create_sf_instance())
+            created = [
+                batch.create("Contact", {"LastName": "User {}".format(i)}, external_id=i)
+                for i in range(250)
+            ]
+            failed = batch.create("Contact", {"LastName": ""})
+            results = batch.execute()
+
+            self.assertEqual(results, created + [failed])
+            self.assertTrue(all(r.success for r in created))
+            self.assertEqual(len({r.id for r in created}), 250)
+            self.assertFalse(failed.success)
+            self.assertEqual(failed.errors[0]["statusCode"], "REQUIRED_FIELD_MISSING")
+            self.assertEqual(server.calls, [("POST", "composite/sobjects")] * 2)
+
+            del server.calls[:]
+            updated = batch.update("Contact", {"FirstName": "A"}, external_id=1)
+            missing = batch.update("Contact", {"FirstName": "B"}, external_id="missing")
+            upserted = batch.upsert("Contact", {"LastName": "Upserted"}, external_id=2)
+            inserted = batch.upsert("Contact", {"LastName": "New"}, external_id=1000)
+            deleted = batch.delete("Contact", id=created[3].id)
+            batch.execute()
+
+            self.assertEqual((updated.success, updated.id), (True, created[1].id))
+            self.assertEqual(server.records[created[1].id]["FirstName"], "A")
+            self.assertEqual((missing.success, missing.id), (False, None))
+            self.assertEqual((upserted.success, upserted.created), (True, False))
+            self.assertEqual(server.records[created[2].id]["LastName"], "Upserted")
+            self.assertEqual((inserted.success, inserted.created), (True, True))
+            self.assertTrue(deleted.success)
+            self.assertNotIn(created[3].id, server.records)
+            self.assertEqual(
+                server.calls,
+                [
+                    ("GET", "query/"),
+                    ("PATCH", "composite/sobjects"),
+                    ("PATCH", "composite/sobjects/Contact/ExternalID__c"),
+                    ("DELETE", "composite/sobjects"),
+                ],
+            )
+
+    def test_upsert_record(self):
+        with FakeSalesforceServer() as server:
+            with mock.patch.object(helpers, "sf", server.create_sf_instance()):
+                id = helpers.create_or_update_contact({"LastName": "One"}, external_id=1)
+                self.assertEqual(helpers.upsert_contact({"LastName": "Two"}, external_id=1), id)
+                self.assertEqual(server.records[id]["LastName"], "Two")
+                self.assertEqual(
+                    server.calls,
+                    [
+                        ("PATCH", "sobjects/Contact/ExternalID__c/1"),
+                        ("PATCH", "sobjects/Contact/ExternalID__c/1"),
+                    ],
+                )
+
+                # Older API versions return no content for updates
+                server.legacy_upsert = True
+                self.assertEqual(helpers.upsert_contact({"LastName": "Three"}, external_id=1), id)
+                self.assertEqual(server.records[id]["LastName"], "Three")
+                self.assertEqual(server.calls[-1], ("GET", "sobjects/Contact/ExternalID__c/1"))
+
+                id = helpers.upsert_contact({"LastName": "Slash"}, external_id="a/b")
+                self.assertEqual(server.records[id]["ExternalID__c"], "a/b")
+
+                with self.assertRaises(SalesforceMalformedRequest) as cm:
+                    helpers.upsert_contact({"LastName": ""}, external_id=2)
+                self.assertIn("REQUIRED_FIELD_MISSING", str(cm.exception))
+
+
+class DjangoSalesforceLookupCacheTestCase(TestCase):
+    def setUp(self):
+        helpers.lookup_cache.enable()
+
+    def tearDown(self):
+        helpers.lookup_cache.disable()
+        SalesforceSettings.SALESFORCE_LOOKUP_CACHE_ALIAS = None
+        SalesforceSettings.SALESFORCE_LOOKUP_CACHE_FIELDS = None
+        cache.clear()
+
+    def test_lookup_cache(self):
+        contacts = FakeSFType("Contact")
+        id = helpers.create_record(contacts, {"Email": "a@example.com"}, external_id=1)
+
+        for _ in range(3):
+            self.assertEqual(helpers.get_by_external_id(contacts, 1)["Id"], id)
+            self.assertEqual(helpers.get_by_email(contacts, "a@example.com")["Id"], id)
+            self.assertIsNone(helpers.get_by_email(contacts, "b@example.com"))
+        self.assertEqual(contacts.lookups, 3)
+        self.assertEqual((helpers.lookup_cache.hits, helpers.lookup_cache.misses), (6, 3))
+
+        # Updates invalidate lookups by id, and by the new field values
+        helpers.update_record(contacts, {"Email": "b@example.com"}, external_id=1)
+        self.assertEqual(helpers.get_by_email(contacts, "b@example.com")["Id"], id)
+        self.assertIsNone(helpers.get_by_email(contacts, "a@example.com"))
+        self.assertEqual(helpers.get_by_external_id(contacts, 1)["Email"], "b@example.com")
+        self.assertEqual(contacts.lookups, 6)
+
+        helpers.delete_record(contacts, id=id)
+        self.assertIsNone(helpers.get_by_external_id(contacts, 1))
+        self.assertEqual(contacts.lookups, 7)
+
+        helpers.lookup_cache.disable()
+        self.assertIsNone(helpers.get_by_external_id(contacts, 1))
+        self.assertEqual(contacts.lookups, 8)
+
+    def test_lookup_cache_copies(self):
+        contacts = FakeSFType("Contact")
+        helpers.create_record(contacts, {"Email": "a@example.com"}, external_id=1)
+
+        helpers.get_by_external_id(contacts, 1)["Email"] = "changed@example.com"
+        self.assertEqual(helpers.get_by_external_id(contacts, 1)["Email"], "a@example.com")
+        self.assertEqual(contacts.lookups, 1)
+
+    def test_lookup_cache_invalidated_after_update(self):
+        class RacingFakeSFType(FakeSFType):
+            def update(self, id, data):
+                # A concurrent lookup before salesforce applies the update
+                helpers.get_by_external_id(self, 1)
+                return super().update(id, data)
+
+        contacts = RacingFakeSFType("Contact")
+        id = helpers.create_record(contacts, {"Email": "a@example.com"}, external_id=1)
+        helpers.update_record(contacts, {"Email": "b@example.com"}, id=id)
+        self.assertEqual(helpers.get_by_external_id(contacts, 1)["Email"], "b@example.com")
+
+    def test_lookup_django_cache(self):
+        SalesforceSettings.SALESFORCE_LOOKUP_CACHE_ALIAS = "default"
+        SalesforceSettings.SALESFORCE_LOOKUP_CACHE_FIELDS = ["Email"]
+        contacts = FakeSFType("Contact")
+        id = helpers.create_record(contacts, {"Email": "a@example.com", "Name": "A"}, external_id=1)
+
+        self.assertEqual(
+            helpers.get_by_external_id(contacts, 1), {"Email": "a@example.com", "Id": id}
+        )
+        helpers.lookup_cache.enable()
+        self.assertEqual(helpers.get_by_external_id(contacts, 1)["Id"], id)
+        self.assertEqual(contacts.lookups, 1)
+        self.assertEqual(helpers.lookup_cache.hits, 1)
+
+        # Invalidated in the Django cache via the record id, for all lookups
+        helpers.get_by_email(contacts, "a@example.com")
+        helpers.lookup_cache.enable()
+        helpers.update_record(contacts, {"Name": "B"}, id=id)
+        helpers.get_by_external_id(contacts, 1)
+        helpers.get_by_email(contacts, "a@example.com")
+        self.assertEqual(contacts.lookups, 4)
+
+        # Invalidated by batch operations
+        batch = helpers.SalesforceBatch(sf_instance=mock.Mock())
+        batch.delete("Contact", id=id)
+        with mock.patch.object(batch, "_execute_delete"):
+            batch.execute()
+        helpers.lookup_cache.enable()
+        helpers.get_by_external_id(contacts, 1)
+        self.assertEqual(contacts.lookups, 5)
+
+    def test_lookup_django_cache_invalidated_outside_sync(self):
+        SalesforceSettings.SALESFORCE_LOOKUP_CACHE_ALIAS = "default"
+        contacts = FakeSFType("Contact")
+        id = helpers.create_record(contacts, {"Email": "a@example.com"}, external_id=1)
+        self.assertEqual(helpers.get_by_external_id(contacts, 1)["Email"], "a@example.com")
+
+        # Eg. a web request updating the record while no sync is running
+        helpers.lookup_cache.disable()
+        helpers.update_record(contacts, {"Email": "b@example.com"}, id=id)
+
+        helpers.lookup_cache.enable()
+        self.assertEqual(helpers.get_by_external_id(contacts, 1)["Email"], "b@example.com")
+        self.assertEqual(contacts.lookups, 2)
+
+
+class DjangoSalesforceBulkTestCase(TestCase):
+    def test_bulk_ingest(self):
+        records = [
+            {
+                "LastName": "" if i == 3 else "User {}".format(i),
+                "ExternalID__c": i,
+                "Active__c": True,
+            }
+            for i in range(10)
+        ]
+
+        with FakeSalesforceServer() as server:
+            server.save(
+                {"LastName": "Existing", "ExternalID__c": "1", "attributes": {"type": "Contact"}}
+            )
+            with self.assertLogs("dwtools3.django.salesforce", "INFO"):
+                jobs = bulk.bulk_ingest(
+                    "Contact",
+                    iter(records),
+                    max_job_bytes=100,
+                    poll_interval=0.01,
+                    sf_instance=server.create_sf_instance(),
+                )
+
+            self.assertEqual([job.records for job in jobs], [5, 4, 1])
+            self.assertTrue(all(job.state == "JobComplete" for job in jobs))
+            self.assertEqual(
+                len([c for c in server.calls if c[1].startswith("jobs/ingest/")]), 3 * 8
+            )
+
+            results = [row for job in jobs for row in job.successful_results]
+            self.assertEqual(len(results), 9)
+            self.assertEqual(results[1]["sf__Created"], "false")
+            self.assertEqual(server.records[results[1]["sf__Id"]]["LastName"], "User 1")
+            self.assertEqual(server.records[results[0]["sf__Id"]]["Active__c"], "true")
+
+            failed = [row for job in jobs for row in job.failed_results]
+            self.assertEqual(len(failed), 1)
+            self.assertEqual(failed[0]["sf__Error"], "REQUIRED_FIELD_MISSING")
+
+        with self.assertLogs("dwtools3.django.salesforce", "WARNING"):
+            count = bulk.requeue_bulk_failures(
+                jobs, record_sync_call, lambda row: int(row["ExternalID__c"])
+            )
+        self.assertEqual(count, 1)
+        self.assertEqual(SyncQueueItem.objects.get().params, 3)
+
+    def test_bulk_ingest_errors(self):
+        with FakeSalesforceServer() as server:
+            sf_instance = server.create_sf_instance()
+            records = [
+                {"LastName": "User 1", "ExternalID__c": 1},
+                {"LastName": "User 2", "ExternalID__c": 2, "Email": "user2@example.com"},
+            ]
+            with self.assertRaises(ValueError):
+                bulk.bulk_ingest("Contact", records, sf_instance=sf_instance)
+            with self.assertRaises(ValueError):
+                bulk.bulk_ingest(
+                    "Contact", records[:1], fields=records[1].keys(), sf_instance=sf_instance
+                )
+            self.assertFalse(server.jobs)
+
+            # Jobs already created are aborted if a later job can't be created
+            create_job = bulk._BulkIngestClient.create_job
+
+            def failing_create_job(client, *args):
+                if server.jobs:
+                    raise SalesforceError("", 500, "jobs/ingest/", "Server error")
+                return create_job(client, *args)
+
+            records = [{"LastName": "User {}".format(i), "ExternalID__c": i} for i in range(10)]
+            with mock.patch.object(bulk._BulkIngestClient, "create_job", failing_create_job):
+                with self.assertLogs("dwtools3.django.salesforce", "INFO"):
+                    with self.assertRaises(SalesforceError):
+                        bulk.bulk_ingest(
+                            "Contact", records, max_job_bytes=100, sf_instance=sf_instance
+                        )
+            self.assertEqual([job["state"] for job in server.jobs.values()], ["Aborted"])
+
+    def test_bulk_ingest_timeout(self):
+        with FakeSalesforceServer() as server:
+            with self.assertRaises(bulk.SalesforceBulkError):
+                bulk.bulk_ingest(
+                    "Contact",
+                    [{"LastName": "User", "ExternalID__c": 1}],
+                    poll_interval=0.01,
+                    timeout=0,
+                    sf_instance=server.create_sf_instance(),
+                )
+            with self.assertRaises(bulk.SalesforceBulkError):
+                bulk.bulk_ingest("Contact", [{"LastName": "User"}])
@@ -1,6 +1,14 @@
+"""
+Tools for profiling Python code, either deterministically with ``cProfile``
+or by periodically sampling a thread's stack.
+"""
+import collections
 import cProfile
+import io
+import os
 import pstats
-import StringIO
+import sys
+import threading
 
 
 def profile_function(fn, sort_by_cumulative_time=True):
@@ -8,8 +16,71 @@ def profile_function(fn, sort_by_cumulative_time=True):
     pr.enable()
     fn()
     pr.disable()
-    s = StringIO.StringIO()
+    s = io.StringIO()
     sortby = "time" if not sort_by_cumulative_time else "cumulative"
     ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
     ps.print_stats()
     return s.getvalue()
+
+
+class StackSampler:
+    """
+    Samples the stack of a single thread at regular intervals from a
+    background thread, with much lower overhead than ``cProfile``.
+
+    The result is available in the "collapsed stacks" format used by
+    flamegraph tools (eg. ``flamegraph.pl`` or speedscope)::
+
+        sampler = StackSampler()
+        sampler.start()
+        do_work()
+        sampler.stop()
+        print(sampler.collapsed())
+
+    :param int thread_id: The ``threading.get_ident()`` of the thread to
+        sample. Defaults to the current thread.
+    :param float interval: Seconds between samples.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        assert self._thread is None, "StackSampler has already been started."
+        self._thread = threading.Thread(target=self._run, name="StackSampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            if frame is None:
+                break
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "{}:{}:{}".format(
+                        os.path.basename(code.co_filename), code.co_name, code.co_firstlineno
+                    )
+                )
+                frame = frame.f_back
+            del frame
+
+            self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """
+        Returns the samples in collapsed stacks format, one ``stack count`` per line.
+        """
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.samples.items())
+